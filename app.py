@@ -1,14 +1,33 @@
 # FORCING A NEW DEPLOYMENT
+import time
+BOOT_STARTED = time.perf_counter() # cold-start measurement, see report_cold_start
 import io
 # ... rest of your code ...
 import io
 import json
+import hmac
+import hashlib
+import base64
+from collections import Counter
+from types import SimpleNamespace
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import webbrowser # Keep for local run
+import csv
+import tempfile
+import threading
 import os
+import random
+import functools
 import datetime
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash
+from flask import Flask, render_template, request, redirect, url_for, send_file, flash, Response, stream_with_context, abort, jsonify, g, session, has_app_context, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy import tuple_, insert, select, update, func, extract, literal, Date, or_, case, text, event, inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.datastructures import MultiDict
+from sqlalchemy.orm import relationship, selectinload, joinedload, make_transient_to_detached, object_session
 from datetime import datetime as dt
 
 # --- NEW IMPORTS ---
@@ -16,18 +35,21 @@ from flask_login import LoginManager, UserMixin, login_user, logout_user, login_
 from werkzeug.security import generate_password_hash, check_password_hash
 # --- END NEW IMPORTS ---
 
-# --- PLATYPUS IMPORTS ---
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-from reportlab.lib.units import inch, mm
-from reportlab.lib.enums import TA_RIGHT, TA_LEFT, TA_CENTER
-
-# --- FONT IMPORTS ---
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.fonts import addMapping
+# --- PDF RENDERING ---
+from formatting import get_currency_symbol, format_date
+from documents import RENDERER_VERSION, LARGE_INVOICE_ITEMS, INVOICE_FIELDS, invoice_document, pack_document, unpack_document # pdf_renderer (ReportLab) is imported where PDFs are actually rendered
+from pdf_cache import PdfCache, document_key
+from ttl_cache import TTLCache
+from migrations import NATIVE_TYPES_STEPS, native_types_check, native_types_state, ensure_customer_search_index, customer_search_backend, add_missing_columns, backfill_due_dates, backfill_gst_keys, ensure_unique_invoice_numbers
+from bulk_export import stream_pdf_zip, get_render_pool
+from ledger_export import LEDGER_FORMATS, stream_csv, stream_xlsx
+from jobs import JobQueue, JobWorker
+from blob_store import BlobStore
+from metrics import Registry
+from importer import CUSTOMER_COLUMNS, detect_format, iter_records, iter_invoice_payloads, batched
+from numbering import InvoiceNumberAllocator, validate_format as validate_number_format
+from mailer import SmtpBatch, DeliveryError, SmtpUnavailable, build_message, sender_address
+from db_routing import RoutingSession, TimedQueuePool, pool_options
 
 app = Flask(__name__)
 
@@ -38,8 +60,72 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'a-default-fallback-secret-key-for-loc
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['PDF_CACHE_DIR'] = os.environ.get('PDF_CACHE_DIR', os.path.join(app.instance_path, 'pdf_cache'))
+app.config['PDF_CACHE_MAX_ENTRIES'] = int(os.environ.get('PDF_CACHE_MAX_ENTRIES', 256))
+app.config['PDF_CACHE_MAX_BYTES'] = int(os.environ.get('PDF_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['INVOICE_BATCH_MAX'] = int(os.environ.get('INVOICE_BATCH_MAX', 1000)) # invoices per POST /api/invoices
+app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+app.config['IMPORT_MAX_ERRORS'] = int(os.environ.get('IMPORT_MAX_ERRORS', 500)) # per-row errors kept on an import job
+app.config['CUSTOMER_PAGE_SIZE'] = int(os.environ.get('CUSTOMER_PAGE_SIZE', 50))
+app.config['DASHBOARD_PAGE_SIZE'] = int(os.environ.get('DASHBOARD_PAGE_SIZE', 50))
+app.config['INVOICE_NUMBER_FORMAT'] = os.environ.get('INVOICE_NUMBER_FORMAT', 'INV-{seq:04d}') # default for profiles without their own format, see numbering.py
+app.config['INVOICE_NUMBER_BLOCK_SIZE'] = int(os.environ.get('INVOICE_NUMBER_BLOCK_SIZE', 1)) # >1 trades gap-free numbering for less counter contention
+app.config['IDENTITY_CACHE_TTL'] = float(os.environ.get('IDENTITY_CACHE_TTL', 60)) # seconds another worker may serve a stale user/profile
+app.config['IDENTITY_CACHE_MAX_ENTRIES'] = int(os.environ.get('IDENTITY_CACHE_MAX_ENTRIES', 10000))
+app.config['DASHBOARD_KPI_TTL'] = float(os.environ.get('DASHBOARD_KPI_TTL', 300)) # seconds another worker may show stale dashboard totals
+app.config['PDF_EXPORT_PROCESSES'] = int(os.environ.get('PDF_EXPORT_PROCESSES', 0)) or None # None = one per CPU
+app.config['EXPORT_RETENTION_HOURS'] = float(os.environ.get('EXPORT_RETENTION_HOURS', 24)) # how long job PDFs and ZIPs are kept in blob storage
+app.config['BLOB_CHUNK_SIZE'] = int(os.environ.get('BLOB_CHUNK_SIZE', 1024 * 1024)) # bytes per stored chunk, and at most what one read or write holds in memory
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2)) # threads per web process; 0 = only `flask run-jobs` processes run jobs
+app.config['JOB_TENANT_CONCURRENCY'] = int(os.environ.get('JOB_TENANT_CONCURRENCY', 2)) # running jobs per user across all workers
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+app.config['JOB_RETRY_DELAY'] = float(os.environ.get('JOB_RETRY_DELAY', 5)) # seconds, doubled per attempt
+app.config['JOB_LEASE_SECONDS'] = int(os.environ.get('JOB_LEASE_SECONDS', 1800)) # a running job older than this is assumed lost
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') # bearer token for /metrics; unset = endpoint disabled
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR') # shared by all gunicorn workers (set in gunicorn.conf.py); unset = this process only
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 0)) # log requests slower than this with their slowest SQL; 0 = off
+app.config['PDF_INLINE_WAIT'] = float(os.environ.get('PDF_INLINE_WAIT', 2)) # seconds a download waits for its render job before redirecting
+app.config['INVOICE_DUE_DAYS'] = int(os.environ.get('INVOICE_DUE_DAYS', 30)) # default payment term when an invoice has no due date
+app.config['STATUS_BATCH_SIZE'] = int(os.environ.get('STATUS_BATCH_SIZE', 500)) # invoices per UPDATE in bulk status changes
+app.config['OVERDUE_SWEEP_INTERVAL'] = float(os.environ.get('OVERDUE_SWEEP_INTERVAL', 3600)) # seconds between a user's automatic overdue sweeps per worker
+app.config['SNAPSHOT_PDF'] = os.environ.get('SNAPSHOT_PDF', '1') == '1' # also keep the rendered PDF of issued invoices in their snapshot
+app.config['LEDGER_FETCH_SIZE'] = int(os.environ.get('LEDGER_FETCH_SIZE', 1000)) # rows per server-side cursor fetch and per streamed chunk of a ledger export
+app.config['SMTP_HOST'] = os.environ.get('SMTP_HOST') # unset = emailing invoices is disabled
+app.config['SMTP_PORT'] = int(os.environ.get('SMTP_PORT', 587))
+app.config['SMTP_USERNAME'] = os.environ.get('SMTP_USERNAME')
+app.config['SMTP_PASSWORD'] = os.environ.get('SMTP_PASSWORD')
+app.config['SMTP_SECURITY'] = os.environ.get('SMTP_SECURITY', 'starttls') # starttls, ssl or none
+app.config['SMTP_TIMEOUT'] = float(os.environ.get('SMTP_TIMEOUT', 30))
+app.config['EMAIL_FROM'] = os.environ.get('EMAIL_FROM', 'invoices@localhost') # envelope sender; the company name is used as display name and its email as Reply-To
+app.config['EMAIL_BATCH_SIZE'] = int(os.environ.get('EMAIL_BATCH_SIZE', 100)) # emails per job, all sent over one SMTP connection
+app.config['EMAIL_RATE_LIMIT'] = float(os.environ.get('EMAIL_RATE_LIMIT', 0)) # messages per second per connection; 0 = unpaced
+app.config['EMAIL_MAX_ATTEMPTS'] = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5)) # runs of an email job before its still-failing emails are given up
+app.config['DATABASE_REPLICA_URLS'] = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()] # read replicas for read-heavy views; empty = primary only
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 10)) # after a write, the user reads from the primary this long (cover replica lag)
+# Connection pools, per engine and per worker process. Each request thread and
+# job thread holds at most one session connection; a request that also queues
+# a job briefly holds a second, hence the overflow. GUNICORN_THREADS is set by
+# gunicorn.conf.py (1 for sync workers).
+WEB_THREADS = int(os.environ.get('GUNICORN_THREADS', 1))
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 0)) or WEB_THREADS + app.config['JOB_WORKERS']
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', WEB_THREADS))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 10)) # seconds a checkout waits before failing the request
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800)) # replace connections older than this, below server/proxy idle cut-offs
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1' # test a pooled connection before use (survives failovers and restarts)
+
+def engine_options(url, name):
+    return pool_options(url, name, app.config['DB_POOL_SIZE'], app.config['DB_MAX_OVERFLOW'], app.config['DB_POOL_TIMEOUT'], app.config['DB_POOL_RECYCLE'], app.config['DB_POOL_PRE_PING'])
+
+REPLICA_KEYS = [f"replica{n}" for n in range(len(app.config['DATABASE_REPLICA_URLS']))]
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DATABASE_URL, 'primary')
+app.config['SQLALCHEMY_BINDS'] = {key: {'url': url, **engine_options(url, key)} for key, url in zip(REPLICA_KEYS, app.config['DATABASE_REPLICA_URLS'])}
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+pdf_cache = PdfCache(app.config['PDF_CACHE_DIR'], max_entries=app.config['PDF_CACHE_MAX_ENTRIES'], max_bytes=app.config['PDF_CACHE_MAX_BYTES'])
+identity_cache = TTLCache(max_entries=app.config['IDENTITY_CACHE_MAX_ENTRIES'], ttl=app.config['IDENTITY_CACHE_TTL'])
+overdue_swept = TTLCache(max_entries=app.config['IDENTITY_CACHE_MAX_ENTRIES'], ttl=app.config['OVERDUE_SWEEP_INTERVAL'])
+kpi_cache = TTLCache(max_entries=app.config['IDENTITY_CACHE_MAX_ENTRIES'], ttl=app.config['DASHBOARD_KPI_TTL'])
 
 # --- Initialize Flask-Login ---
 login_manager = LoginManager()
@@ -64,7 +150,9 @@ class User(UserMixin, db.Model):
     def __repr__(self): return f'<User {self.username}>'
 
 @login_manager.user_loader
-def load_user(user_id): return db.session.get(User, int(user_id))
+def load_user(user_id):
+    user_id = int(user_id)
+    return cached_instance(User, ('user', user_id), lambda: db.session.get(User, user_id))
 
 class CompanyProfile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -80,6 +168,8 @@ class CompanyProfile(db.Model):
     currency = db.Column(db.String(10), nullable=False, default='USD')
     date_format = db.Column(db.String(20), nullable=False, default='DD/MM/YYYY')
     terms_and_conditions = db.Column(db.Text)
+    invoice_number_format = db.Column(db.String(50)) # e.g. 'INV/{fy}/{seq:04d}'; NULL uses INVOICE_NUMBER_FORMAT
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1', onupdate=text('version + 1')) # bumped by every UPDATE; feeds the HTTP ETags
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
     invoices = db.relationship('Invoice', back_populates='profile', lazy=True, cascade="all, delete-orphan")
 
@@ -91,21 +181,29 @@ class Customer(db.Model):
     gstin = db.Column(db.String(50))
     state = db.Column(db.String(50))
     contact_person = db.Column(db.String(100))
+    email = db.Column(db.String(200)) # where invoices are emailed
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1', onupdate=text('version + 1')) # bumped by every UPDATE; feeds the HTTP ETags
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     invoices = db.relationship('Invoice', back_populates='customer', lazy=True, cascade="all, delete-orphan")
+    __table_args__ = (
+        db.Index('ix_customer_user_gstin', 'user_id', 'gstin'), # import dedupe / lookup by GSTIN
+        db.Index('ix_customer_user_name', 'user_id', 'name', 'id'), # customer list order and short prefix searches
+    )
 
 class Invoice(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     invoice_no = db.Column(db.String(50), nullable=False)
-    date = db.Column(db.String(50), nullable=False)
+    date = db.Column(db.Date, nullable=False)
     po_number = db.Column(db.String(100))
-    subtotal = db.Column(db.Float, nullable=False)
-    total_gst = db.Column(db.Float, nullable=False)
-    grand_total = db.Column(db.Float, nullable=False)
-    po_date = db.Column(db.String(50))
+    subtotal = db.Column(db.Numeric(12, 2), nullable=False)
+    total_gst = db.Column(db.Numeric(12, 2), nullable=False)
+    grand_total = db.Column(db.Numeric(12, 2), nullable=False)
+    po_date = db.Column(db.Date)
     eway_bill_no = db.Column(db.String(100))
     place_of_supply = db.Column(db.String(100))
+    customer_gstin = db.Column(db.String(50)) # GST rollup key, frozen at insert so later customer edits cannot strand rollup rows
+    gst_place_of_supply = db.Column(db.String(100)) # place_of_supply, else the customer's state at insert; the other rollup key
     transport_name = db.Column(db.String(100))
     vehicle_no = db.Column(db.String(50))
     delivery_location = db.Column(db.String(200))
@@ -113,55 +211,1109 @@ class Invoice(db.Model):
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     items = db.relationship('InvoiceItem', backref='invoice', lazy=True, cascade="all, delete-orphan")
+    tax_lines = db.relationship('InvoiceTaxLine', backref='invoice', lazy=True, cascade="all, delete-orphan", order_by='InvoiceTaxLine.tax_percent')
     profile = db.relationship('CompanyProfile', back_populates='invoices')
     customer = db.relationship('Customer', back_populates='invoices')
+    snapshot = db.relationship('InvoiceSnapshot', uselist=False, lazy=True, cascade="all, delete-orphan")
     status = db.Column(db.String(20), nullable=False, default='Draft') # Add this line
+    due_date = db.Column(db.Date) # invoice date + INVOICE_DUE_DAYS unless given; Sent invoices past it are swept to Overdue
+    amount_paid = db.Column(db.Numeric(12, 2), nullable=False, default=0, server_default='0') # sum of payments, kept by the UPDATE that records each one
+    payments = db.relationship('Payment', backref='invoice', lazy=True, cascade="all, delete-orphan", order_by='Payment.date')
+    deliveries = db.relationship('InvoiceDelivery', lazy=True, cascade="all, delete-orphan", order_by='InvoiceDelivery.id')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1', onupdate=text('version + 1')) # bump explicitly if items or tax lines ever change in place
+    __table_args__ = (
+        db.Index('ix_invoice_user_date_id', 'user_id', 'date', 'id'), # dashboard keyset pagination
+        db.Index('uq_invoice_user_invoice_no', 'user_id', 'invoice_no', unique=True), # numbers are unique per user, enforced here rather than checked before insert
+        db.Index('ix_invoice_user_status_due', 'user_id', 'status', 'due_date'), # overdue sweep
+    )
+
 class InvoiceItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
     hsn = db.Column(db.String(50))
     qty = db.Column(db.Integer, nullable=False)
-    rate = db.Column(db.Float, nullable=False)
-    tax_percent = db.Column(db.Float, nullable=False)
+    rate = db.Column(db.Numeric(12, 2), nullable=False)
+    tax_percent = db.Column(db.Numeric(5, 2), nullable=False)
     unit = db.Column(db.String(50))
     invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
 
-# Create tables if they don't exist
-with app.app_context():
+class Payment(db.Model):
+    """Money received against an invoice; partial payments add up until the invoice is Paid."""
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    amount = db.Column(db.Numeric(12, 2), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    reference = db.Column(db.String(100)) # cheque / UTR / transaction id
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class InvoiceDelivery(db.Model):
+    """One emailing of an invoice to its customer: queued -> sent, or failed once retries are used up (see _email_job)."""
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    recipient = db.Column(db.String(200), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(500)) # last failure; cleared once sent
+    message_id = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+class InvoiceTaxLine(db.Model):
+    """Per-rate tax breakdown of an invoice, written whenever its items change (see set_tax_lines)."""
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, index=True)
+    tax_percent = db.Column(db.Numeric(5, 2), nullable=False)
+    taxable_amount = db.Column(db.Numeric(12, 2), nullable=False)
+    gst_amount = db.Column(db.Numeric(12, 2), nullable=False)
+
+class GstRollup(db.Model):
+    """Monthly taxable value and GST per (tax rate, customer GSTIN, place of supply), maintained incrementally."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    month = db.Column(db.Date, nullable=False) # first day of the month
+    tax_percent = db.Column(db.Numeric(5, 2), nullable=False)
+    customer_gstin = db.Column(db.String(50), nullable=False, default='') # '' rather than NULL so the unique key matches
+    place_of_supply = db.Column(db.String(100), nullable=False, default='')
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)
+    taxable_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    gst_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('user_id', 'month', 'tax_percent', 'customer_gstin', 'place_of_supply', name='uq_gst_rollup_key'),)
+
+class InvoiceSequence(db.Model):
+    """Next free invoice number per user and numbering scope (e.g. one per financial year), see numbering.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    scope = db.Column(db.String(100), nullable=False)
+    next_value = db.Column(db.Integer, nullable=False, default=1)
+    __table_args__ = (db.UniqueConstraint('user_id', 'scope', name='uq_invoice_sequence_scope'),)
+
+class InvoiceSnapshot(db.Model):
+    """Frozen copy of an issued invoice (see snapshot_invoices). Written once; only `pdf` is filled in later."""
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    invoice_no = db.Column(db.String(50), nullable=False) # for the download filename without unpacking
+    document = db.Column(db.LargeBinary, nullable=False) # documents.pack_document()
+    document_key = db.Column(db.String(64), nullable=False) # pdf_cache.document_key() of the document
+    pdf = db.deferred(db.Column(db.LargeBinary)) # rendered by the pdf job after finalizing
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class BackgroundJob(db.Model):
+    """A unit of queued work, see jobs.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False) # 'pdf', 'export' or 'import'
+    priority = db.Column(db.Integer, nullable=False, default=100) # lower runs first
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued -> running -> done / failed
+    params = db.Column(db.Text, nullable=False, default='{}')
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    dedupe_key = db.Column(db.String(200))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    locked_by = db.Column(db.String(200))
+    locked_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_background_job_claim', 'status', 'priority', 'run_after', 'id'),
+        db.Index('ix_background_job_user_status', 'user_id', 'status'), # per-tenant running count, dedupe
+    )
+
+class BlobChunk(db.Model):
+    """One chunk of a file every process must be able to read (export ZIPs, job PDFs, import uploads), see blob_store.py."""
+    key = db.Column(db.String(200), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class ImportJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False) # 'customers' or 'invoices'
+    filename = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending -> running -> done / failed
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    rows_imported = db.Column(db.Integer, nullable=False, default=0)
+    rows_skipped = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text, nullable=False, default='[]') # JSON list of {"line", "error"}
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {'id': self.id, 'kind': self.kind, 'filename': self.filename, 'status': self.status,
+                'rows_processed': self.rows_processed, 'rows_imported': self.rows_imported,
+                'rows_skipped': self.rows_skipped, 'errors': json.loads(self.errors or '[]')}
+
+def init_db():
+    """Create missing tables, indexes and columns. Run once per deploy (`flask init-db`), not on every worker boot."""
     db.create_all()
+    # create_all() skips tables that already exist, so add any newer columns and indexes to them explicitly
+    added = {model: add_missing_columns(db.engine, model.__table__) for model in (CompanyProfile, Customer, Invoice)}
+    if 'due_date' in added[Invoice]: backfill_due_dates(db.engine, app.config['INVOICE_DUE_DAYS'])
+    if 'customer_gstin' in added[Invoice]: backfill_gst_keys(db.engine)
+    for index in [*Invoice.__table__.indexes, *Customer.__table__.indexes]:
+        if not index.unique: index.create(db.engine, checkfirst=True)
+    ensure_unique_invoice_numbers(db.engine, next(i for i in Invoice.__table__.indexes if i.unique))
+    app.config['CUSTOMER_SEARCH_BACKEND'] = ensure_customer_search_index(db.engine)
+
+# --- Identity cache ---
+# The logged-in user and their profile are cached per worker as plain column
+# values (identity_cache, TTL-bounded) and re-attached to each request's session
+# without a SELECT. Any ORM write to either row drops the local entry once its
+# transaction commits, so a concurrent request cannot re-cache the old values.
+def cached_instance(model, key, loader):
+    """`loader()`'s row from the identity cache, attached to the current session; None is cached too."""
+    def load():
+        obj = loader()
+        return None if obj is None else {attr.key: getattr(obj, attr.key) for attr in sa_inspect(model).column_attrs}
+    values = identity_cache.get_or_load(key, load)
+    if values is None: return None
+    obj = model(**values); make_transient_to_detached(obj)
+    return db.session.merge(obj, load=False)
+
+def get_profile(user_id):
+    """The user's CompanyProfile (or None), fetched at most once per request."""
+    memo = g.setdefault('profiles', {})
+    if user_id not in memo:
+        memo[user_id] = cached_instance(CompanyProfile, ('profile', user_id), lambda: CompanyProfile.query.filter_by(user_id=user_id).first())
+    return memo[user_id]
+
+def _forget_identity(mapper, connection, target):
+    session = object_session(target)
+    key = ('profile', target.user_id) if isinstance(target, CompanyProfile) else ('user', target.id)
+    if session is not None: session.info.setdefault('identity_keys', set()).add(key)
+    g.pop('profiles', None)
+
+for _model in (User, CompanyProfile):
+    for _event in ('after_insert', 'after_update', 'after_delete'): event.listen(_model, _event, _forget_identity)
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_identities(session):
+    for key in session.info.pop('identity_keys', ()): identity_cache.invalidate(key)
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_identities(session):
+    session.info.pop('identity_keys', None)
+
+invoice_numbers = InvoiceNumberAllocator(InvoiceSequence.__table__, block_size=app.config['INVOICE_NUMBER_BLOCK_SIZE'])
+
+# --- Read replicas ---
+# Read-heavy views are decorated with @reads_from_replica: their SELECTs go to
+# one of DATABASE_REPLICA_URLS (db_routing.RoutingSession) while writes stay on
+# the primary. A request that writes keeps its user on the primary for
+# REPLICA_STICKY_SECONDS (a timestamp in the Flask session), so the redirect
+# after saving an invoice never shows the replica's slightly older copy.
+def use_replica():
+    """Route this session's plain SELECTs to a replica, unless there is none or the user wrote recently."""
+    if REPLICA_KEYS and not (has_request_context() and time.time() < session.get('primary_until', 0)):
+        db.session.info['replica'] = random.choice(REPLICA_KEYS)
+
+def reads_from_replica(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        use_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.after_request
+def stick_to_primary(response):
+    if REPLICA_KEYS and db.session.info.get('wrote'): session['primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+    return response
 
 # -----------------------------
 # HELPER FUNCTIONS
 # -----------------------------
-def get_currency_symbol(currency_code): symbols = {'USD': '$', 'INR': '₹', 'EUR': '€', 'GBP': '£', 'JPY': '¥'}; return symbols.get(currency_code, '$')
+CENTS = Decimal('0.01')
+
+def to_money(value):
+    """Parse a form/JSON amount into a Decimal rounded to paise/cents. Raises InvalidOperation on junk."""
+    return Decimal(str(value)).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+def parse_date(value):
+    """ISO 'YYYY-MM-DD' string (as sent by <input type=date>) to a date; None when empty."""
+    if not value: return None
+    if isinstance(value, datetime.date): return value
+    return datetime.date.fromisoformat(value)
+
+def compute_tax_summary(items):
+    """{tax_percent: {'taxable_amount', 'gst_amount'}} for InvoiceItems (or item dicts), rounded to cents."""
+    tax_summary = {}
+    for item in items:
+        qty, rate, tax_rate = (item['qty'], item['rate'], item['tax_percent']) if isinstance(item, dict) else (item.qty, item.rate, item.tax_percent)
+        taxable_amount = qty * Decimal(rate)
+        entry = tax_summary.setdefault(Decimal(tax_rate), {'taxable_amount': Decimal(0), 'gst_amount': Decimal(0)})
+        entry['taxable_amount'] += taxable_amount
+        entry['gst_amount'] += taxable_amount * Decimal(tax_rate) / 100
+    for entry in tax_summary.values():
+        entry['taxable_amount'] = entry['taxable_amount'].quantize(CENTS, rounding=ROUND_HALF_UP)
+        entry['gst_amount'] = entry['gst_amount'].quantize(CENTS, rounding=ROUND_HALF_UP)
+    return dict(sorted(tax_summary.items()))
+
+def set_tax_lines(invoice, items):
+    """Replace the stored tax breakdown of an invoice. Call from every path that writes its items."""
+    invoice.tax_lines = [InvoiceTaxLine(tax_percent=rate, **amounts) for rate, amounts in compute_tax_summary(items).items()]
+
+def invoice_tax_summary(invoice):
+    """Stored tax breakdown, falling back to the items for invoices created before it was persisted."""
+    if invoice.tax_lines:
+        return {line.tax_percent: {'taxable_amount': line.taxable_amount, 'gst_amount': line.gst_amount} for line in invoice.tax_lines}
+    return compute_tax_summary(invoice.items)
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_customers(user_id, q, limit, offset=0):
+    """A page of a user's customers matching `q` anywhere in name, GSTIN or contact person.
 
-def format_date(date_str, format_str):
-    if not date_str:
-        return 'N/A'
+    Name-prefix matches sort first. Uses the FTS5 trigram table on SQLite and
+    pg_trgm indexes on Postgres (see migrations.ensure_customer_search_index).
+    Returns (customers, has_more).
+    """
+    query = Customer.query.filter(Customer.user_id == user_id)
+    q = (q or '').strip()
+    order = [Customer.name, Customer.id]
+    if q:
+        pattern = f"%{escape_like(q)}%"
+        if 'CUSTOMER_SEARCH_BACKEND' not in app.config: app.config['CUSTOMER_SEARCH_BACKEND'] = customer_search_backend(db.engine)
+        if app.config['CUSTOMER_SEARCH_BACKEND'] == 'fts5' and len(q) >= 3: # trigram tokens need 3+ characters
+            phrase = '"' + q.replace('"', '""') + '"'
+            query = query.filter(Customer.id.in_(text("SELECT rowid FROM customer_fts WHERE customer_fts MATCH :phrase").bindparams(phrase=phrase)))
+        else:
+            query = query.filter(or_(*(col.ilike(pattern, escape='\\') for col in (Customer.name, Customer.gstin, Customer.contact_person))))
+        order.insert(0, case((Customer.name.ilike(f"{escape_like(q)}%", escape='\\'), 0), else_=1))
+    rows = query.order_by(*order).offset(offset).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+def encode_cursor(invoice):
+    """Opaque keyset cursor for the (date, id) position of an invoice."""
+    return base64.urlsafe_b64encode(json.dumps([str(invoice.date), invoice.id]).encode()).decode()
+
+def decode_cursor(token):
+    if not token: return None
     try:
-        date_obj = dt.strptime(date_str, '%Y-%m-%d')
-        if format_str == 'DD/MM/YYYY':
-            return date_obj.strftime('%d/%m/%Y')
-        if format_str == 'MM/DD/YYYY':
-            return date_obj.strftime('%m/%d/%Y')
-        if format_str == 'YYYY-MM-DD':
-            return date_obj.strftime('%Y-%m-%d')
-        return date_str # Fallback
-    except ValueError:
-        return date_str # Return original if parsing fails
+        date_value, invoice_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return (parse_date(date_value), int(invoice_id))
+    except (ValueError, TypeError): return None
 
 import datetime # Add this near the top imports if not already there
 
+# --- HTTP caching ---
+# Invoice pages and PDFs carry a strong ETag built from the version counters of
+# the invoice, its customer and the profile, read with one small query before
+# anything is loaded or rendered, so a matching If-None-Match costs one SELECT.
+# Static files are linked with a content hash (asset_url) and served immutable.
+def invoice_versions(invoice_id, user_id):
+    """(invoice, customer, profile) version numbers of one of the user's invoices, or 404."""
+    row = (db.session.query(Invoice.version, Customer.version, CompanyProfile.version)
+           .join(Invoice.customer).join(Invoice.profile)
+           .filter(Invoice.id == invoice_id, Invoice.user_id == user_id).first())
+    if row is None: abort(404)
+    return tuple(row)
+
+def make_etag(*parts):
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()[:32]
+
+def is_not_modified(etag):
+    """True when the client already holds `etag` and no flash message is waiting to be shown."""
+    return request.if_none_match.contains(etag) and not session.get('_flashes')
+
+def with_etag(response, etag):
+    response.set_etag(etag); response.headers['Cache-Control'] = 'private, no-cache' # always revalidate, never share
+    return response
+
+def not_modified_response(etag):
+    return with_etag(Response(status=304), etag)
+
+_asset_hashes = {} # filename -> (mtime, hash)
+
+def asset_hash(filename):
+    path = os.path.join(app.static_folder, filename)
+    try: mtime = os.path.getmtime(path)
+    except OSError: return None
+    cached = _asset_hashes.get(filename)
+    if not cached or cached[0] != mtime:
+        with open(path, 'rb') as f: cached = _asset_hashes[filename] = (mtime, hashlib.sha256(f.read()).hexdigest()[:12])
+    return cached[1]
+
+def asset_url(filename):
+    """url_for('static') plus ?v=<content hash>, so the file can be cached forever."""
+    return url_for('static', filename=filename, v=asset_hash(filename))
+
+_template_version = None
+
+def template_version():
+    """Hash of every template, part of HTML ETags so a deploy that changes the markup invalidates them."""
+    global _template_version
+    if _template_version is None:
+        digest = hashlib.sha256()
+        for root, _, files in sorted(os.walk(app.template_folder if os.path.isabs(app.template_folder) else os.path.join(app.root_path, app.template_folder))):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f: digest.update(name.encode() + f.read())
+        _template_version = digest.hexdigest()[:12]
+    return _template_version
+
+@app.after_request
+def cache_static_assets(response):
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        version = request.args.get('v')
+        if version and version == asset_hash(request.view_args.get('filename', '')):
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# -----------------------------
+# INVOICE SERVICE
+# -----------------------------
+# The single write path for new invoices, used by the HTML form and the JSON API.
+INVOICE_HEADER_FIELDS = ('po_number', 'eway_bill_no', 'place_of_supply', 'transport_name', 'vehicle_no', 'delivery_location')
+
+class InvoiceValidationError(ValueError):
+    """Raised with a list of human-readable problems; nothing has been written."""
+    def __init__(self, errors):
+        super().__init__('; '.join(errors)); self.errors = errors
+
+def items_from_form(form):
+    """Line items of the invoice form as dicts; rows without a name are ignored."""
+    columns = [form.getlist(k) for k in ('item_name', 'hsn', 'qty', 'unit', 'rate', 'tax_percent')]
+    rows = []
+    for i, name in enumerate(columns[0]):
+        if not name: continue
+        values = [col[i] if i < len(col) else None for col in columns]
+        rows.append(dict(zip(('name', 'hsn', 'qty', 'unit', 'rate', 'tax_percent'), values)))
+    return rows
+
+def _validate_invoice(payload, label):
+    """Return (header, items, tax_summary, errors) with dates, quantities and money parsed; a blank invoice_no is numbered later."""
+    errors = []; items = []
+    invoice_no = str(payload.get('invoice_no') or '').strip()
+    if len(invoice_no) > 50: errors.append(f"{label}: invoice_no is longer than 50 characters.")
+    try:
+        invoice_date = parse_date(payload.get('date')); po_date = parse_date(payload.get('po_date')); due_date = parse_date(payload.get('due_date'))
+        if not invoice_date: errors.append(f"{label}: date is required.")
+        elif not due_date: due_date = invoice_date + datetime.timedelta(days=app.config['INVOICE_DUE_DAYS'])
+        elif due_date < invoice_date: errors.append(f"{label}: due_date is before the invoice date.")
+    except (ValueError, TypeError): errors.append(f"{label}: dates must be YYYY-MM-DD."); invoice_date = po_date = due_date = None
+    try: customer_id = int(payload.get('customer_id') or payload.get('customer'))
+    except (ValueError, TypeError): errors.append(f"{label}: a valid customer is required."); customer_id = None
+    raw_items = payload.get('items') or []
+    if not raw_items: errors.append(f"{label}: at least one item is required.")
+    subtotal = Decimal(0)
+    for n, raw in enumerate(raw_items, start=1):
+        try:
+            if not raw.get('name'): raise ValueError("name is required")
+            qty = int(raw['qty']); rate = to_money(raw['rate']); tax_percent = Decimal(str(raw.get('tax_percent') or 0))
+            if qty < 1 or rate < 0 or not (0 <= tax_percent <= 100): raise ValueError("qty, rate or tax % out of range")
+        except (KeyError, ValueError, TypeError, InvalidOperation) as e:
+            errors.append(f"{label}, item {n}: {e}"); continue
+        items.append({'name': raw['name'], 'hsn': raw.get('hsn') or '', 'qty': qty, 'unit': raw.get('unit') or '', 'rate': rate, 'tax_percent': tax_percent})
+        subtotal += qty * rate
+    tax_summary = compute_tax_summary(items)
+    total_gst = sum((line['gst_amount'] for line in tax_summary.values()), Decimal('0.00'))
+    header = {f: payload.get(f) or None for f in INVOICE_HEADER_FIELDS}
+    header.update(invoice_no=invoice_no, date=invoice_date, po_date=po_date, due_date=due_date, customer_id=customer_id,
+                  subtotal=subtotal, total_gst=total_gst, grand_total=subtotal + total_gst)
+    return header, items, tax_summary, errors
+
+def _assign_numbers(user_id, profile, validated, skip=()):
+    """Give every invoice without a number the next one from the profile's sequence, passing over numbers in `skip`."""
+    fmt = profile.invoice_number_format or app.config['INVOICE_NUMBER_FORMAT']
+    for header, _, _, _ in validated:
+        if header['invoice_no']: continue
+        number = invoice_numbers.allocate(db.engine, user_id, fmt, header['date'])
+        while number in skip: number = invoice_numbers.allocate(db.engine, user_id, fmt, header['date'])
+        header['invoice_no'] = number
+
+def _insert_invoices(user_id, profile_id, validated):
+    """Multi-row INSERTs for already-validated invoices; the caller commits. Returns the new ids."""
+    customer_ids = {h['customer_id'] for h, _, _, _ in validated}
+    customers = {cid: (gstin, state) for cid, gstin, state in db.session.query(Customer.id, Customer.gstin, Customer.state).filter(Customer.id.in_(customer_ids))}
+    headers = [dict(h, user_id=user_id, profile_id=profile_id, status='Draft', customer_gstin=customers[h['customer_id']][0] or '',
+                    gst_place_of_supply=h['place_of_supply'] or customers[h['customer_id']][1] or '') for h, _, _, _ in validated]
+    ids = db.session.execute(insert(Invoice).returning(Invoice.id, sort_by_parameter_order=True), headers).scalars().all()
+    item_rows = [dict(item, invoice_id=invoice_id) for invoice_id, (_, items, _, _) in zip(ids, validated) for item in items]
+    tax_rows = [dict(amounts, tax_percent=rate, invoice_id=invoice_id) for invoice_id, (_, _, summary, _) in zip(ids, validated) for rate, amounts in summary.items()]
+    if item_rows: db.session.execute(insert(InvoiceItem), item_rows)
+    if tax_rows: db.session.execute(insert(InvoiceTaxLine), tax_rows)
+    apply_gst_rollup(user_id, [(h['date'], h['customer_gstin'], h['gst_place_of_supply'], summary) for h, (_, _, summary, _) in zip(headers, validated)])
+    forget_dashboard_kpis(user_id)
+    return ids
+
+def _insert_numbered(user_id, profile, validated, skip=()):
+    """Number and insert `validated`, retrying on number clashes; the caller commits.
+
+    Clashes with existing numbers are caught by the unique index instead of a lookup
+    first: an allocated number that is taken (the sequence running into numbers typed
+    by hand) is skipped over and the insert retried, and invoices whose chosen number
+    is taken are left out. A clash rolls the session back, so call this with nothing
+    else pending. Returns (ids, inserted entries of `validated`, clashing chosen numbers).
+    """
+    chosen = {h['invoice_no'] for h, _, _, _ in validated if h['invoice_no']}
+    auto = [h for h, _, _, _ in validated if not h['invoice_no']]
+    _assign_numbers(user_id, profile, validated, skip)
+    clashes = set()
+    while True:
+        rows = [v for v in validated if v[0]['invoice_no'] not in clashes]
+        try:
+            return (_insert_invoices(user_id, profile.id, rows) if rows else []), rows, sorted(clashes)
+        except IntegrityError:
+            db.session.rollback()
+            taken = {n for (n,) in db.session.query(Invoice.invoice_no).filter(Invoice.user_id == user_id, Invoice.invoice_no.in_([h['invoice_no'] for h, _, _, _ in rows]))}
+            if not taken: raise
+            clashes |= taken & chosen
+            for header in auto:
+                if header['invoice_no'] in taken: header['invoice_no'] = ''
+            _assign_numbers(user_id, profile, validated, skip=set(skip) | taken)
+
+def create_invoices(user_id, profile, payloads):
+    """Validate and insert invoices (header dict with an 'items' list each) in one transaction.
+
+    Headers, items and tax lines are written with one multi-row INSERT per table.
+    Invoices without an invoice_no are numbered from the profile's sequence; a chosen
+    number that already exists fails the whole call (see _insert_numbered).
+    Returns [{'id', 'invoice_no', 'subtotal', 'total_gst', 'grand_total'}] in input order,
+    or raises InvoiceValidationError without writing anything.
+    """
+    validated = [_validate_invoice(p, f"Invoice {p.get('invoice_no') or i + 1}") for i, p in enumerate(payloads)]
+    errors = [e for _, _, _, errs in validated for e in errs]
+    chosen = [h['invoice_no'] for h, _, _, _ in validated if h['invoice_no']]
+    errors += [f"Invoice number '{n}' is used more than once." for n, count in sorted(Counter(chosen).items()) if count > 1]
+    customer_ids = {h['customer_id'] for h, _, _, _ in validated if h['customer_id']}
+    owned = {cid for (cid,) in db.session.query(Customer.id).filter(Customer.user_id == user_id, Customer.id.in_(customer_ids))}
+    errors += [f"Invalid customer selected ({cid})." for cid in sorted(customer_ids - owned)]
+    if errors: raise InvoiceValidationError(errors)
+
+    try:
+        ids, _, clashes = _insert_numbered(user_id, profile, validated)
+        if clashes: raise InvoiceValidationError([f"Invoice number '{n}' already exists." for n in clashes])
+        db.session.commit()
+    except Exception:
+        db.session.rollback(); raise
+    return [{'id': invoice_id, 'invoice_no': h['invoice_no'], 'subtotal': h['subtotal'], 'total_gst': h['total_gst'], 'grand_total': h['grand_total']} for invoice_id, (h, _, _, _) in zip(ids, validated)]
+
+# --- Finalizing ---
+# Moving a Draft to an issued status freezes everything the preview and the PDF
+# show into one invoice_snapshot row. From then on both are served from that row
+# alone, and edits to the customer or profile no longer reach the invoice.
+ISSUED_STATUSES = ('Sent', 'Paid', 'Overdue', 'Cancelled')
+
+def snapshot_invoices(user_id, ids):
+    """Write snapshots for the given invoices (one multi-row INSERT); the caller commits."""
+    invoices = (Invoice.query.filter(Invoice.user_id == user_id, Invoice.id.in_(ids), ~Invoice.snapshot.has())
+                .options(selectinload(Invoice.profile), selectinload(Invoice.customer), selectinload(Invoice.items), selectinload(Invoice.tax_lines)).all())
+    rows = []; now = datetime.datetime.utcnow()
+    for invoice in invoices:
+        document = invoice_document(invoice, invoice.profile, tax_summary=invoice_tax_summary(invoice))
+        rows.append(dict(invoice_id=invoice.id, user_id=user_id, invoice_no=invoice.invoice_no, document=pack_document(document), document_key=document_key(document), created_at=now))
+    if rows: db.session.execute(insert(InvoiceSnapshot), rows)
+    return rows
+
+def snapshot_row(invoice_id, user_id, *columns):
+    """(id, *columns) of an invoice's snapshot in one SELECT, or None while it is a Draft."""
+    return db.session.execute(select(InvoiceSnapshot.id, *columns).where(InvoiceSnapshot.invoice_id == invoice_id, InvoiceSnapshot.user_id == user_id)).first()
+
+def snapshot_context(invoice_id, document):
+    """invoice_preview.html variables built from a snapshot document instead of the models."""
+    invoice = SimpleNamespace(id=invoice_id, items=[SimpleNamespace(**item) for item in document['items']], **{f: document[f] for f in INVOICE_FIELDS})
+    return dict(invoice=invoice, profile=SimpleNamespace(**document['profile']), customer=SimpleNamespace(**document['customer']),
+                tax_summary={line['tax_percent']: line for line in document['tax_summary']}, issued=True)
+
+# -----------------------------
+# STATUS WORKFLOW & PAYMENTS
+# -----------------------------
+# Status changes are set-based. Each batch of ids is one UPDATE whose WHERE
+# clause only matches invoices the workflow lets move, and it returns the ids
+# that did move, so nothing is loaded row by row and concurrent requests cannot
+# move an invoice twice. Marking invoices Paid then records each one's remaining
+# balance as a payment with a single INSERT ... SELECT; issuing Drafts writes
+# their snapshots. Every UPDATE bumps Invoice.version, so ETags follow.
+INVOICE_TRANSITIONS = {
+    'Draft': ('Sent',),
+    'Sent': ('Paid', 'Overdue', 'Cancelled'),
+    'Overdue': ('Paid', 'Cancelled'),
+    'Paid': (),
+    'Cancelled': (),
+}
+PAYABLE_STATUSES = ('Sent', 'Overdue')
+
+def transition_invoices(user_id, ids, status, on_date=None, reference=None):
+    """Move the user's invoices in `ids` to `status` where INVOICE_TRANSITIONS allows; returns the ids moved. The caller commits."""
+    sources = [source for source, targets in INVOICE_TRANSITIONS.items() if status in targets]
+    if not sources: raise InvoiceValidationError([f"Invoices cannot be moved to {status}."])
+    moved = []
+    for batch in batched(sorted(set(ids)), app.config['STATUS_BATCH_SIZE']):
+        batch_moved = db.session.execute(
+            update(Invoice).where(Invoice.user_id == user_id, Invoice.id.in_(batch), Invoice.status.in_(sources))
+            .values(status=status).returning(Invoice.id).execution_options(synchronize_session=False)).scalars().all()
+        if not batch_moved: continue
+        if status == 'Sent': snapshot_invoices(user_id, batch_moved)
+        if status == 'Paid':
+            balance = Invoice.grand_total - Invoice.amount_paid; settled = (Invoice.id.in_(batch_moved), balance > 0)
+            db.session.execute(insert(Payment).from_select(
+                ['invoice_id', 'user_id', 'amount', 'date', 'reference', 'created_at'],
+                select(Invoice.id, Invoice.user_id, balance, literal(on_date or datetime.date.today(), Date), literal(reference, db.String), literal(datetime.datetime.utcnow(), db.DateTime)).where(*settled)))
+            db.session.execute(update(Invoice).where(*settled).values(amount_paid=Invoice.grand_total).execution_options(synchronize_session=False))
+        moved += batch_moved
+    if moved: forget_dashboard_kpis(user_id)
+    return moved
+
+def record_payment(user_id, invoice_id, amount, on_date, reference=None):
+    """Add a (possibly partial) payment and mark the invoice Paid once it is covered; the caller commits."""
+    paid = Invoice.amount_paid + amount
+    status = db.session.execute(
+        update(Invoice).where(Invoice.id == invoice_id, Invoice.user_id == user_id, Invoice.status.in_(PAYABLE_STATUSES), paid <= Invoice.grand_total)
+        .values(amount_paid=paid, status=case((paid >= Invoice.grand_total, 'Paid'), else_=Invoice.status))
+        .returning(Invoice.status).execution_options(synchronize_session=False)).scalar()
+    if status is None: raise InvoiceValidationError(["Payments can only be recorded against Sent or Overdue invoices, up to the balance due."])
+    db.session.add(Payment(invoice_id=invoice_id, user_id=user_id, amount=amount, date=on_date, reference=reference))
+    forget_dashboard_kpis(user_id)
+    return status
+
+def sweep_overdue(user_id=None, today=None):
+    """Mark Sent invoices past their due date Overdue in one UPDATE on ix_invoice_user_status_due; returns the count. The caller commits."""
+    conditions = [Invoice.status == 'Sent', Invoice.due_date < (today or datetime.date.today())]
+    if user_id is not None: conditions.append(Invoice.user_id == user_id)
+    count = db.session.execute(update(Invoice).where(*conditions).values(status='Overdue').execution_options(synchronize_session=False)).rowcount
+    if count and user_id is not None: forget_dashboard_kpis(user_id)
+    return count
+
+def sweep_overdue_for(user_id):
+    """The automatic sweep: at most once per OVERDUE_SWEEP_INTERVAL per user and worker (`flask sweep-overdue` covers idle tenants)."""
+    if overdue_swept.get(user_id): return
+    if sweep_overdue(user_id): db.session.commit()
+    overdue_swept.put(user_id, True)
+
+# -----------------------------
+# GST REPORTING
+# -----------------------------
+# gst_rollup is updated in the same transaction as every invoice insert
+# (_insert_invoices) and delete (delete_invoice), so reports read a few hundred
+# pre-aggregated rows instead of every line item. Customer GSTIN and place of
+# supply are stored on the invoice when it is written (customer_gstin,
+# gst_place_of_supply), and the same stored values are subtracted on delete and
+# read by `flask rebuild-gst-rollups`, so editing a customer never moves an
+# existing invoice between rollup rows.
+def upsert(model):
+    """Dialect INSERT that supports on_conflict_do_update (Postgres and SQLite)."""
+    return (pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert)(model)
+
+def apply_gst_rollup(user_id, contributions, sign=1):
+    """Add (sign=1) or remove (sign=-1) invoices from the rollup.
+
+    `contributions` holds (invoice_date, customer_gstin, gst_place_of_supply, tax_summary) per invoice.
+    """
+    totals = {}
+    for invoice_date, gstin, place, tax_summary in contributions:
+        month = invoice_date.replace(day=1); place = place or ''
+        for rate, amounts in tax_summary.items():
+            entry = totals.setdefault((month, Decimal(rate), gstin or '', place), [0, Decimal(0), Decimal(0)])
+            entry[0] += sign; entry[1] += sign * amounts['taxable_amount']; entry[2] += sign * amounts['gst_amount']
+    if not totals: return
+    stmt = upsert(GstRollup).values([
+        {'user_id': user_id, 'month': month, 'tax_percent': rate, 'customer_gstin': gstin, 'place_of_supply': place,
+         'invoice_count': count, 'taxable_amount': taxable, 'gst_amount': gst}
+        for (month, rate, gstin, place), (count, taxable, gst) in totals.items()])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'month', 'tax_percent', 'customer_gstin', 'place_of_supply'],
+        set_={col: getattr(GstRollup, col) + getattr(stmt.excluded, col) for col in ('invoice_count', 'taxable_amount', 'gst_amount')})
+    db.session.execute(stmt)
+    if sign < 0:
+        GstRollup.query.filter(GstRollup.user_id == user_id, GstRollup.invoice_count <= 0).delete(synchronize_session=False)
+
+def rebuild_gst_rollups(user_id=None):
+    """Recompute the rollup from invoice_tax_line with one INSERT ... SELECT. Caller commits."""
+    scope = GstRollup.query if user_id is None else GstRollup.query.filter_by(user_id=user_id)
+    scope.delete(synchronize_session=False)
+    if db.engine.dialect.name == 'postgresql': month = func.date_trunc('month', Invoice.date).cast(Date)
+    else: month = func.strftime('%Y-%m-01', Invoice.date)
+    gstin = func.coalesce(Invoice.customer_gstin, ''); place = func.coalesce(Invoice.gst_place_of_supply, '')
+    query = (select(Invoice.user_id, month, InvoiceTaxLine.tax_percent, gstin, place, func.count(func.distinct(Invoice.id)),
+                    func.sum(InvoiceTaxLine.taxable_amount), func.sum(InvoiceTaxLine.gst_amount))
+             .join(InvoiceTaxLine, InvoiceTaxLine.invoice_id == Invoice.id)
+             .group_by(Invoice.user_id, month, InvoiceTaxLine.tax_percent, gstin, place))
+    if user_id is not None: query = query.where(Invoice.user_id == user_id)
+    db.session.execute(insert(GstRollup).from_select(
+        ['user_id', 'month', 'tax_percent', 'customer_gstin', 'place_of_supply', 'invoice_count', 'taxable_amount', 'gst_amount'], query))
+
+GST_REPORT_GROUPS = {'rate': GstRollup.tax_percent, 'customer': GstRollup.customer_gstin, 'place': GstRollup.place_of_supply}
+
+def gst_report(user_id, group, start=None, end=None):
+    """Rows of (month, group value, invoice_count, taxable_amount, gst_amount) read from the rollup."""
+    column = GST_REPORT_GROUPS[group]
+    query = (db.session.query(GstRollup.month, column, func.sum(GstRollup.invoice_count), func.sum(GstRollup.taxable_amount), func.sum(GstRollup.gst_amount))
+             .filter(GstRollup.user_id == user_id).group_by(GstRollup.month, column).order_by(GstRollup.month, column))
+    if start: query = query.filter(GstRollup.month >= start)
+    if end: query = query.filter(GstRollup.month <= end)
+    return query.all()
+
+# -----------------------------
+# DASHBOARD KPIS
+# -----------------------------
+# The dashboard panel is built from three GROUP BY queries over invoice (by
+# status, by month over the last KPI_MONTHS months, by customer) and cached per
+# user in kpi_cache, so its cost does not grow with the number of invoices shown.
+# Writes that add, delete or change invoices mark the user on the session
+# (forget_dashboard_kpis, or the Invoice mapper events for ORM writes) and the
+# entry is dropped once that transaction commits. Other workers catch up within
+# DASHBOARD_KPI_TTL.
+KPI_MONTHS = 12
+OUTSTANDING_STATUSES = PAYABLE_STATUSES
+TOP_CUSTOMERS = 5
+
+def month_start(day, back=0):
+    """First day of the month `back` months before `day`'s month."""
+    months = day.year * 12 + day.month - 1 - back
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+def compute_dashboard_kpis(user_id, today):
+    since = month_start(today, KPI_MONTHS - 1)
+    by_status = {status: {'count': count, 'amount': to_money(amount or 0), 'paid': to_money(paid or 0)} for status, count, amount, paid in db.session.execute(
+        select(Invoice.status, func.count(), func.sum(Invoice.grand_total), func.sum(Invoice.amount_paid)).where(Invoice.user_id == user_id)
+        .group_by(Invoice.status).order_by(Invoice.status))}
+    year = extract('year', Invoice.date); month = extract('month', Invoice.date)
+    billed = {(int(y), int(m)): (count, to_money(amount or 0)) for y, m, count, amount in db.session.execute(
+        select(year, month, func.count(), func.sum(Invoice.grand_total)).where(Invoice.user_id == user_id, Invoice.date >= since)
+        .group_by(year, month))}
+    months = []
+    for back in range(KPI_MONTHS - 1, -1, -1):
+        start = month_start(today, back); count, amount = billed.get((start.year, start.month), (0, Decimal('0.00')))
+        months.append({'month': start, 'count': count, 'amount': amount})
+    top = [{'name': name, 'count': count, 'amount': to_money(amount or 0)} for _, name, count, amount in db.session.execute(
+        select(Customer.id, Customer.name, func.count(Invoice.id), func.sum(Invoice.grand_total))
+        .join(Customer, Customer.id == Invoice.customer_id).where(Invoice.user_id == user_id, Invoice.date >= since)
+        .group_by(Customer.id, Customer.name).order_by(func.sum(Invoice.grand_total).desc()).limit(TOP_CUSTOMERS))]
+    return {
+        'by_status': by_status,
+        'invoice_count': sum(s['count'] for s in by_status.values()),
+        'outstanding': sum((s['amount'] - s['paid'] for status, s in by_status.items() if status in OUTSTANDING_STATUSES), Decimal('0.00')),
+        'this_month': months[-1]['amount'], 'last_month': months[-2]['amount'],
+        'months': months, 'month_max': max(m['amount'] for m in months),
+        'top_customers': top,
+    }
+
+def dashboard_kpis(user_id):
+    return kpi_cache.get_or_load(user_id, lambda: compute_dashboard_kpis(user_id, datetime.date.today()))
+
+def forget_dashboard_kpis(user_id, session=None):
+    """Drop the user's cached KPIs when the current transaction commits."""
+    (session or db.session).info.setdefault('kpi_users', set()).add(user_id)
+
+@event.listens_for(Invoice, 'after_insert')
+@event.listens_for(Invoice, 'after_update')
+@event.listens_for(Invoice, 'after_delete')
+def _invoice_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None: forget_dashboard_kpis(target.user_id, session)
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_kpis(session):
+    for user_id in session.info.pop('kpi_users', ()): kpi_cache.invalidate(user_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_kpis(session):
+    session.info.pop('kpi_users', None)
+
+# -----------------------------
+# BULK IMPORT
+# -----------------------------
+# Uploads are kept in blob storage until a worker (on any host) copies them to a
+# local file, parsed as a stream (importer.py) and written in batches of
+# IMPORT_BATCH_SIZE, one transaction per batch, on a background thread. Existing
+# customers (by GSTIN) and invoices (by number) are skipped using the
+# (user_id, gstin) and (user_id, invoice_no) indexes. Progress lands on ImportJob.
+def _record_errors(job, errors):
+    if not errors: return
+    stored = json.loads(job.errors or '[]')
+    room = app.config['IMPORT_MAX_ERRORS'] - len(stored)
+    if room > 0: job.errors = json.dumps(stored + [{'line': line, 'error': msg} for line, msg in errors[:room]])
+
+def _import_customer_batch(job, batch):
+    errors = []; rows = []; skipped = 0
+    gstins = {r.get('gstin') for _, r, err in batch if not err and r.get('gstin')}
+    existing = {g for (g,) in db.session.query(Customer.gstin).filter(Customer.user_id == job.user_id, Customer.gstin.in_(gstins))} if gstins else set()
+    for line, record, error in batch:
+        if error: errors.append((line, error)); continue
+        if not record.get('name') or not record.get('billing_address'): errors.append((line, "name and billing_address are required")); continue
+        gstin = record.get('gstin') or None
+        if gstin and gstin in existing: skipped += 1; continue
+        if gstin: existing.add(gstin)
+        rows.append({c: record.get(c) or None for c in CUSTOMER_COLUMNS} | {'name': record['name'], 'billing_address': record['billing_address'], 'user_id': job.user_id})
+    if rows: db.session.execute(insert(Customer), rows)
+    return len(rows), skipped, errors
+
+def _import_invoice_batch(job, profile, batch):
+    errors = []; skipped = 0
+    gstins = {p.get('customer_gstin') for _, p, err in batch if not err and p.get('customer_gstin') and not p.get('customer_id')}
+    by_gstin = dict(db.session.query(Customer.gstin, Customer.id).filter(Customer.user_id == job.user_id, Customer.gstin.in_(gstins))) if gstins else {}
+    numbers = {str(p.get('invoice_no') or '').strip() for _, p, err in batch if not err} - {''}
+    existing = {n for (n,) in db.session.query(Invoice.invoice_no).filter(Invoice.user_id == job.user_id, Invoice.invoice_no.in_(numbers))} if numbers else set()
+    candidates = []
+    for line, payload, error in batch:
+        if error: errors.append((line, error)); continue
+        if payload.get('customer_gstin') and not payload.get('customer_id'):
+            payload['customer_id'] = by_gstin.get(payload['customer_gstin'])
+            if not payload['customer_id']: errors.append((line, f"no customer with GSTIN {payload['customer_gstin']}")); continue
+        header, items, summary, problems = _validate_invoice(payload, f"Invoice {payload.get('invoice_no') or '?'}")
+        if problems: errors.extend((line, p) for p in problems); continue
+        if header['invoice_no'] in existing: skipped += 1; continue
+        if header['invoice_no']: existing.add(header['invoice_no'])
+        candidates.append((line, (header, items, summary, problems)))
+    customer_ids = {v[0]['customer_id'] for _, v in candidates}
+    owned = {cid for (cid,) in db.session.query(Customer.id).filter(Customer.user_id == job.user_id, Customer.id.in_(customer_ids))} if customer_ids else set()
+    validated = []; lines = []
+    for line, v in candidates:
+        if v[0]['customer_id'] in owned: validated.append(v); lines.append(line)
+        else: errors.append((line, f"Invalid customer selected ({v[0]['customer_id']})."))
+    if not validated: return 0, skipped, errors
+    _, inserted, _ = _insert_numbered(job.user_id, profile, validated, skip=existing)
+    kept = {id(v) for v in inserted} # the rest clashed with numbers written since the lookup above
+    errors += [(line, f"Invoice number '{v[0]['invoice_no']}' already exists.") for line, v in zip(lines, validated) if id(v) not in kept]
+    return len(inserted), skipped, errors
+
+def run_import(job_id, path, fmt, batch_size):
+    """Process an uploaded file for an ImportJob. Call inside an app context."""
+    job = db.session.get(ImportJob, job_id)
+    job.status = 'running'; db.session.commit()
+    try:
+        records = iter_records(path, fmt)
+        if job.kind == 'invoices':
+            profile = CompanyProfile.query.filter_by(user_id=job.user_id).first()
+            records = iter_invoice_payloads(records)
+        for batch in batched(records, batch_size):
+            if job.kind == 'invoices': imported, skipped, errors = _import_invoice_batch(job, profile, batch)
+            else: imported, skipped, errors = _import_customer_batch(job, batch)
+            job.rows_processed += len(batch); job.rows_imported += imported; job.rows_skipped += skipped
+            _record_errors(job, errors)
+            db.session.commit()
+        job.status = 'done'
+    except Exception as e:
+        db.session.rollback(); print(f"ERROR in import {job_id}: {e}")
+        job = db.session.get(ImportJob, job_id); job.status = 'failed'; _record_errors(job, [(None, str(e))])
+    finally:
+        job.finished_at = datetime.datetime.utcnow(); db.session.commit()
+        try: os.remove(path)
+        except OSError: pass
+
+# -----------------------------
+# METRICS
+# -----------------------------
+# Per-endpoint request latency, SQL statement count and time (engine events),
+# template render time, PDF build time/size and job outcomes, served in the
+# Prometheus text format on /metrics. See metrics.py for how gunicorn workers
+# are added together.
+metrics = Registry(app.config['METRICS_DIR'])
+metrics.histogram('http_request_duration_seconds', "Request latency by endpoint, method and status.")
+metrics.counter('db_queries_total', "SQL statements executed, by endpoint (or job:<kind>).")
+metrics.counter('db_query_seconds_total', "Time spent in SQL statements, by endpoint (or job:<kind>).")
+metrics.histogram('template_render_seconds', "Jinja template render time.")
+metrics.histogram('pdf_build_seconds', "ReportLab build time of one invoice PDF.")
+metrics.histogram('pdf_size_bytes', "Size of generated invoice PDFs.", buckets=(16e3, 32e3, 64e3, 128e3, 256e3, 512e3, 1e6, 4e6))
+metrics.histogram('job_duration_seconds', "Background job run time by kind.", buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900))
+metrics.counter('jobs_total', "Background jobs run, by kind and outcome.")
+metrics.counter('cache_lookups_total', "In-process cache lookups by cache and result.")
+metrics.counter('emails_total', "Invoice email attempts by outcome (sent, deferred for retry, failed).")
+metrics.histogram('email_send_seconds', "SMTP time to hand over one invoice email.")
+metrics.histogram('db_pool_wait_seconds', "Time a connection checkout waited (for a free or newly opened connection), by pool.",
+                  buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+metrics.counter('db_pool_timeouts_total', "Checkouts that gave up after DB_POOL_TIMEOUT, by pool.")
+metrics.counter('db_statements_total', "SQL statements by target database (primary, replica0, ...).")
+def _pool_wait(pool, seconds, timed_out):
+    metrics.observe('db_pool_wait_seconds', seconds, pool=pool)
+    if timed_out: metrics.inc('db_pool_timeouts_total', pool=pool)
+TimedQueuePool.observer = _pool_wait
+metrics.collectors.append(lambda registry: [
+    registry.set_total('cache_lookups_total', value, cache=cache, result=result)
+    for cache, result, value in (('identity', 'hit', identity_cache.hits), ('identity', 'miss', identity_cache.misses),
+                                 ('kpi', 'hit', kpi_cache.hits), ('kpi', 'miss', kpi_cache.misses),
+                                 ('pdf', 'memory_hit', pdf_cache.hits['memory']), ('pdf', 'disk_hit', pdf_cache.hits['disk']), ('pdf', 'miss', pdf_cache.misses))])
+
+def _sql_stats():
+    return g.get('sql_stats') if has_app_context() else None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if REPLICA_KEYS: metrics.inc('db_statements_total', database=conn.engine.pool.logging_name or 'primary')
+    stats = _sql_stats()
+    if stats is None: return
+    stats['count'] += 1; stats['seconds'] += elapsed
+    if app.config['SLOW_REQUEST_MS']: stats['statements'].append((elapsed, statement))
+
+@event.listens_for(Engine, 'handle_error')
+def _sql_failed(context):
+    if context.connection is not None and context.connection.info.get('query_started'): context.connection.info['query_started'].pop()
+
+def _record_sql(label):
+    stats = g.pop('sql_stats', None)
+    if stats and stats['count']:
+        metrics.inc('db_queries_total', stats['count'], endpoint=label); metrics.inc('db_query_seconds_total', stats['seconds'], endpoint=label)
+    return stats
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter(); g.sql_stats = {'count': 0, 'seconds': 0.0, 'statements': []}
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g: return response
+    elapsed = time.perf_counter() - g.pop('request_started'); endpoint = request.endpoint or 'unmatched'
+    metrics.observe('http_request_duration_seconds', elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    stats = _record_sql(endpoint)
+    if app.config['SLOW_REQUEST_MS'] and elapsed * 1000 >= app.config['SLOW_REQUEST_MS'] and stats:
+        slowest = sorted(stats['statements'], key=lambda s: s[0], reverse=True)[:3]
+        print(f"SLOW REQUEST {request.method} {request.path} ({endpoint}) {elapsed * 1000:.0f} ms, {stats['count']} queries / {stats['seconds'] * 1000:.0f} ms SQL"
+              + ''.join(f"\n    {seconds * 1000:.1f} ms  {' '.join(statement.split())[:300]}" for seconds, statement in slowest))
+    return response
+
+@before_render_template.connect_via(app)
+def _template_started(sender, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _template_finished(sender, template, context, **extra):
+    if g.get('template_started'): metrics.observe('template_render_seconds', time.perf_counter() - g.template_started.pop(), template=template.name or 'string')
+
+def instrumented_job(kind, handler):
+    """Wrap a job handler to record its duration, outcome and SQL."""
+    def run(job):
+        g.sql_stats = {'count': 0, 'seconds': 0.0, 'statements': []}; started = time.perf_counter(); outcome = 'failed'
+        try:
+            result = handler(job); outcome = 'done'
+            return result
+        finally:
+            metrics.observe('job_duration_seconds', time.perf_counter() - started, kind=kind); metrics.inc('jobs_total', kind=kind, outcome=outcome)
+            _record_sql(f"job:{kind}")
+    return run
+
+# -----------------------------
+# BACKGROUND JOBS
+# -----------------------------
+# PDF renders, bulk exports, imports and invoice emails run on the job queue
+# (jobs.py) instead of inside the request. Each web process starts JOB_WORKERS threads on first
+# use; `flask run-jobs` runs a dedicated worker process.
+JOB_PRIORITIES = {'pdf': 0, 'import': 50, 'email': 75, 'export': 100} # interactive downloads first
+
+job_queue = JobQueue(BackgroundJob.__table__, tenant_limit=app.config['JOB_TENANT_CONCURRENCY'],
+                     lease_seconds=app.config['JOB_LEASE_SECONDS'], retry_delay=app.config['JOB_RETRY_DELAY'])
+blobs = BlobStore(BlobChunk.__table__, chunk_size=app.config['BLOB_CHUNK_SIZE']) # job inputs and results, readable from any host
+
+def enqueue_job(user_id, kind, params, max_attempts=None, dedupe_key=None):
+    job_id = job_queue.enqueue(db.engine, user_id, kind, params, priority=JOB_PRIORITIES[kind],
+                               max_attempts=max_attempts or app.config['JOB_MAX_ATTEMPTS'], dedupe_key=dedupe_key)
+    job_worker.start()
+    return job_id
+
+def _pdf_job(job):
+    """Render one invoice into the PDF cache and blob storage, where the download route picks it up; issued invoices also keep it in their snapshot."""
+    invoice_id = job['params']['invoice_id']
+    snapshot = snapshot_row(invoice_id, job['user_id'], InvoiceSnapshot.document, InvoiceSnapshot.document_key)
+    if snapshot:
+        document = unpack_document(snapshot.document); key = snapshot.document_key
+    else:
+        invoice = Invoice.query.filter_by(id=invoice_id, user_id=job['user_id']).first()
+        profile = CompanyProfile.query.filter_by(user_id=job['user_id']).first()
+        if not invoice or not profile: raise LookupError("Invoice or profile no longer exists.")
+        document = invoice_document(invoice, profile, tax_summary=invoice_tax_summary(invoice)); key = document_key(document)
+    from pdf_renderer import render_invoice_pdf_timed
+    pdf_bytes, timings = get_render_pool(app.config['PDF_EXPORT_PROCESSES']).submit(render_invoice_pdf_timed, document).result()
+    keep_rendered_pdf(job['user_id'], invoice_id, key, pdf_bytes, timings, snapshot.id if snapshot else None)
+    blobs.write(db.session.connection(), job_output_key(job['id']), [pdf_bytes]); db.session.commit() # the requester may be on another host than this cache
+    expire_job_outputs()
+    return {'invoice_id': invoice_id, 'key': key, 'timings': timings}
+
+def job_output_key(job_id): return f"job-output:{job_id}"
+
+def import_upload_key(import_job_id): return f"import-upload:{import_job_id}"
+
+def expire_job_outputs():
+    before = datetime.datetime.utcnow() - datetime.timedelta(hours=app.config['EXPORT_RETENTION_HOURS'])
+    blobs.expire(db.engine, before, prefix='job-output:')
+    blobs.expire(db.engine, before, prefix='import-upload:') # uploads whose import job died before it could remove them
+
+def keep_rendered_pdf(user_id, invoice_id, key, pdf_bytes, timings, snapshot_id=None):
+    """Put a freshly rendered PDF where downloads look for it: the PDF cache, and the snapshot of an issued invoice."""
+    pdf_cache.put(user_id, invoice_id, key, pdf_bytes)
+    if snapshot_id and app.config['SNAPSHOT_PDF']:
+        db.session.execute(update(InvoiceSnapshot).where(InvoiceSnapshot.id == snapshot_id, InvoiceSnapshot.pdf.is_(None)).values(pdf=pdf_bytes)); db.session.commit()
+    metrics.observe('pdf_build_seconds', timings['total']); metrics.observe('pdf_size_bytes', len(pdf_bytes))
+
+def _export_job(job):
+    """Stream a ZIP of the selected invoices' PDFs into blob storage, one chunk at a time, for download from any host."""
+    user_id = job['user_id']; use_replica()
+    profile = CompanyProfile.query.filter_by(user_id=user_id).first()
+    if not profile: raise LookupError("Profile no longer exists.")
+    args = MultiDict([(k, v) for k, values in job['params']['args'].items() for v in values])
+    query = (filtered_invoices_query(user_id, args)
+             .options(selectinload(Invoice.customer), selectinload(Invoice.items), selectinload(Invoice.tax_lines), selectinload(Invoice.snapshot))
+             .order_by(Invoice.date, Invoice.id)
+             .yield_per(100))
+
+    def entries():
+        for invoice in query:
+            if invoice.snapshot: # issued: exactly what was frozen
+                yield user_id, invoice.id, invoice.invoice_no, unpack_document(invoice.snapshot.document), invoice.snapshot.document_key; continue
+            document = invoice_document(invoice, profile, tax_summary=invoice_tax_summary(invoice))
+            yield user_id, invoice.id, invoice.invoice_no, document, document_key(document)
+
+    expire_job_outputs()
+    size = blobs.write(db.session.connection(), job_output_key(job['id']), stream_pdf_zip(entries(), cache=pdf_cache, processes=app.config['PDF_EXPORT_PROCESSES']))
+    db.session.commit()
+    return {'filename': job['params']['filename'], 'size': size}
+
+def _import_job(job):
+    """Copy the upload from blob storage to a file on this host, chunk by chunk, and import it."""
+    params = job['params']; key = import_upload_key(params['import_job_id'])
+    if not blobs.exists(db.engine, key):
+        import_job = db.session.get(ImportJob, params['import_job_id'])
+        import_job.status = 'failed'; import_job.finished_at = datetime.datetime.utcnow()
+        _record_errors(import_job, [(None, "The uploaded file is no longer available, please upload it again.")]); db.session.commit()
+        return
+    fd, path = tempfile.mkstemp(suffix=f".{params['format']}")
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in blobs.read(db.engine, key): f.write(chunk)
+    try: run_import(params['import_job_id'], path, params['format'], params['batch_size']) # removes the file
+    finally: blobs.delete(db.engine, key)
+
+# --- Emailing invoices ---
+# send_invoices() issues any Drafts, records one queued InvoiceDelivery per
+# invoice and queues an 'email' job per EMAIL_BATCH_SIZE of them. The job sends
+# its batch over one reused SMTP connection (mailer.py), taking each PDF the way
+# the download route does: stored in the snapshot, else the PDF cache, else
+# rendered -- misses render in parallel on the render pool while earlier emails
+# go out. Delivery state is written every DELIVERY_FLUSH_EVERY emails, so a lost
+# worker resends at most that many. Temporary failures stay queued and fail the
+# job, which the job queue retries with exponential backoff; the last attempt
+# marks what is left failed. Permanent (5xx) rejections fail at once.
+EMAILABLE_STATUSES = ('Sent', 'Overdue', 'Paid')
+DELIVERY_FLUSH_EVERY = 25
+
+def send_invoices(user_id, ids):
+    """Queue an email of each invoice to its customer; returns (delivery ids, invoices skipped). Commits."""
+    ids = sorted(set(ids)); transition_invoices(user_id, ids, 'Sent')
+    now = datetime.datetime.utcnow(); delivery_ids = []
+    for batch in batched(ids, app.config['STATUS_BATCH_SIZE']):
+        rows = [dict(invoice_id=invoice_id, user_id=user_id, recipient=email, status='queued', attempts=0, created_at=now) for invoice_id, email in db.session.execute(
+            select(Invoice.id, Customer.email).join(Customer, Customer.id == Invoice.customer_id)
+            .where(Invoice.user_id == user_id, Invoice.id.in_(batch), Invoice.status.in_(EMAILABLE_STATUSES), Customer.email.is_not(None), Customer.email != '',
+                   ~Invoice.deliveries.any(InvoiceDelivery.status == 'queued')) # a double-clicked Send queues nothing twice
+            .order_by(Invoice.id))]
+        if rows: delivery_ids += db.session.execute(insert(InvoiceDelivery).returning(InvoiceDelivery.id), rows).scalars().all()
+    db.session.commit()
+    for chunk in batched(delivery_ids, app.config['EMAIL_BATCH_SIZE']):
+        enqueue_job(user_id, 'email', {'delivery_ids': list(chunk)}, max_attempts=app.config['EMAIL_MAX_ATTEMPTS'])
+    return delivery_ids, len(ids) - len(delivery_ids)
+
+def smtp_batch():
+    return SmtpBatch(app.config['SMTP_HOST'], app.config['SMTP_PORT'], app.config['SMTP_USERNAME'], app.config['SMTP_PASSWORD'],
+                     security=app.config['SMTP_SECURITY'], timeout=app.config['SMTP_TIMEOUT'],
+                     rate_limit=app.config['EMAIL_RATE_LIMIT'], max_per_connection=app.config['EMAIL_BATCH_SIZE'])
+
+def invoice_message(profile, row, pdf_bytes):
+    symbol = get_currency_symbol(profile.currency)
+    body = (f"Dear customer,\n\nPlease find attached invoice {row.invoice_no} for {symbol}{row.grand_total:.2f}"
+            + (f", due on {format_date(row.due_date, profile.date_format)}" if row.due_date else "") + f".\n\nRegards,\n{profile.name}\n")
+    return build_message(sender_address(profile.name, app.config['EMAIL_FROM']), row.recipient, f"Invoice {row.invoice_no} from {profile.name}",
+                         body, f"Invoice-{row.invoice_no}.pdf", pdf_bytes, reply_to=profile.email)
+
+def _email_job(job):
+    """Send one batch of queued deliveries over a single SMTP connection."""
+    user_id = job['user_id']; delivery_ids = job['params']['delivery_ids']
+    profile = CompanyProfile.query.filter_by(user_id=user_id).first()
+    if not profile: raise LookupError("Profile no longer exists.")
+    rows = db.session.execute(
+        select(InvoiceDelivery.id, InvoiceDelivery.invoice_id, InvoiceDelivery.recipient, InvoiceDelivery.attempts, Invoice.invoice_no, Invoice.grand_total, Invoice.due_date,
+               InvoiceSnapshot.id.label('snapshot_id'), InvoiceSnapshot.document, InvoiceSnapshot.document_key, InvoiceSnapshot.pdf)
+        .join(Invoice, Invoice.id == InvoiceDelivery.invoice_id).join(InvoiceSnapshot, InvoiceSnapshot.invoice_id == Invoice.id)
+        .where(InvoiceDelivery.id.in_(delivery_ids), InvoiceDelivery.user_id == user_id, InvoiceDelivery.status == 'queued')
+        .order_by(InvoiceDelivery.id)).all()
+    from pdf_renderer import render_invoice_pdf_timed
+    pool = get_render_pool(app.config['PDF_EXPORT_PROCESSES']); pdfs = {}
+    for row in rows: pdfs[row.id] = row.pdf or pdf_cache.get(user_id, row.invoice_id, row.document_key) or pool.submit(render_invoice_pdf_timed, unpack_document(row.document))
+
+    outcomes = []; sent = 0; last_error = None
+    def flush():
+        if outcomes: db.session.execute(update(InvoiceDelivery), outcomes); db.session.commit(); outcomes.clear()
+    with smtp_batch() as smtp:
+        for position, row in enumerate(rows):
+            outcome = {'id': row.id, 'attempts': row.attempts + 1, 'status': 'queued', 'error': None, 'message_id': None, 'sent_at': None}
+            try:
+                pdf_bytes = pdfs.pop(row.id)
+                if not isinstance(pdf_bytes, bytes):
+                    pdf_bytes, timings = pdf_bytes.result(); keep_rendered_pdf(user_id, row.invoice_id, row.document_key, pdf_bytes, timings, row.snapshot_id)
+                message = invoice_message(profile, row, pdf_bytes)
+                started = time.perf_counter(); smtp.send(message); metrics.observe('email_send_seconds', time.perf_counter() - started)
+                outcome.update(status='sent', message_id=message['Message-ID'], sent_at=datetime.datetime.utcnow())
+            except SmtpUnavailable as e: # nothing else will get through either: the rest stay queued with this error
+                last_error = e; unsent = [pending.id for pending in rows[position:]]
+                db.session.execute(update(InvoiceDelivery).where(InvoiceDelivery.id.in_(unsent)).values(attempts=InvoiceDelivery.attempts + 1, error=str(e)[:500])); db.session.commit()
+                for pending_pdf in pdfs.values():
+                    if not isinstance(pending_pdf, bytes): pending_pdf.cancel()
+                break
+            except Exception as e: # DeliveryError, or the PDF failed to render
+                last_error = e; outcome.update(status='failed' if getattr(e, 'permanent', False) else 'queued', error=str(e)[:500])
+            sent += outcome['status'] == 'sent'; outcomes.append(outcome)
+            metrics.inc('emails_total', outcome={'queued': 'deferred'}.get(outcome['status'], outcome['status']))
+            if len(outcomes) >= DELIVERY_FLUSH_EVERY: flush()
+    flush()
+    pending = db.session.execute(select(InvoiceDelivery.id).where(InvoiceDelivery.id.in_(delivery_ids), InvoiceDelivery.status == 'queued')).scalars().all()
+    if pending and job['attempts'] < job['max_attempts']: raise DeliveryError(f"{len(pending)} email(s) will be retried: {last_error}")
+    if pending: # out of attempts
+        db.session.execute(update(InvoiceDelivery).where(InvoiceDelivery.id.in_(pending)).values(status='failed', error=func.coalesce(InvoiceDelivery.error, str(last_error)[:500]))); db.session.commit()
+        metrics.inc('emails_total', len(pending), outcome='failed')
+    return {'sent': sent, 'failed': len(rows) - sent, 'connections': smtp.connections}
+
+JOB_HANDLERS = {kind: instrumented_job(kind, handler) for kind, handler in {'pdf': _pdf_job, 'export': _export_job, 'import': _import_job, 'email': _email_job}.items()}
+job_worker = JobWorker(job_queue, JOB_HANDLERS, app.app_context,
+                       lambda: db.engine, threads=app.config['JOB_WORKERS'], poll_interval=app.config['JOB_POLL_INTERVAL'])
+
+def job_result_url(job):
+    if job['status'] != 'done': return None
+    if job['kind'] == 'pdf': return url_for('download_invoice_pdf', invoice_id=job['result']['invoice_id'])
+    if job['kind'] == 'export': return url_for('download_job_result', job_id=job['id'])
+    return url_for('import_data', job=job['params']['import_job_id'])
+
+def wants_json(): return request.accept_mimetypes.best == 'application/json'
+
 @app.context_processor
 def inject_helpers():
     logged_in_user = current_user if hasattr(current_user, 'is_authenticated') and current_user.is_authenticated else None
     return dict(
         get_currency_symbol=get_currency_symbol,
         format_date=format_date,
+        asset_url=asset_url,
         current_user=logged_in_user,
         now=datetime.datetime.utcnow() # ADD THIS LINE
     )
 
+# --- Cold start ---
+# Logged once per worker, as two numbers: how long `import app` took, and how
+# long the worker then took to finish its first response. With preload_app the
+# import ran once in the gunicorn master, so post_fork calls worker_started()
+# and each worker's clock starts at its fork. Together with `flask cold-start`
+# this tells whether boots stay within the platform's startup budget.
+STARTUP_TIMINGS = {'import': None, 'first_response': None, 'preloaded': False}
+
+def worker_started():
+    """Restart the first-response clock in a freshly forked worker (gunicorn post_fork)."""
+    global WORKER_STARTED
+    WORKER_STARTED = time.perf_counter(); STARTUP_TIMINGS.update(first_response=None, preloaded=True)
+
+@app.after_request
+def report_cold_start(response):
+    if STARTUP_TIMINGS['first_response'] is None:
+        STARTUP_TIMINGS['first_response'] = time.perf_counter() - WORKER_STARTED
+        where = ' in the master' if STARTUP_TIMINGS['preloaded'] else ''
+        print(f"Cold start (pid {os.getpid()}): import {STARTUP_TIMINGS['import'] * 1000:.0f} ms{where}, first response {STARTUP_TIMINGS['first_response'] * 1000:.0f} ms after the worker started")
+        timing = f"cold-import;dur={STARTUP_TIMINGS['import'] * 1000:.1f}, cold-first-response;dur={STARTUP_TIMINGS['first_response'] * 1000:.1f}"
+        response.headers['Server-Timing'] = ', '.join(filter(None, [response.headers.get('Server-Timing'), timing]))
+    return response
+
 # -----------------------------
 # CORE APPLICATION ROUTES
 # -----------------------------
@@ -174,26 +1326,45 @@ def home():
 
 @app.route('/dashboard')
 @login_required # ADDED
+@reads_from_replica
 def dashboard():
-    profile = CompanyProfile.query.filter_by(user_id=current_user.id).first() # CHANGED
+    profile = get_profile(current_user.id)
 
     if not profile:
          flash("Welcome! Please create your company profile to get started.", "info")
          return redirect(url_for('profile')) 
 
-    invoices = Invoice.query.filter_by(user_id=current_user.id).order_by(Invoice.date.desc()).all() # CHANGED
-    return render_template('dashboard.html', invoices=invoices, profile=profile)
+    sweep_overdue_for(current_user.id)
+    page_size = app.config['DASHBOARD_PAGE_SIZE']
+    query = Invoice.query.filter_by(user_id=current_user.id).options(joinedload(Invoice.customer))
+    after = decode_cursor(request.args.get('after')); before = decode_cursor(request.args.get('before'))
+    if before:
+        # Walk backwards from the cursor, then flip the page back to newest-first
+        rows = query.filter(tuple_(Invoice.date, Invoice.id) > before).order_by(Invoice.date.asc(), Invoice.id.asc()).limit(page_size + 1).all()
+        has_more = len(rows) > page_size; invoices = rows[:page_size][::-1]
+        prev_cursor = encode_cursor(invoices[0]) if has_more else None
+        next_cursor = encode_cursor(invoices[-1]) if invoices else None
+    else:
+        if after: query = query.filter(tuple_(Invoice.date, Invoice.id) < after)
+        rows = query.order_by(Invoice.date.desc(), Invoice.id.desc()).limit(page_size + 1).all()
+        has_more = len(rows) > page_size; invoices = rows[:page_size]
+        next_cursor = encode_cursor(invoices[-1]) if has_more else None
+        prev_cursor = encode_cursor(invoices[0]) if after and invoices else None
+    return render_template('dashboard.html', invoices=invoices, profile=profile, next_cursor=next_cursor, prev_cursor=prev_cursor, kpis=dashboard_kpis(current_user.id))
 
 
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required # ADDED
 def profile():
-    profile = CompanyProfile.query.filter_by(user_id=current_user.id).first() # CHANGED
+    profile = get_profile(current_user.id)
 
     if request.method == 'POST':
+        number_format = request.form.get('invoice_number_format', '').strip() or None
+        format_error = validate_number_format(number_format)
+        if format_error: flash(format_error, "error"); return redirect(url_for('profile'))
         if profile:
             # Update existing profile logic
-            profile.name=request.form['name']; profile.address=request.form['address']; profile.gstin=request.form['gstin']; profile.pan=request.form['pan']; profile.email=request.form['email']; profile.phone=request.form['phone']; profile.bank_name=request.form['bank_name']; profile.account_no=request.form['account_no']; profile.ifsc_code=request.form['ifsc_code']; profile.currency=request.form['currency']; profile.date_format=request.form['date_format']; profile.terms_and_conditions=request.form['terms_and_conditions']
+            profile.name=request.form['name']; profile.address=request.form['address']; profile.gstin=request.form['gstin']; profile.pan=request.form['pan']; profile.email=request.form['email']; profile.phone=request.form['phone']; profile.bank_name=request.form['bank_name']; profile.account_no=request.form['account_no']; profile.ifsc_code=request.form['ifsc_code']; profile.currency=request.form['currency']; profile.date_format=request.form['date_format']; profile.terms_and_conditions=request.form['terms_and_conditions']; profile.invoice_number_format=number_format
             flash("Profile updated successfully!", "success")
         else:
             # Create new profile logic, link to current user
@@ -205,20 +1376,32 @@ def profile():
                 ifsc_code = request.form['ifsc_code'], currency = request.form['currency'], 
                 date_format = request.form['date_format'], 
                 terms_and_conditions = request.form['terms_and_conditions'], 
+                invoice_number_format = number_format,
                 user_id = current_user.id # CHANGED
             )
             db.session.add(new_profile)
             flash("Profile created successfully!", "success")
-        try: db.session.commit()
+        try: db.session.commit(); pdf_cache.invalidate(current_user.id)
         except Exception as e: db.session.rollback(); flash(f"Error saving profile: {e}", "error")
         return redirect(url_for('profile'))
     return render_template('profile.html', profile=profile)
 
 @app.route('/customers')
 @login_required # ADDED
+@reads_from_replica
 def customer_management():
-    customers = Customer.query.filter_by(user_id=current_user.id).all() # CHANGED
-    return render_template('customers.html', customers=customers)
+    page = max(request.args.get('page', 1, type=int), 1); per_page = app.config['CUSTOMER_PAGE_SIZE']; q = request.args.get('q', '')
+    customers, has_more = search_customers(current_user.id, q, per_page, (page - 1) * per_page)
+    return render_template('customers.html', customers=customers, q=q, page=page, has_more=has_more)
+
+@app.route('/api/customers/search')
+@login_required
+@reads_from_replica
+def api_search_customers():
+    """Typeahead: ?q=&page=&per_page= -> {"results": [...], "has_more": bool}."""
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100); page = max(request.args.get('page', 1, type=int), 1)
+    customers, has_more = search_customers(current_user.id, request.args.get('q', ''), per_page, (page - 1) * per_page)
+    return jsonify(results=[{'id': c.id, 'name': c.name, 'gstin': c.gstin, 'contact_person': c.contact_person, 'state': c.state} for c in customers], has_more=has_more)
 
 @app.route('/customers/add', methods=['GET', 'POST'])
 @login_required # ADDED
@@ -231,6 +1414,7 @@ def add_customer():
             gstin=request.form.get('gstin', ''), 
             state=request.form.get('state', ''), 
             contact_person=request.form.get('contact_person', ''), 
+            email=request.form.get('email', '').strip() or None, 
             user_id = current_user.id # CHANGED
         )
         db.session.add(new_customer)
@@ -244,8 +1428,8 @@ def add_customer():
 def edit_customer(customer_id):
     customer = Customer.query.filter_by(id=customer_id, user_id=current_user.id).first_or_404() # CHANGED
     if request.method == 'POST':
-        customer.name = request.form['name']; customer.billing_address = request.form['billing_address']; customer.shipping_address = request.form.get('shipping_address', ''); customer.gstin = request.form.get('gstin', ''); customer.state = request.form.get('state', ''); customer.contact_person = request.form.get('contact_person', '')
-        try: db.session.commit(); flash(f"Customer '{customer.name}' updated.", "success")
+        customer.name = request.form['name']; customer.billing_address = request.form['billing_address']; customer.shipping_address = request.form.get('shipping_address', ''); customer.gstin = request.form.get('gstin', ''); customer.state = request.form.get('state', ''); customer.contact_person = request.form.get('contact_person', ''); customer.email = request.form.get('email', '').strip() or None
+        try: db.session.commit(); pdf_cache.invalidate(current_user.id, [inv.id for inv in customer.invoices]); flash(f"Customer '{customer.name}' updated.", "success")
         except Exception as e: db.session.rollback(); flash(f"Error updating customer: {e}", "error")
         return redirect(url_for('customer_management'))
     return render_template('customer_form.html', customer=customer, mode='edit')
@@ -266,86 +1450,60 @@ def delete_customer(customer_id):
 @app.route('/invoice/add', methods=['GET', 'POST'])
 @login_required # ADDED
 def add_invoice():
-    profile = CompanyProfile.query.filter_by(user_id=current_user.id).first() # CHANGED
+    profile = get_profile(current_user.id)
     if not profile: flash("Please create profile first.", "warning"); return redirect(url_for('profile'))
-    customers = Customer.query.filter_by(user_id=current_user.id).all() # CHANGED
     today = datetime.date.today().strftime('%Y-%m-%d')
 
     def rerender_form(error_msg="An error occurred.", customer_id_sel=None):
          flash(error_msg, "error")
-         return render_template('invoice_form.html', customers=customers, profile=profile, today=today, invoice_data=request.form, selected_customer=int(customer_id_sel) if customer_id_sel else None)
+         selected = Customer.query.filter_by(id=customer_id_sel, user_id=current_user.id).first() if str(customer_id_sel or '').isdigit() else None
+         return render_template('invoice_form.html', profile=profile, today=today, due_days=app.config['INVOICE_DUE_DAYS'], invoice_data=request.form, selected_customer=selected)
 
     if request.method == 'POST':
-        invoice_no_from_form = request.form['invoice_no']; customer_id = request.form.get('customer')
-        existing_invoice = Invoice.query.filter_by(invoice_no=invoice_no_from_form, user_id=current_user.id).first() # CHANGED
-        if existing_invoice: return rerender_form(f"Error: Invoice number '{invoice_no_from_form}' already exists.", customer_id)
-        selected_cust_obj = Customer.query.filter_by(id=customer_id, user_id=current_user.id).first() # CHANGED
-        if not selected_cust_obj: return rerender_form("Invalid customer selected.", customer_id)
-
-        new_invoice = Invoice( 
-            invoice_no = invoice_no_from_form, 
-            date = request.form['date'], 
-            po_number = request.form.get('po_number'), 
-            profile_id = profile.id, 
-            customer_id = customer_id, 
-            user_id = current_user.id, # CHANGED
-            subtotal = 0, total_gst = 0, grand_total = 0, 
-            po_date = request.form.get('po_date'), 
-            eway_bill_no = request.form.get('eway_bill_no'), 
-            place_of_supply = request.form.get('place_of_supply'), 
-            transport_name = request.form.get('transport_name'), 
-            vehicle_no = request.form.get('vehicle_no'), 
-            delivery_location = request.form.get('delivery_location')
-        )
-        try: db.session.add(new_invoice); db.session.commit()
-        except Exception as e: db.session.rollback(); print(f"DB Error: {e}"); return rerender_form(f"Error creating invoice header: {e}", customer_id)
-
-        item_names = request.form.getlist('item_name'); hsns = request.form.getlist('hsn'); qtys = request.form.getlist('qty'); units = request.form.getlist('unit'); rates = request.form.getlist('rate'); taxes = request.form.getlist('tax_percent'); subtotal_calc = 0; total_gst_calc = 0; items_to_add = []
-        for i in range(len(item_names)):
-             try:
-                 if not item_names[i]: continue
-                 qty = int(qtys[i]); rate = float(rates[i]); tax_percent = float(taxes[i]); line_total = qty * rate; gst_amount = line_total * (tax_percent / 100.0); subtotal_calc += line_total; total_gst_calc += gst_amount
-                 new_item = InvoiceItem(name = item_names[i], hsn = hsns[i], qty = qty, unit = units[i], rate = rate, tax_percent = tax_percent, invoice_id = new_invoice.id)
-                 items_to_add.append(new_item)
-             except (ValueError, IndexError) as e: print(f"Skipping bad item row {i}: {e}"); continue
-        try: db.session.add_all(items_to_add); new_invoice.subtotal = subtotal_calc; new_invoice.total_gst = total_gst_calc; new_invoice.grand_total = subtotal_calc + total_gst_calc; db.session.commit(); flash(f"Invoice {new_invoice.invoice_no} created.", "success"); return redirect(url_for('dashboard'))
-        except Exception as e: db.session.rollback(); print(f"DB Error Items: {e}"); return rerender_form(f"Error saving invoice items: {e}", customer_id)
+        customer_id = request.form.get('customer')
+        payload = {k: request.form.get(k) for k in ('invoice_no', 'date', 'po_date', 'due_date', *INVOICE_HEADER_FIELDS)}
+        payload.update(customer_id=customer_id, items=items_from_form(request.form))
+        try: created, = create_invoices(current_user.id, profile, [payload])
+        except InvoiceValidationError as e: return rerender_form(' '.join(e.errors), customer_id)
+        except Exception as e: print(f"DB Error: {e}"); return rerender_form(f"Error creating invoice: {e}", customer_id)
+        flash(f"Invoice {created['invoice_no']} created.", "success"); return redirect(url_for('dashboard'))
 
-    return render_template('invoice_form.html', customers=customers, profile=profile, today=today, invoice_data={}, selected_customer=None)
+    return render_template('invoice_form.html', profile=profile, today=today, due_days=app.config['INVOICE_DUE_DAYS'], invoice_data={}, selected_customer=None)
 
 
 @app.route('/invoice/view/<int:invoice_id>')
 @login_required # ADDED
+@reads_from_replica
 def view_invoice(invoice_id):
+    snapshot = snapshot_row(invoice_id, current_user.id, InvoiceSnapshot.document)
+    if snapshot: # issued: one read, nothing live
+        etag = make_etag('view', invoice_id, 'snapshot', snapshot.id, current_user.id, template_version(), datetime.date.today())
+        if is_not_modified(etag): return not_modified_response(etag)
+        return with_etag(app.make_response(render_template('invoice_preview.html', **snapshot_context(invoice_id, unpack_document(snapshot.document)))), etag)
+    etag = make_etag('view', invoice_id, invoice_versions(invoice_id, current_user.id), current_user.id, template_version(), datetime.date.today())
+    if is_not_modified(etag): return not_modified_response(etag)
     invoice = Invoice.query.filter_by(id=invoice_id, user_id=current_user.id).first_or_404() # CHANGED
     profile = invoice.profile
     customer = invoice.customer
-    tax_summary = {}
-    for item in invoice.items:
-        tax_rate = item.tax_percent
-        taxable_amount = item.qty * item.rate
-        gst_amount = taxable_amount * (tax_rate / 100.0)
-        if tax_rate in tax_summary:
-            tax_summary[tax_rate]['taxable_amount'] += taxable_amount
-            tax_summary[tax_rate]['gst_amount'] += gst_amount
-        else: 
-            tax_summary[tax_rate] = {
-                'taxable_amount': taxable_amount,
-                'gst_amount': gst_amount
-            }
-    return render_template('invoice_preview.html', invoice=invoice, profile=profile, customer=customer, tax_summary=tax_summary)
+    tax_summary = invoice_tax_summary(invoice)
+    return with_etag(app.make_response(render_template('invoice_preview.html', invoice=invoice, profile=profile, customer=customer, tax_summary=tax_summary)), etag)
 
 
 @app.route('/invoice/delete/<int:invoice_id>', methods=['POST'])
 @login_required # ADDED
 def delete_invoice(invoice_id):
-    """Delete an invoice belonging to the current user."""
+    """Delete a Draft belonging to the current user; issued invoices keep their number and are Cancelled instead."""
     invoice = Invoice.query.filter_by(id=invoice_id, user_id=current_user.id).first() # CHANGED
 
+    if invoice and invoice.status != 'Draft':
+        flash(f"Invoice #{invoice.invoice_no} has already been issued and cannot be deleted; cancel it instead.", "warning")
+        return redirect(url_for('invoice_payments', invoice_id=invoice_id))
     if invoice:
         try:
+            apply_gst_rollup(current_user.id, [(invoice.date, invoice.customer_gstin, invoice.gst_place_of_supply, invoice_tax_summary(invoice))], sign=-1)
             db.session.delete(invoice)
             db.session.commit()
+            pdf_cache.invalidate(current_user.id, [invoice_id])
             flash(f"Invoice #{invoice.invoice_no} deleted successfully.", "success")
         except Exception as e:
             db.session.rollback()
@@ -356,154 +1514,324 @@ def delete_invoice(invoice_id):
     return redirect(url_for('dashboard'))
 
 
+@app.route('/invoice/issue/<int:invoice_id>', methods=['POST'])
+@login_required
+def issue_invoice(invoice_id):
+    """Finalize a Draft as Sent: freeze its snapshot and start rendering the PDF kept with it."""
+    invoice_no = db.session.execute(select(Invoice.invoice_no).where(Invoice.id == invoice_id, Invoice.user_id == current_user.id)).scalar() or abort(404)
+    if not transition_invoices(current_user.id, [invoice_id], 'Sent'):
+        db.session.rollback(); flash(f"Invoice #{invoice_no} has already been issued.", "warning"); return redirect(url_for('view_invoice', invoice_id=invoice_id))
+    key = db.session.execute(select(InvoiceSnapshot.document_key).where(InvoiceSnapshot.invoice_id == invoice_id)).scalar()
+    db.session.commit()
+    if app.config['SNAPSHOT_PDF']: enqueue_job(current_user.id, 'pdf', {'invoice_id': invoice_id}, dedupe_key=f"{invoice_id}:{key}")
+    flash(f"Invoice #{invoice_no} issued. Its contents are now fixed.", "success")
+    return redirect(url_for('view_invoice', invoice_id=invoice_id))
+
+@app.route('/invoice/<int:invoice_id>/payments', methods=['GET', 'POST'])
+@login_required
+def invoice_payments(invoice_id):
+    """Payment history of an invoice and a form to record a (partial) payment."""
+    if request.method == 'POST':
+        try:
+            amount = to_money(request.form.get('amount'))
+            if amount <= 0: raise ValueError
+            on_date = parse_date(request.form.get('date')) or datetime.date.today()
+        except (ValueError, InvalidOperation):
+            flash("Enter a positive amount and a valid date.", "warning"); return redirect(url_for('invoice_payments', invoice_id=invoice_id))
+        try:
+            status = record_payment(current_user.id, invoice_id, amount, on_date, request.form.get('reference', '').strip()[:100] or None); db.session.commit()
+        except InvoiceValidationError as e:
+            db.session.rollback(); flash('; '.join(e.errors), "warning")
+        else:
+            flash(f"Payment of {amount} recorded." + (" The invoice is now fully paid." if status == 'Paid' else ""), "success")
+        return redirect(url_for('invoice_payments', invoice_id=invoice_id))
+    invoice = Invoice.query.filter_by(id=invoice_id, user_id=current_user.id).options(selectinload(Invoice.payments), selectinload(Invoice.deliveries)).first_or_404()
+    return render_template('payments.html', invoice=invoice, profile=get_profile(current_user.id), balance=invoice.grand_total - invoice.amount_paid,
+                           payable_statuses=PAYABLE_STATUSES, transitions=INVOICE_TRANSITIONS.get(invoice.status, ()), today=datetime.date.today().isoformat())
+
+@app.route('/invoice/<int:invoice_id>/status', methods=['POST'])
+@login_required
+def invoice_status(invoice_id):
+    status = request.form.get('status', '')
+    try: moved = transition_invoices(current_user.id, [invoice_id], status, parse_date(request.form.get('date')), request.form.get('reference', '').strip()[:100] or None)
+    except (InvoiceValidationError, ValueError) as e:
+        db.session.rollback(); flash('; '.join(e.errors) if isinstance(e, InvoiceValidationError) else "Invalid date.", "warning"); return redirect(url_for('invoice_payments', invoice_id=invoice_id))
+    db.session.commit()
+    flash(f"Invoice marked {status}." if moved else f"This invoice cannot be moved to {status}.", "success" if moved else "warning")
+    return redirect(url_for('invoice_payments', invoice_id=invoice_id))
+
+@app.route('/invoice/<int:invoice_id>/send', methods=['POST'])
+@login_required
+def send_invoice(invoice_id):
+    """Email one invoice to its customer (issuing it first if it is a Draft)."""
+    invoice = Invoice.query.filter_by(id=invoice_id, user_id=current_user.id).options(joinedload(Invoice.customer)).first_or_404()
+    if not app.config['SMTP_HOST']: flash("Email is not configured (set SMTP_HOST).", "warning"); return redirect(url_for('view_invoice', invoice_id=invoice_id))
+    if not invoice.customer.email: flash(f"Add an email address for {invoice.customer.name} first.", "warning"); return redirect(url_for('edit_customer', customer_id=invoice.customer_id))
+    queued, _ = send_invoices(current_user.id, [invoice_id])
+    flash(f"Invoice #{invoice.invoice_no} is being emailed to {invoice.customer.email}." if queued else f"Invoice #{invoice.invoice_no} cannot be emailed now (cancelled, or already queued).", "success" if queued else "warning")
+    return redirect(url_for('invoice_payments', invoice_id=invoice_id))
+
+@app.route('/invoices/send', methods=['POST'])
+@login_required
+def bulk_send_invoices():
+    """Dashboard bulk action: email the ticked invoices, one SMTP connection per batch."""
+    ids = [int(i) for i in request.form.getlist('ids') if i.isdigit()]
+    if not app.config['SMTP_HOST']: flash("Email is not configured (set SMTP_HOST).", "warning"); return redirect(url_for('dashboard'))
+    if not ids: flash("Select at least one invoice.", "warning"); return redirect(url_for('dashboard'))
+    queued, skipped = send_invoices(current_user.id, ids)
+    flash(f"{len(queued)} invoice(s) queued for email." + (f" {skipped} skipped: cancelled, already queued, or the customer has no email address." if skipped else ""), "success" if queued else "warning")
+    return redirect(url_for('dashboard'))
+
+@app.route('/invoices/status', methods=['POST'])
+@login_required
+def bulk_invoice_status():
+    """Dashboard bulk action: move the ticked invoices to one status."""
+    ids = [int(i) for i in request.form.getlist('ids') if i.isdigit()]; status = request.form.get('status', '')
+    if not ids: flash("Select at least one invoice.", "warning"); return redirect(url_for('dashboard'))
+    try: moved = transition_invoices(current_user.id, ids, status, parse_date(request.form.get('date')), request.form.get('reference', '').strip()[:100] or None)
+    except (InvoiceValidationError, ValueError) as e:
+        db.session.rollback(); flash('; '.join(e.errors) if isinstance(e, InvoiceValidationError) else "Invalid date.", "warning"); return redirect(url_for('dashboard'))
+    db.session.commit()
+    skipped = len(set(ids)) - len(moved)
+    flash(f"{len(moved)} invoice(s) marked {status}." + (f" {skipped} skipped: their status does not allow it." if skipped else ""), "success" if moved else "warning")
+    return redirect(url_for('dashboard'))
+
 @app.route('/invoice/pdf/<int:invoice_id>')
 @login_required # ADDED
+@reads_from_replica
 def download_invoice_pdf(invoice_id):
-    profile = CompanyProfile.query.filter_by(user_id=current_user.id).first() # CHANGED
+    profile = get_profile(current_user.id)
     if not profile: flash("Cannot generate PDF without profile.", "warning"); return redirect(url_for('profile'))
+    snapshot = snapshot_row(invoice_id, current_user.id, InvoiceSnapshot.invoice_no, InvoiceSnapshot.document_key, InvoiceSnapshot.pdf)
+    if snapshot: # issued: the stored PDF, or the frozen document once it has been rendered
+        etag = make_etag('pdf', invoice_id, 'snapshot', snapshot.id, 'stored' if snapshot.pdf else [RENDERER_VERSION, LARGE_INVOICE_ITEMS])
+        if is_not_modified(etag): return not_modified_response(etag)
+        invoice_no, cache_key, pdf_bytes = snapshot.invoice_no, snapshot.document_key, snapshot.pdf
+    else:
+        etag = make_etag('pdf', invoice_id, invoice_versions(invoice_id, current_user.id), RENDERER_VERSION, LARGE_INVOICE_ITEMS)
+        if is_not_modified(etag): return not_modified_response(etag)
+        invoice = Invoice.query.filter_by(id=invoice_id, user_id=current_user.id).first_or_404() # CHANGED
+        document = invoice_document(invoice, profile, tax_summary=invoice_tax_summary(invoice))
+        invoice_no, cache_key, pdf_bytes = invoice.invoice_no, document_key(document), None
+    timings = {}; source = 'snapshot' if pdf_bytes else 'hit'
+    if pdf_bytes is None: pdf_bytes = pdf_cache.get(current_user.id, invoice_id, cache_key)
+    if pdf_bytes is None:
+        # Rendered on the job queue; small invoices finish within PDF_INLINE_WAIT and are served right away
+        job_id = enqueue_job(current_user.id, 'pdf', {'invoice_id': invoice_id}, dedupe_key=f"{invoice_id}:{cache_key}")
+        job = job_queue.wait(db.engine, job_id, app.config['PDF_INLINE_WAIT'])
+        if job['status'] == 'failed':
+            flash(f"Error generating PDF: {job['error']}", "error"); return redirect(url_for('dashboard'))
+        if job['status'] == 'done' and job['result']['key'] == cache_key:
+            pdf_bytes = pdf_cache.get(current_user.id, invoice_id, cache_key) or blobs.load(db.engine, job_output_key(job_id)) # rendered on another host
+            timings = job['result']['timings']; source = 'miss'
+        if pdf_bytes is None:
+            if wants_json(): return jsonify(job_id=job_id, status=job['status'], status_url=url_for('job_status', job_id=job_id)), 202
+            return redirect(url_for('job_page', job_id=job_id))
 
-    invoice = Invoice.query.filter_by(id=invoice_id, user_id=current_user.id).first_or_404() # CHANGED
-    customer = invoice.customer; buffer = io.BytesIO()
-    
-    # --- Font Registration & Styles ---
-    FONT_NORMAL = 'NotoSans'
-    FONT_BOLD = 'NotoSans-Bold'
-    
-    try:
-        # Get the absolute path to the fonts directory
-        # (This is necessary for Render to find the files)
-        base_dir = os.path.abspath(os.path.dirname(__file__))
-        fonts_dir = os.path.join(base_dir, 'fonts')
-        
-        regular_font_path = os.path.join(fonts_dir, 'NotoSans-Regular.ttf')
-        bold_font_path = os.path.join(fonts_dir, 'NotoSans-Bold.ttf')
+    response = send_file(io.BytesIO(pdf_bytes), as_attachment=True, download_name=f"Invoice-{invoice_no}.pdf", mimetype='application/pdf')
+    response.headers['X-PDF-Cache'] = source
+    if timings: response.headers['Server-Timing'] = ', '.join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in timings.items())
+    return with_etag(response, etag)
 
-        pdfmetrics.registerFont(TTFont(FONT_NORMAL, regular_font_path))
-        pdfmetrics.registerFont(TTFont(FONT_BOLD, bold_font_path))
-        
-        # Add mapping for bold/italic (though we only have bold)
-        addMapping(FONT_NORMAL, 0, 0, FONT_NORMAL) # normal
-        addMapping(FONT_NORMAL, 1, 0, FONT_BOLD)   # bold
-        addMapping(FONT_NORMAL, 0, 1, FONT_NORMAL) # italic (fallback to normal)
-        addMapping(FONT_NORMAL, 1, 1, FONT_BOLD)   # bold-italic (fallback to bold)
-        
-        print(f"Successfully registered fonts: {FONT_NORMAL}, {FONT_BOLD}")
+def invoice_filters(user_id, args):
+    """WHERE clauses for a user's invoices narrowed by the optional start/end date, status, customer_id and ids query parameters."""
+    conditions = [Invoice.user_id == user_id]
+    try: start = parse_date(args.get('start')); end = parse_date(args.get('end'))
+    except ValueError: abort(400, "Dates must be YYYY-MM-DD.")
+    if start: conditions.append(Invoice.date >= start)
+    if end: conditions.append(Invoice.date <= end)
+    if args.get('status'): conditions.append(Invoice.status == args['status'])
+    if args.get('customer_id'):
+        if not args['customer_id'].isdigit(): abort(400, "customer_id must be a number.")
+        conditions.append(Invoice.customer_id == int(args['customer_id']))
+    ids = [int(i) for raw in args.getlist('ids') for i in raw.split(',') if i.strip().isdigit()]
+    if ids: conditions.append(Invoice.id.in_(ids))
+    return conditions
 
-    except Exception as e:
-        print(f"WARNING: Font registration failed: {e}. Falling back to Helvetica.")
-        FONT_NORMAL = 'Helvetica'
-        FONT_BOLD = 'Helvetica-Bold'
-    
-    styles=getSampleStyleSheet(); theme_color=colors.HexColor('#4A90E2'); light_bg_color=colors.HexColor('#F8F9FA')
-    style_normal=ParagraphStyle(name='NormalBase', parent=styles['Normal'], fontName=FONT_NORMAL, fontSize=9, leading=12)
-    style_normal_right=ParagraphStyle(name='Normal_Right', parent=style_normal, alignment=TA_RIGHT)
-    style_bold=ParagraphStyle(name='Bold', parent=style_normal, fontName=FONT_BOLD)
-    style_bold_right=ParagraphStyle(name='Bold_Right', parent=style_bold, alignment=TA_RIGHT)
-    style_small=ParagraphStyle(name='Small', parent=style_normal, fontSize=8, leading=10)
-    style_small_right=ParagraphStyle(name='Small_Right', parent=style_small, alignment=TA_RIGHT)
-    style_title=ParagraphStyle(name='Title', parent=styles['h1'], fontName=FONT_BOLD, fontSize=18, alignment=TA_CENTER)
-    style_table_header=ParagraphStyle(name='TableHeader', parent=style_small, fontName=FONT_BOLD, textColor=colors.white)
-    style_table_header_right=ParagraphStyle(name='TableHeaderRight', parent=style_table_header, alignment=TA_RIGHT)
-    
-    currency = get_currency_symbol(profile.currency)
-    
-    def format_date_pdf(date_str):
-        return format_date(date_str, profile.date_format) if date_str else 'N/A'
-    def nl_to_br(text):
-        return text.replace('\n', '<br/>') if text else ''
-    
-    story=[]; doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=15*mm, leftMargin=15*mm, topMargin=15*mm, bottomMargin=15*mm)
-    story.append(Paragraph("TAX INVOICE", style_title)); story.append(Spacer(1, 8*mm))
-    
-    supplier_details = f"<b>{profile.name}</b><br/>{nl_to_br(profile.address)}<br/><b>GSTIN:</b> {profile.gstin}<br/><b>Phone:</b> {profile.phone or 'N/A'}<br/><b>Email:</b> {profile.email or 'N/A'}"
-    bill_to_details = f"<b>Bill To:</b><br/><b>{customer.name}</b><br/>{nl_to_br(customer.billing_address)}<br/><b>GSTIN:</b> {customer.gstin or 'N/A'}"
-    ship_to_address = customer.shipping_address or customer.billing_address
-    ship_to_details = f"<b>Ship To:</b><br/><b>{customer.name}</b><br/>{nl_to_br(ship_to_address)}"
-    
-    invoice_details_data = [
-        [Paragraph("<b>Invoice No.:</b>", style_normal), Paragraph(invoice.invoice_no, style_normal_right)], 
-        [Paragraph("<b>Invoice Date:</b>", style_normal), Paragraph(format_date_pdf(invoice.date), style_normal_right)], 
-        [Paragraph("<b>E-Way Bill No.:</b>", style_normal), Paragraph(invoice.eway_bill_no or 'N/A', style_normal_right)], 
-        [Paragraph("<b>Place of Supply:</b>", style_normal), Paragraph(invoice.place_of_supply or customer.state or 'N/A', style_normal_right)]
-    ]
-    invoice_details_table = Table(invoice_details_data, colWidths=['*', 1.8*inch])
-    invoice_details_table.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP')]))
-    
-    header_data = [[Paragraph(supplier_details, style_normal), [Paragraph(bill_to_details, style_normal), Spacer(1, 4*mm), Paragraph(ship_to_details, style_normal)], invoice_details_table]]
-    header_table = Table(header_data, colWidths=[2.7*inch, 2.7*inch, 2.4*inch])
-    header_table.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('RIGHTPADDING', (0,0), (-1,-1), 0), ('BOTTOMPADDING', (0,0), (-1,-1), 5*mm)]))
-    story.append(header_table)
-    
-    transport_data = [[
-        Paragraph(f"<b>P.O. Number:</b><br/>{invoice.po_number or 'N/A'}", style_small), 
-        Paragraph(f"<b>P.O. Date:</b><br/>{format_date_pdf(invoice.po_date)}", style_small), 
-        Paragraph(f"<b>Transport:</b><br/>{invoice.transport_name or 'N/A'}", style_small), 
-        Paragraph(f"<b>Vehicle No.:</b><br/>{invoice.vehicle_no or 'N/A'}", style_small), 
-        Paragraph(f"<b>Delivery At:</b><br/>{invoice.delivery_location or 'N/A'}", style_small)
-    ]]
-    transport_table = Table(transport_data, colWidths='*')
-    transport_table.setStyle(TableStyle([('BACKGROUND', (0,0), (-1,-1), light_bg_color), ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey), ('PADDING', (0,0), (-1,-1), 6), ('VALIGN', (0,0), (-1,-1), 'TOP')]))
-    story.append(transport_table); story.append(Spacer(1, 6*mm))
-    
-    item_table_data = [[Paragraph("Item Description", style_table_header), Paragraph("HSN/SAC", style_table_header), Paragraph("Qty", style_table_header_right), Paragraph("Unit", style_table_header_right), Paragraph("Rate", style_table_header_right), Paragraph("Tax %", style_table_header_right), Paragraph("Amount", style_table_header_right)]]
-    tax_summary = {}
-    
-    for item in invoice.items: 
-        line_total = item.qty * item.rate
-        item_table_data.append([
-            Paragraph(item.name, style_small), 
-            Paragraph(item.hsn or '', style_small), 
-            Paragraph(str(item.qty), style_small_right), 
-            Paragraph(item.unit or '', style_small_right), 
-            Paragraph(f"{currency}{item.rate:.2f}", style_small_right), 
-            Paragraph(f"{item.tax_percent:.0f}%", style_small_right), 
-            Paragraph(f"{currency}{line_total:.2f}", style_small_right)
-        ])
-        tax_rate = item.tax_percent; taxable_amount = line_total; gst_amount = taxable_amount * (tax_rate / 100.0)
-        if tax_rate in tax_summary: 
-            tax_summary[tax_rate]['taxable_amount'] += taxable_amount
-            tax_summary[tax_rate]['gst_amount'] += gst_amount
-        else: 
-            tax_summary[tax_rate] = {'taxable_amount': taxable_amount, 'gst_amount': gst_amount}
-            
-    item_table = Table(item_table_data, colWidths=[2.8*inch, 0.8*inch, 0.5*inch, 0.6*inch, 0.9*inch, 0.6*inch, 1.1*inch], repeatRows=1)
-    item_table.setStyle(TableStyle([('BACKGROUND', (0,0), (-1,0), theme_color), ('TEXTCOLOR', (0,0), (-1,0), colors.white), ('FONTNAME', (0,0), (-1,0), FONT_BOLD), ('BOTTOMPADDING', (0,0), (-1,0), 6), ('TOPPADDING', (0,0), (-1,0), 6), ('ALIGN', (0,0), (-1,0), 'CENTER'), ('FONTNAME', (0,1), (-1,-1), FONT_NORMAL), ('FONTSIZE', (0,1), (-1,-1), 8), ('TOPPADDING', (0,1), (-1,-1), 4), ('BOTTOMPADDING', (0,1), (-1,-1), 4), ('LINEBELOW', (0,0), (-1,0), 1, theme_color), ('LINEBELOW', (0,-1), (-1,-1), 0.5, colors.grey), ('ALIGN', (2,1), (-1,-1), 'RIGHT'), ('VALIGN', (0,0), (-1,-1), 'MIDDLE')]))
-    story.append(item_table); story.append(Spacer(1, 8*mm))
-    
-    tax_table_data = [[Paragraph("<b>Tax Rate</b>", style_small), Paragraph("<b>Taxable Amount</b>", style_small_right), Paragraph("<b>GST Amount</b>", style_small_right)]]
-    for rate, data in sorted(tax_summary.items()): 
-        tax_table_data.append([Paragraph(f"{rate:.0f}%", style_small), Paragraph(f"{currency}{data['taxable_amount']:.2f}", style_small_right), Paragraph(f"{currency}{data['gst_amount']:.2f}", style_small_right)])
-    
-    tax_table = Table(tax_table_data, colWidths='*')
-    tax_table.setStyle(TableStyle([('FONTSIZE', (0,0), (-1,-1), 8), ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey), ('BOX', (0,0), (-1,-1), 0.5, colors.grey), ('BACKGROUND', (0,0), (-1,0), light_bg_color), ('FONTNAME', (0,0), (-1,-1), FONT_NORMAL)]))
-    
-    bank_details = f"<b>Bank Details:</b><br/><b>Bank:</b> {profile.bank_name or 'N/A'}<br/><b>A/C No:</b> {profile.account_no or 'N/A'}<br/><b>IFSC:</b> {profile.ifsc_code or 'N/A'}"
-    terms = f"<b>Terms & Conditions:</b><br/>{nl_to_br(profile.terms_and_conditions) or 'Thank you for your business.'}"
-    
-    left_footer_content = [Paragraph("<b>Tax Summary:</b>", style_bold), Spacer(1, 1*mm), tax_table, Spacer(1, 5*mm), Paragraph(bank_details, style_small), Spacer(1, 5*mm), Paragraph(terms, style_small)]
-    
-    totals_data = [
-        [Paragraph("Subtotal:", style_bold), Paragraph(f"{currency}{invoice.subtotal:.2f}", style_bold_right)], 
-        [Paragraph("Total GST:", style_bold), Paragraph(f"{currency}{invoice.total_gst:.2f}", style_bold_right)], 
-        [Paragraph("Grand Total:", style_bold), Paragraph(f"{currency}{invoice.grand_total:.2f}", style_bold_right)]
-    ]
-    totals_table = Table(totals_data, colWidths=['*', 1.5*inch])
-    totals_table.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'MIDDLE'), ('TOPPADDING', (0,0), (-1,-1), 4), ('BOTTOMPADDING', (0,0), (-1,-1), 4), ('LINEABOVE', (0, -1), (-1, -1), 1, colors.grey), ('BACKGROUND', (0, -1), (-1, -1), light_bg_color), ('FONTNAME', (0,0), (-1,-1), FONT_BOLD)]))
-    
-    signature = f"For: {profile.name}<br/><br/><br/><br/>Authorized Signatory"
-    right_footer_content = [totals_table, Spacer(1, 15*mm), Paragraph(signature, style_small_right)]
-    
-    footer_table = Table([[left_footer_content, right_footer_content]], colWidths=[4.8*inch, 2.5*inch])
-    footer_table.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('RIGHTPADDING', (0,0), (-1,-1), 0)]))
-    story.append(footer_table)
-    
-    try: doc.build(story)
-    except Exception as e: 
-        print(f"ERROR building PDF: {e}"); flash(f"Error generating PDF: {e}", "error"); 
-        return redirect(url_for('dashboard'))
-        
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name=f"Invoice-{invoice.invoice_no}.pdf", mimetype='application/pdf')
+def filtered_invoices_query(user_id, args):
+    return Invoice.query.filter(*invoice_filters(user_id, args))
+
+def ledger_statement(user_id, args):
+    """One row per line item of the filtered invoices, fetched LEDGER_FETCH_SIZE rows at a time through a server-side cursor."""
+    return (select(Invoice.invoice_no, Invoice.date, Invoice.status, Customer.name, Customer.gstin, Invoice.place_of_supply,
+                   InvoiceItem.name, InvoiceItem.hsn, InvoiceItem.qty, InvoiceItem.unit, InvoiceItem.rate, InvoiceItem.tax_percent)
+            .join(InvoiceItem, InvoiceItem.invoice_id == Invoice.id).join(Customer, Customer.id == Invoice.customer_id)
+            .where(*invoice_filters(user_id, args))
+            .order_by(Invoice.date, Invoice.id, InvoiceItem.id)
+            .execution_options(stream_results=True, yield_per=app.config['LEDGER_FETCH_SIZE']))
+
+def ledger_rows(statement):
+    """Ledger rows in LEDGER_COLUMNS order, with per-line amounts rounded like compute_tax_summary."""
+    for *head, qty, unit, rate, tax_percent in db.session.execute(statement):
+        taxable = (qty * Decimal(rate)).quantize(CENTS, rounding=ROUND_HALF_UP)
+        gst = (qty * Decimal(rate) * Decimal(tax_percent) / 100).quantize(CENTS, rounding=ROUND_HALF_UP)
+        yield (*head, qty, unit, rate, tax_percent, taxable, gst, taxable + gst)
+
+
+@app.route('/invoices/export/pdf')
+@login_required
+def export_invoices_pdf():
+    """Queue a ZIP export of the filtered invoices and send the user to its job page."""
+    profile = get_profile(current_user.id)
+    if not profile: flash("Cannot generate PDF without profile.", "warning"); return redirect(url_for('profile'))
+    filtered_invoices_query(current_user.id, request.args) # reject bad filters now rather than in the job
+    filename = f"Invoices-{request.args.get('start') or 'all'}-{request.args.get('end') or 'all'}.zip"
+    job_id = enqueue_job(current_user.id, 'export', {'args': request.args.to_dict(flat=False), 'filename': filename})
+    if wants_json(): return jsonify(job_id=job_id, status_url=url_for('job_status', job_id=job_id)), 202
+    return redirect(url_for('job_page', job_id=job_id))
+
+@app.route('/invoices/export/ledger')
+@login_required
+@reads_from_replica
+def export_ledger():
+    """Stream the line-item ledger of the filtered invoices as CSV (default) or XLSX."""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in LEDGER_FORMATS: abort(400, "format must be csv or xlsx.")
+    statement = ledger_statement(current_user.id, request.args) # bad filters fail here, before the response starts
+    stream = stream_xlsx if fmt == 'xlsx' else stream_csv
+    filename = f"Ledger-{request.args.get('start') or 'all'}-{request.args.get('end') or 'all'}.{fmt}"
+    return Response(stream_with_context(stream(ledger_rows(statement), batch_rows=app.config['LEDGER_FETCH_SIZE'])), mimetype=LEDGER_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}', 'X-Accel-Buffering': 'no'}) # no proxy buffering, rows reach the client as they are written
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_page(job_id):
+    job = job_queue.get(db.engine, job_id)
+    if not job or job['user_id'] != current_user.id: abort(404)
+    return render_template('job.html', job=job, result_url=job_result_url(job))
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = job_queue.get(db.engine, job_id)
+    if not job or job['user_id'] != current_user.id: abort(404)
+    return jsonify(id=job['id'], kind=job['kind'], status=job['status'], attempts=job['attempts'], error=job['error'], result_url=job_result_url(job))
+
+@app.route('/jobs/<int:job_id>/download')
+@login_required
+def download_job_result(job_id):
+    job = job_queue.get(db.engine, job_id)
+    if not job or job['user_id'] != current_user.id or job['kind'] != 'export' or job['status'] != 'done': abort(404)
+    if not blobs.exists(db.engine, job_output_key(job_id)): flash("This export has expired, please export again.", "warning"); return redirect(url_for('dashboard'))
+    return Response(blobs.read(db.engine, job_output_key(job_id)), mimetype='application/zip', # chunk by chunk, never the whole archive
+                    headers={'Content-Disposition': f"attachment; filename={job['result']['filename']}", 'Content-Length': str(job['result']['size'])})
+
+@app.route('/api/invoices', methods=['POST'])
+@login_required
+def api_create_invoices():
+    """Create many invoices in one transaction. Body: {"invoices": [...]} or a bare list; all or nothing."""
+    profile = get_profile(current_user.id)
+    if not profile: return jsonify(errors=["Create a company profile first."]), 409
+    body = request.get_json(silent=True)
+    payloads = body.get('invoices') if isinstance(body, dict) else body
+    if not isinstance(payloads, list) or not payloads: return jsonify(errors=["Expected a non-empty list of invoices."]), 400
+    if len(payloads) > app.config['INVOICE_BATCH_MAX']: return jsonify(errors=[f"At most {app.config['INVOICE_BATCH_MAX']} invoices per request."]), 413
+    if not all(isinstance(p, dict) for p in payloads): return jsonify(errors=["Each invoice must be an object."]), 400
+    try: created = create_invoices(current_user.id, profile, payloads)
+    except InvoiceValidationError as e: return jsonify(errors=e.errors), 422
+    return jsonify(invoices=[{k: str(v) if isinstance(v, Decimal) else v for k, v in row.items()} for row in created]), 201
+
+@app.route('/api/invoices/send', methods=['POST'])
+@login_required
+def api_send_invoices():
+    """Body: {"ids": [...]} -> {"deliveries": [...], "skipped": n}; follow progress on the invoices' payments pages or /api/invoices/deliveries."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('ids'), list) or not all(isinstance(i, int) for i in body['ids']):
+        return jsonify(errors=["Expected {\"ids\": [...]}."]), 400
+    if not app.config['SMTP_HOST']: return jsonify(errors=["Email is not configured."]), 503
+    queued, skipped = send_invoices(current_user.id, body['ids'])
+    return jsonify(deliveries=queued, skipped=skipped), 202
+
+@app.route('/api/invoices/deliveries')
+@login_required
+def api_invoice_deliveries():
+    """Delivery state: ?ids=1,2,3 (delivery ids as returned by /api/invoices/send) or ?invoice_id=."""
+    query = select(InvoiceDelivery.id, InvoiceDelivery.invoice_id, InvoiceDelivery.recipient, InvoiceDelivery.status, InvoiceDelivery.attempts, InvoiceDelivery.error, InvoiceDelivery.sent_at).where(InvoiceDelivery.user_id == current_user.id)
+    if request.args.get('ids'): query = query.where(InvoiceDelivery.id.in_([int(i) for i in request.args['ids'].split(',') if i.strip().isdigit()]))
+    elif request.args.get('invoice_id', type=int): query = query.where(InvoiceDelivery.invoice_id == request.args.get('invoice_id', type=int))
+    else: return jsonify(errors=["Pass ids or invoice_id."]), 400
+    rows = db.session.execute(query.order_by(InvoiceDelivery.id)).mappings().all()
+    return jsonify(deliveries=[dict(row, sent_at=row['sent_at'].isoformat() if row['sent_at'] else None) for row in rows])
+
+@app.route('/api/invoices/status', methods=['POST'])
+@login_required
+def api_invoice_status():
+    """Body: {"ids": [...], "status": "Paid", "date": "YYYY-MM-DD", "reference": "..."} -> {"moved": [...], "requested": n}."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('ids'), list) or not all(isinstance(i, int) for i in body['ids']):
+        return jsonify(errors=["Expected {\"ids\": [...], \"status\": ...}."]), 400
+    try: moved = transition_invoices(current_user.id, body['ids'], body.get('status', ''), parse_date(body.get('date')), (body.get('reference') or '')[:100] or None)
+    except InvoiceValidationError as e: db.session.rollback(); return jsonify(errors=e.errors), 422
+    except (ValueError, TypeError): db.session.rollback(); return jsonify(errors=["Invalid date."]), 400
+    db.session.commit()
+    return jsonify(moved=moved, requested=len(set(body['ids'])))
+
+@app.route('/api/cache-stats')
+@login_required
+def cache_stats():
+    """Hit/miss counters of this worker's in-process caches."""
+    return jsonify(identity=identity_cache.stats(), kpi=kpi_cache.stats(), pdf=pdf_cache.stats(), startup=STARTUP_TIMINGS,
+                   db_pools={key or 'primary': engine.pool.status() for key, engine in db.engines.items()})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint; needs `Authorization: Bearer $METRICS_TOKEN`."""
+    token = app.config['METRICS_TOKEN']
+    if not token: abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"): return Response("Unauthorized\n", 401, {'WWW-Authenticate': 'Bearer'})
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_data():
+    if request.method == 'POST':
+        upload = request.files.get('file'); kind = request.form.get('kind')
+        if not upload or not upload.filename: flash("Choose a CSV or JSONL file to import.", "error"); return redirect(url_for('import_data'))
+        if kind not in ('customers', 'invoices'): flash("Choose what to import.", "error"); return redirect(url_for('import_data'))
+        if kind == 'invoices' and not get_profile(current_user.id):
+            flash("Please create profile first.", "warning"); return redirect(url_for('profile'))
+        try: batch_size = max(1, int(request.form.get('batch_size') or app.config['IMPORT_BATCH_SIZE']))
+        except ValueError: batch_size = app.config['IMPORT_BATCH_SIZE']
+        fmt = detect_format(upload.filename, request.form.get('format'))
+        job = ImportJob(user_id=current_user.id, kind=kind, filename=upload.filename)
+        db.session.add(job); db.session.flush()
+        # into blob storage chunk by chunk (never whole in memory), so a worker on any host can read it
+        blobs.write(db.session.connection(), import_upload_key(job.id), iter(lambda: upload.stream.read(app.config['BLOB_CHUNK_SIZE']), b''))
+        db.session.commit()
+        enqueue_job(current_user.id, 'import', {'import_job_id': job.id, 'format': fmt, 'batch_size': batch_size}, max_attempts=1) # a partial import isn't safe to replay
+        return redirect(url_for('import_data', job=job.id))
+    jobs = ImportJob.query.filter_by(user_id=current_user.id).order_by(ImportJob.id.desc()).limit(10).all()
+    return render_template('import.html', jobs=jobs, active_job=request.args.get('job', type=int), batch_size=app.config['IMPORT_BATCH_SIZE'])
+
+@app.route('/import/<int:job_id>')
+@login_required
+def import_status(job_id):
+    job = ImportJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return jsonify(job.to_dict())
+
+def parse_month(value):
+    """'YYYY-MM' (from <input type=month>) to the first day of that month; None when empty or invalid."""
+    try: return datetime.date.fromisoformat(f"{value}-01") if value else None
+    except ValueError: return None
+
+@app.route('/reports/gst')
+@login_required
+@reads_from_replica
+def gst_reports():
+    profile = get_profile(current_user.id)
+    if not profile: flash("Please create profile first.", "warning"); return redirect(url_for('profile'))
+    group = request.args.get('group', 'rate')
+    if group not in GST_REPORT_GROUPS: group = 'rate'
+    start = parse_month(request.args.get('start')); end = parse_month(request.args.get('end'))
+    rows = gst_report(current_user.id, group, start, end)
+    if request.args.get('format') == 'csv':
+        buffer = io.StringIO(); writer = csv.writer(buffer)
+        # invoice_count is per tax rate, so summing it across rates (customer/place views) would double count
+        with_count = group == 'rate'
+        writer.writerow(['month', {'rate': 'tax_percent', 'customer': 'customer_gstin', 'place': 'place_of_supply'}[group], *(['invoice_count'] if with_count else []), 'taxable_amount', 'gst_amount'])
+        for month, key, count, taxable, gst in rows: writer.writerow([month.strftime('%Y-%m'), key, *([count] if with_count else []), f"{taxable:.2f}", f"{gst:.2f}"])
+        return Response(buffer.getvalue(), mimetype='text/csv', headers={'Content-Disposition': f'attachment; filename=gst-{group}.csv'})
+    return render_template('reports.html', rows=rows, group=group, profile=profile, start=request.args.get('start', ''), end=request.args.get('end', ''))
 
 # -----------------------------
 # AUTHENTICATION ROUTES
@@ -588,6 +1916,85 @@ def logout():
 # -----------------------------
 # END AUTHENTICATION ROUTES
 # -----------------------------
+
+# -----------------------------
+# CLI COMMANDS
+# -----------------------------
+import click
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and indexes (safe to re-run; part of every deploy)."""
+    init_db()
+    click.echo(f"Schema is up to date (customer search: {app.config['CUSTOMER_SEARCH_BACKEND']}).")
+
+@app.cli.command('cold-start')
+@click.option('--runs', default=5, show_default=True)
+@click.option('--path', default='/login', show_default=True, help="Page to request first.")
+def cold_start_command(runs, path):
+    """Measure import time, then time to the first response, in fresh interpreters."""
+    import subprocess, sys, statistics
+    probe = ("import time; t0 = time.perf_counter(); import app; t1 = time.perf_counter(); "
+             f"app.app.test_client().get({path!r}); t2 = time.perf_counter(); "
+             "import sys; print(t1 - t0, t2 - t1, 'reportlab' in sys.modules)")
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        results.append((float(out[-3]), float(out[-2]), out[-1] == 'True'))
+    for label, values in (('import', [r[0] for r in results]), ('first response', [r[1] for r in results])):
+        click.echo(f"{label:>15}: median {statistics.median(values) * 1000:.0f} ms, max {max(values) * 1000:.0f} ms")
+    click.echo(f"ReportLab loaded at first response: {'yes' if any(r[2] for r in results) else 'no'}")
+
+@app.cli.command('migrate-native-types')
+@click.argument('step', type=click.Choice(['status', *NATIVE_TYPES_STEPS]))
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per backfill transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between backfill batches.')
+def migrate_native_types(step, batch_size, pause):
+    """Convert invoice dates to DATE and money to NUMERIC (expand -> backfill -> switch -> cleanup)."""
+    if step == 'status':
+        click.echo(f"state: {native_types_state(db.engine)}; unconverted rows: {native_types_check(db.engine) or 'none'}"); return
+    if step == 'backfill': NATIVE_TYPES_STEPS[step](db.engine, batch_size=batch_size, pause=pause, log=click.echo)
+    else: NATIVE_TYPES_STEPS[step](db.engine, log=click.echo)
+
+@app.cli.command('rebuild-gst-rollups')
+@click.option('--user-id', type=int, help='Only rebuild this user (default: everyone).')
+def rebuild_gst_rollups_command(user_id):
+    """Recompute the GST reporting rollup from stored tax lines (run rebuild-tax-summaries first on old data)."""
+    rebuild_gst_rollups(user_id); db.session.commit()
+    click.echo("GST rollups rebuilt.")
+
+@app.cli.command('rebuild-tax-summaries')
+@click.option('--batch-size', default=500, show_default=True)
+def rebuild_tax_summaries(batch_size):
+    """Write the stored tax breakdown for invoices that do not have one yet."""
+    done = 0
+    while True:
+        batch = (Invoice.query.filter(~Invoice.tax_lines.any()).filter(Invoice.items.any())
+                 .options(selectinload(Invoice.items)).order_by(Invoice.id).limit(batch_size).all())
+        if not batch: break
+        for invoice in batch: set_tax_lines(invoice, invoice.items)
+        db.session.commit(); done += len(batch)
+        click.echo(f"{done} invoices updated")
+
+@app.cli.command('sweep-overdue')
+@click.option('--user-id', type=int, help='Only sweep this user (default: everyone).')
+def sweep_overdue_command(user_id):
+    """Mark Sent invoices past their due date Overdue (schedule daily; dashboards also sweep on view)."""
+    count = sweep_overdue(user_id); db.session.commit()
+    click.echo(f"{count} invoice(s) marked Overdue.")
+
+@app.cli.command('run-jobs')
+@click.option('--threads', default=None, type=int, help="Worker threads (default JOB_WORKERS).")
+def run_jobs(threads):
+    """Run background jobs in this process until interrupted."""
+    worker = JobWorker(job_queue, JOB_HANDLERS, app.app_context, lambda: db.engine,
+                       threads=threads or max(app.config['JOB_WORKERS'], 1), poll_interval=app.config['JOB_POLL_INTERVAL'])
+    click.echo(f"Running jobs with {worker.threads} thread(s), Ctrl+C to stop.")
+    worker.run_forever()
+
+STARTUP_TIMINGS['import'] = time.perf_counter() - BOOT_STARTED
+WORKER_STARTED = time.perf_counter() # reset by worker_started() in forked workers
+
 # --- ADDED DEVELOPMENT SERVER BLOCK FOR LOCAL TESTING ---
 if __name__ == "__main__":
     is_debug = os.environ.get('FLASK_DEBUG') == '1' or app.debug
@@ -600,6 +2007,7 @@ if __name__ == "__main__":
                    try: webbrowser.open("http://122.170.106.196:5000/profile")
                    except Exception as e: print(f"Could not open browser: {e}")
          threading.Thread(target=open_browser).start()
+    with app.app_context(): init_db()
     # Run with debug=True for local testing on http://122.170.106.196:5000
     app.run(debug=True, host='127.0.0.1', port=5000)
-# --- END DEVELOPMENT SERVER BLOCK ---
\ No newline at end of file
+# --- END DEVELOPMENT SERVER BLOCK ---
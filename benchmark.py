@@ -0,0 +1,460 @@
+# -----------------------------
+# BENCHMARK SUITE
+# -----------------------------
+# Reproducible latency numbers for the hot routes, so a change can be compared
+# against a stored baseline before it ships.
+#
+#   python benchmark.py generate --database-url sqlite:///bench.db --users 2 --customers 500 --invoices 20000
+#   python benchmark.py run --database-url sqlite:///bench.db --requests 200 --output result.json
+#   python benchmark.py run --database-url sqlite:///bench.db --url http://127.0.0.1:8000 --server-pid 1234 --concurrency 8
+#   python benchmark.py compare baseline.json result.json
+#   python benchmark.py pdf --items 100,500,1000,2000,5000
+#   python benchmark.py email --count 1000 [--smtp localhost:8025]
+#
+# `run` drives the real routes through the Flask test client (in-process, with
+# SQL query counts) or, with --url, a running server over HTTP with concurrent
+# clients. Either way it reads the generated tenant from --database-url to pick
+# invoice ids and cursors. Results are JSON: p50/p95/p99/mean latency in ms,
+# throughput, errors, SQL queries per request (test client only) and the
+# server's peak RSS during each scenario, sampled from /proc: this process with
+# the test client, --server-pid and its children (e.g. the gunicorn master and
+# workers, shared pages counted once per process) over HTTP, else null.
+#
+# `pdf` renders synthetic invoices of growing item counts straight through
+# pdf_renderer (no database) in each layout and reports render time, time per
+# item, page count and peak Python memory, to check that large invoices scale
+# linearly.
+#
+# `email` sends `count` invoice emails (one real rendered PDF attached to each)
+# through mailer.SmtpBatch, once reusing the connection as the email job does
+# and once connecting per message, and reports messages per second. It targets
+# --smtp, or starts an in-process aiosmtpd sink when aiosmtpd is installed.
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+BENCH_PASSWORD = 'bench'
+TAX_RATES = (0, 5, 12, 18, 28)
+STATES = ('MH', 'KA', 'TN', 'DL', 'GJ', 'UP', 'WB', 'RJ')
+WORDS = ('Steel', 'Textiles', 'Agro', 'Pharma', 'Logistics', 'Traders', 'Foods', 'Motors', 'Plastics', 'Electricals', 'Paper', 'Chemicals')
+
+
+def load_app(database_url):
+    """Import app.py against `database_url`; the URL is read at import time."""
+    if database_url: os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as appmod
+    appmod.app.config['TESTING'] = True
+    return appmod
+
+
+def process_tree(pid):
+    """`pid` and all its descendants (Linux /proc)."""
+    pids = [pid]
+    for p in pids:
+        for task in os.listdir(f"/proc/{p}/task") if os.path.isdir(f"/proc/{p}/task") else ():
+            try:
+                with open(f"/proc/{p}/task/{task}/children") as f: pids.extend(int(c) for c in f.read().split())
+            except OSError: pass
+    return pids
+
+
+def rss_mb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f: total += next((int(line.split()[1]) for line in f if line.startswith('VmRSS:')), 0) # kB
+        except OSError: pass # exited since listed
+    return total / 1024
+
+
+class RssSampler:
+    """Peak resident memory of a process tree while a scenario runs, sampled every `interval` seconds."""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid if pid and os.path.exists(f"/proc/{pid}/status") else None
+        self.interval = interval; self.peak = None
+        self._stop = threading.Event(); self._thread = None
+
+    def _sample(self):
+        rss = rss_mb(process_tree(self.pid))
+        self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval): self._sample()
+
+    def __enter__(self):
+        if self.pid:
+            self._sample(); self._thread = threading.Thread(target=self._run, daemon=True); self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread:
+            self._stop.set(); self._thread.join(); self._sample()
+
+    def result(self): return round(self.peak, 1) if self.peak is not None else None
+
+
+# -----------------------------
+# DATA GENERATOR
+# -----------------------------
+def generate(appmod, users, customers, invoices, items, seed=1, batch_size=500, log=print):
+    """Fill the database with `users` tenants, each with the given number of customers and invoices."""
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    db = appmod.db; rnd = random.Random(seed)
+    password_hash = generate_password_hash(BENCH_PASSWORD) # hashing is deliberately slow, do it once
+    with appmod.app.app_context():
+        appmod.init_db()
+        if appmod.User.query.filter_by(email='bench0@example.com').first():
+            raise SystemExit("Benchmark data already exists in this database; generate into a fresh one.")
+        for u in range(users):
+            started = time.perf_counter()
+            user = appmod.User(username=f'bench{u}', email=f'bench{u}@example.com', password_hash=password_hash)
+            db.session.add(user); db.session.flush()
+            profile = appmod.CompanyProfile(name=f'Bench Co {u}', address=f'{u} Bench Street\nMumbai', gstin=f'27BENCH{u:05d}Z1', pan=f'BENCH{u:05d}',
+                                            email=f'bench{u}@example.com', phone='0000000000', currency='INR', date_format='DD/MM/YYYY',
+                                            terms_and_conditions='Payment due in 30 days.', user_id=user.id)
+            db.session.add(profile); db.session.flush()
+            rows = [{'name': f"{rnd.choice(WORDS)} {rnd.choice(WORDS)} {n}", 'billing_address': f"{n} Market Road", 'gstin': f"{rnd.randint(1, 37):02d}CUST{u:03d}{n:06d}",
+                     'state': rnd.choice(STATES), 'contact_person': f"Contact {n}", 'user_id': user.id} for n in range(customers)]
+            customer_ids = db.session.execute(insert(appmod.Customer).returning(appmod.Customer.id, sort_by_parameter_order=True), rows).scalars().all()
+            db.session.commit()
+            start_date = appmod.datetime.date.today() - appmod.datetime.timedelta(days=730)
+            for first in range(0, invoices, batch_size):
+                validated = []
+                for n in range(first, min(first + batch_size, invoices)):
+                    payload = {'invoice_no': f"B{u}-{n:07d}", 'date': str(start_date + appmod.datetime.timedelta(days=rnd.randrange(730))),
+                               'customer_id': rnd.choice(customer_ids), 'place_of_supply': rnd.choice(STATES),
+                               'items': [{'name': f"{rnd.choice(WORDS)} item {k}", 'hsn': str(rnd.randint(1000, 9999)), 'qty': rnd.randint(1, 50),
+                                          'unit': 'pcs', 'rate': f"{rnd.uniform(10, 5000):.2f}", 'tax_percent': rnd.choice(TAX_RATES)} for k in range(items)]}
+                    validated.append(appmod._validate_invoice(payload, payload['invoice_no']))
+                appmod._insert_invoices(user.id, profile.id, validated)
+                db.session.commit()
+            log(f"tenant bench{u}: {customers} customers, {invoices} invoices x {items} items in {time.perf_counter() - started:.1f}s")
+
+
+# -----------------------------
+# SCENARIOS
+# -----------------------------
+# Each returns (method, path, json_body) for the i-th request. Writes go last so
+# they don't change the data the read scenarios see within a run.
+def _pick(ids, i): return ids[i % len(ids)]
+
+SCENARIOS = {
+    'dashboard': lambda ctx, i: ('GET', '/dashboard', None),
+    'dashboard_deep_page': lambda ctx, i: ('GET', f"/dashboard?after={ctx['deep_cursor']}", None),
+    'view_invoice': lambda ctx, i: ('GET', f"/invoice/view/{_pick(ctx['invoice_ids'], i)}", None),
+    'pdf_cached': lambda ctx, i: ('GET', f"/invoice/pdf/{_pick(ctx['invoice_ids'][:5], i)}", None), # warm-up renders these
+    'pdf_render': lambda ctx, i: ('GET', f"/invoice/pdf/{_pick(ctx['invoice_ids'][5:], i)}", None), # a different invoice every time
+    'customer_search': lambda ctx, i: ('GET', f"/api/customers/search?q={urllib.parse.quote(_pick(ctx['search_terms'], i))}", None),
+    'customers_page': lambda ctx, i: ('GET', '/customers', None),
+    'gst_report': lambda ctx, i: ('GET', '/reports/gst', None),
+    'create_invoice': lambda ctx, i: ('POST', '/api/invoices', [{'date': ctx['today'], 'customer_id': _pick(ctx['customer_ids'], i),
+                                                                 'items': [{'name': 'Bench item', 'qty': 1, 'rate': '100.00', 'tax_percent': 18}]}]),
+}
+
+
+def build_context(appmod, tenant):
+    """Ids and cursors of one generated tenant, read straight from the database."""
+    with appmod.app.app_context():
+        user = appmod.User.query.filter_by(email=f'bench{tenant}@example.com').first()
+        if not user: raise SystemExit(f"No benchmark tenant {tenant}; run `benchmark.py generate` first.")
+        Invoice = appmod.Invoice
+        newest = Invoice.query.filter_by(user_id=user.id).order_by(Invoice.date.desc(), Invoice.id.desc())
+        deep = newest.offset(min(newest.count() - 1, 100 * appmod.app.config['DASHBOARD_PAGE_SIZE'])).first()
+        invoice_ids = [i for (i,) in appmod.db.session.query(Invoice.id).filter_by(user_id=user.id).order_by(Invoice.id)]
+        random.Random(tenant).shuffle(invoice_ids)
+        customers = appmod.Customer.query.filter_by(user_id=user.id).order_by(appmod.Customer.id).limit(200).all()
+        return {'email': user.email, 'invoice_ids': invoice_ids, 'deep_cursor': appmod.encode_cursor(deep),
+                'customer_ids': [c.id for c in customers], 'search_terms': sorted({c.name.split()[0][:4].lower() for c in customers}),
+                'today': str(appmod.datetime.date.today())}
+
+
+# -----------------------------
+# DRIVERS
+# -----------------------------
+class TestClientDriver:
+    """In-process requests through app.test_client(); counts SQL statements."""
+    server_pid = os.getpid()
+
+    def __init__(self, appmod, email):
+        from sqlalchemy import event
+        self.appmod = appmod; self.email = email
+        self.queries = 0; self._lock = threading.Lock()
+        with appmod.app.app_context():
+            event.listen(appmod.db.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        with self._lock: self.queries += 1
+
+    def client(self):
+        client = self.appmod.app.test_client()
+        client.post('/login', data={'email': self.email, 'password': BENCH_PASSWORD})
+        def request(method, path, body):
+            return client.open(path, method=method, json=body).status_code
+        return request
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args): return None # report 302s instead of following them
+
+
+class HttpDriver:
+    """Requests against a running server; each client keeps its own session cookie."""
+    queries = None
+
+    def __init__(self, base_url, email, server_pid=None):
+        self.base_url = base_url.rstrip('/'); self.email = email
+        self.server_pid = server_pid # RSS is only reported when the server runs on this machine
+
+    def client(self):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect)
+        def request(method, path, body):
+            data = json.dumps(body).encode() if body is not None else None
+            req = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'} if data else {})
+            try:
+                with opener.open(req, timeout=60) as response: response.read(); return response.status
+            except urllib.error.HTTPError as e: return e.code
+        login = urllib.parse.urlencode({'email': self.email, 'password': BENCH_PASSWORD}).encode()
+        try: opener.open(urllib.request.Request(self.base_url + '/login', data=login, method='POST'), timeout=60)
+        except urllib.error.HTTPError as e:
+            if e.code != 302: raise
+        return request
+
+
+def run_scenario(driver, ctx, name, requests, concurrency, warmup):
+    build = SCENARIOS[name]
+    clients = [driver.client() for _ in range(concurrency)]
+    for i in range(warmup): clients[0](*build(ctx, i))
+    latencies = []; errors = 0; lock = threading.Lock(); counter = iter(range(warmup, warmup + requests))
+    queries_before = driver.queries
+
+    def worker(request):
+        nonlocal errors
+        while True:
+            with lock: i = next(counter, None)
+            if i is None: return
+            method, path, body = build(ctx, i)
+            t0 = time.perf_counter(); status = request(method, path, body); elapsed = time.perf_counter() - t0
+            with lock:
+                latencies.append(elapsed * 1000)
+                if status >= 400: errors += 1
+
+    with RssSampler(driver.server_pid) as rss:
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(c,)) for c in clients]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        wall = time.perf_counter() - started
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(latencies), 'errors': errors, 'concurrency': concurrency,
+        'p50_ms': round(cuts[49], 2), 'p95_ms': round(cuts[94], 2), 'p99_ms': round(cuts[98], 2),
+        'mean_ms': round(statistics.fmean(latencies), 2), 'throughput_rps': round(len(latencies) / wall, 1),
+        'sql_queries_per_request': round((driver.queries - queries_before) / len(latencies), 2) if driver.queries is not None else None,
+        'peak_rss_mb': rss.result(),
+    }
+
+
+# -----------------------------
+# PDF SCALING
+# -----------------------------
+def synthetic_document(items, seed=1):
+    """An invoice_document()-shaped dict with `items` line items; every seventh name is long enough to wrap."""
+    from decimal import Decimal
+    import datetime
+    rnd = random.Random(seed)
+    lines = [{'name': f"{rnd.choice(WORDS)} {rnd.choice(WORDS)} item {n}" + (" with an extended wholesale description that wraps onto a second line" if n % 7 == 0 else ''),
+              'hsn': str(rnd.randint(1000, 9999)), 'qty': rnd.randint(1, 50), 'unit': 'pcs',
+              'rate': Decimal(f"{rnd.uniform(10, 5000):.2f}"), 'tax_percent': Decimal(rnd.choice(TAX_RATES))} for n in range(items)]
+    subtotal = sum(line['qty'] * line['rate'] for line in lines)
+    total_gst = sum(line['qty'] * line['rate'] * line['tax_percent'] / 100 for line in lines).quantize(Decimal('0.01'))
+    return {'invoice_no': 'BENCH-1', 'date': datetime.date(2024, 4, 1), 'po_number': None, 'po_date': None, 'eway_bill_no': None,
+            'place_of_supply': 'MH', 'transport_name': None, 'vehicle_no': None, 'delivery_location': None,
+            'subtotal': subtotal, 'total_gst': total_gst, 'grand_total': subtotal + total_gst,
+            'profile': {'name': 'Bench Co', 'address': '1 Bench Street\nMumbai', 'gstin': '27BENCH00000Z1', 'phone': '0000000000', 'email': 'bench@example.com',
+                        'bank_name': None, 'account_no': None, 'ifsc_code': None, 'terms_and_conditions': 'Payment due in 30 days.', 'currency': 'INR', 'date_format': 'DD/MM/YYYY'},
+            'customer': {'name': 'Bench Customer', 'billing_address': '2 Market Road', 'shipping_address': None, 'gstin': '27CUST000000001', 'state': 'MH'},
+            'items': lines}
+
+
+def pdf_scaling(sizes, layouts, repeat=3):
+    """{layout: {items: result}} for 'standard', 'large' or 'auto' (the renderer's own choice).
+
+    Time is the median of `repeat` renders; memory is measured in one extra traced render.
+    """
+    import tracemalloc
+    from pdf_renderer import render_invoice_pdf, warm_up
+    warm_up()
+    results = {}
+    for layout in layouts:
+        results[layout] = {}
+        for size in sizes:
+            document = synthetic_document(size); seconds = []; forced = None if layout == 'auto' else layout
+            for _ in range(repeat):
+                t0 = time.perf_counter(); pdf = render_invoice_pdf(document, layout=forced); seconds.append(time.perf_counter() - t0)
+            tracemalloc.start(); render_invoice_pdf(document, layout=forced); peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+            median = statistics.median(seconds)
+            results[layout][size] = {'seconds': round(median, 3), 'ms_per_item': round(median * 1000 / size, 3), 'pages': pdf.count(b'/Type /Page\n'),
+                                     'pdf_bytes': len(pdf), 'peak_python_mb': round(peak / 1e6, 1)}
+            print(f"{layout:<9}{size:>7} items {median:>8.3f} s {results[layout][size]['ms_per_item']:>7} ms/item {results[layout][size]['pages']:>5} pages"
+                  f" {results[layout][size]['peak_python_mb']:>7} MB", file=sys.stderr)
+    return results
+
+
+# -----------------------------
+# EMAIL THROUGHPUT
+# -----------------------------
+def smtp_sink():
+    """Start an aiosmtpd server that accepts and discards everything; returns (controller, host, port)."""
+    try:
+        from aiosmtpd.controller import Controller
+    except ImportError:
+        raise SystemExit("aiosmtpd is not installed: pip install aiosmtpd, or pass --smtp host:port")
+    class Sink:
+        async def handle_DATA(self, server, session, envelope): return '250 OK'
+    controller = Controller(Sink(), hostname='127.0.0.1', port=0); controller.start()
+    return controller, controller.hostname, controller.server.sockets[0].getsockname()[1]
+
+
+def email_throughput(host, port, count, modes, rate_limit=0):
+    """{mode: result} for 'reuse' (one connection for the whole send) and 'per_message' (a new connection each time)."""
+    from mailer import SmtpBatch, build_message
+    from pdf_renderer import render_invoice_pdf
+    pdf = render_invoice_pdf(synthetic_document(10))
+    results = {}
+    for mode in modes:
+        batch = SmtpBatch(host, port, security='none', rate_limit=rate_limit, max_per_connection=count if mode == 'reuse' else 1)
+        t0 = time.perf_counter(); errors = 0
+        with batch:
+            for n in range(count):
+                message = build_message('Bench Co <bench@example.com>', f"customer{n}@example.com", f"Invoice BENCH-{n}", "Please find your invoice attached.\n", f"Invoice-BENCH-{n}.pdf", pdf)
+                try: batch.send(message)
+                except Exception: errors += 1
+        seconds = time.perf_counter() - t0
+        results[mode] = {'messages': count, 'seconds': round(seconds, 3), 'messages_per_second': round(count / seconds, 1),
+                         'connections': batch.connections, 'errors': errors, 'pdf_bytes': len(pdf)}
+        print(f"{mode:<12}{count:>6} messages {seconds:>8.3f} s {results[mode]['messages_per_second']:>8} msg/s {batch.connections:>6} connections", file=sys.stderr)
+    return results
+
+
+# -----------------------------
+# BASELINE COMPARISON
+# -----------------------------
+def compare(baseline, current, max_regression):
+    """Print a per-scenario comparison; returns the list of regressions."""
+    regressions = []
+    print(f"{'scenario':<22}{'p95 base':>10}{'p95 now':>10}{'change':>9}{'sql base':>10}{'sql now':>9}")
+    for name, now in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if not base: print(f"{name:<22}{'-':>10}{now['p95_ms']:>10}{'new':>9}"); continue
+        change = (now['p95_ms'] - base['p95_ms']) / base['p95_ms'] if base['p95_ms'] else 0.0
+        print(f"{name:<22}{base['p95_ms']:>10}{now['p95_ms']:>10}{change:>+9.1%}{str(base['sql_queries_per_request']):>10}{str(now['sql_queries_per_request']):>9}")
+        if change > max_regression: regressions.append(f"{name}: p95 {base['p95_ms']} -> {now['p95_ms']} ms ({change:+.1%})")
+        if None not in (base['sql_queries_per_request'], now['sql_queries_per_request']) and now['sql_queries_per_request'] > base['sql_queries_per_request'] + 0.5:
+            regressions.append(f"{name}: SQL queries per request {base['sql_queries_per_request']} -> {now['sql_queries_per_request']}")
+        if now['errors'] > base['errors']: regressions.append(f"{name}: {now['errors']} errors (baseline {base['errors']})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest='command', required=True)
+    gen = sub.add_parser('generate', help="Create synthetic tenants.")
+    gen.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    gen.add_argument('--users', type=int, default=1); gen.add_argument('--customers', type=int, default=200)
+    gen.add_argument('--invoices', type=int, default=5000); gen.add_argument('--items', type=int, default=5)
+    gen.add_argument('--seed', type=int, default=1)
+    run = sub.add_parser('run', help="Run scenarios and print JSON results.")
+    run.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    run.add_argument('--url', help="Benchmark a running server instead of the in-process test client.")
+    run.add_argument('--server-pid', type=int, help="With --url: PID of the local server (e.g. the gunicorn master) to sample RSS from.")
+    run.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="Repeatable; default all.")
+    run.add_argument('--requests', type=int, default=100); run.add_argument('--concurrency', type=int, default=1)
+    run.add_argument('--warmup', type=int, default=5); run.add_argument('--tenant', type=int, default=0)
+    run.add_argument('--output', help="Also write the JSON result here.")
+    cmp = sub.add_parser('compare', help="Fail when a result regresses against a baseline.")
+    cmp.add_argument('baseline'); cmp.add_argument('current')
+    cmp.add_argument('--max-regression', type=float, default=0.15, help="Allowed p95 slowdown as a fraction.")
+    pdf = sub.add_parser('pdf', help="Render synthetic invoices of growing size and print JSON timings.")
+    pdf.add_argument('--items', default='100,500,1000,2000,5000', help="Comma-separated line item counts.")
+    pdf.add_argument('--layout', action='append', choices=('auto', 'standard', 'large'), help="Repeatable; default standard and large.")
+    pdf.add_argument('--repeat', type=int, default=3)
+    pdf.add_argument('--output', help="Also write the JSON result here.")
+    email = sub.add_parser('email', help="Measure invoice email throughput in messages per second.")
+    email.add_argument('--count', type=int, default=1000)
+    email.add_argument('--smtp', help="host:port of a test SMTP server (default: an in-process aiosmtpd sink).")
+    email.add_argument('--mode', action='append', choices=('reuse', 'per_message'), help="Repeatable; default both.")
+    email.add_argument('--rate-limit', type=float, default=0, help="Messages per second; 0 = unpaced.")
+    email.add_argument('--output', help="Also write the JSON result here.")
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.baseline) as f: baseline = json.load(f)
+        with open(args.current) as f: current = json.load(f)
+        regressions = compare(baseline, current, args.max_regression)
+        for line in regressions: print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+
+    if args.command == 'pdf':
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        sizes = [int(n) for n in args.items.split(',')]
+        layouts = args.layout or ['standard', 'large']
+        output = {'meta': {'python': sys.version.split()[0], 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+                  'pdf': pdf_scaling(sizes, layouts, args.repeat)}
+        print(json.dumps(output, indent=2))
+        if args.output:
+            with open(args.output, 'w') as f: json.dump(output, f, indent=2)
+        return 0
+
+    if args.command == 'email':
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        controller = None
+        if args.smtp: host, _, port = args.smtp.rpartition(':'); port = int(port)
+        else: controller, host, port = smtp_sink()
+        try:
+            output = {'meta': {'python': sys.version.split()[0], 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'smtp': f"{host}:{port}"},
+                      'email': email_throughput(host, port, args.count, args.mode or ['reuse', 'per_message'], args.rate_limit)}
+        finally:
+            if controller: controller.stop()
+        print(json.dumps(output, indent=2))
+        if args.output:
+            with open(args.output, 'w') as f: json.dump(output, f, indent=2)
+        return 0
+
+    appmod = load_app(args.database_url)
+    if args.command == 'generate':
+        generate(appmod, args.users, args.customers, args.invoices, args.items, seed=args.seed)
+        return 0
+
+    ctx = build_context(appmod, args.tenant)
+    driver = HttpDriver(args.url, ctx['email'], args.server_pid) if args.url else TestClientDriver(appmod, ctx['email'])
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        if name == 'pdf_render' and not args.url: appmod.pdf_cache.clear()
+        results[name] = run_scenario(driver, ctx, name, args.requests, args.concurrency, args.warmup)
+        print(f"{name:<22} p50 {results[name]['p50_ms']:>8} ms  p95 {results[name]['p95_ms']:>8} ms  {results[name]['throughput_rps']:>7} req/s", file=sys.stderr)
+    with appmod.app.app_context(): database = appmod.db.engine.url.render_as_string(hide_password=True)
+    output = {'meta': {'mode': 'http' if args.url else 'test_client', 'url': args.url, 'database': database,
+                       'tenant': args.tenant, 'invoices': len(ctx['invoice_ids']), 'requests': args.requests, 'concurrency': args.concurrency,
+                       'python': sys.version.split()[0], 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'scenarios': results}
+    print(json.dumps(output, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(output, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# -----------------------------
+# SHARED BLOB STORAGE
+# -----------------------------
+# Files that must be readable from every process and host -- export ZIPs, PDFs
+# rendered by a job, uploaded import files -- are kept in the database as
+# numbered chunk rows of at most `chunk_size` bytes. write() consumes an
+# iterable of bytes and inserts one chunk at a time on the caller's connection
+# (so it can run while that connection is still streaming the rows the file is
+# built from; the caller commits); read() yields them back one SELECT per chunk,
+# without holding a pooled connection in between. Neither
+# side ever has more than one chunk in memory, however large the file.
+import datetime
+
+from sqlalchemy import delete, insert, select
+
+
+class BlobStore:
+    def __init__(self, table, chunk_size=1024 * 1024):
+        self.table = table # columns: key, seq, data, created_at
+        self.chunk_size = chunk_size
+
+    def write(self, conn, key, chunks):
+        """Store `chunks` (an iterable of bytes) under `key` on `conn`, replacing what was there; returns the size in bytes. Caller commits."""
+        conn.execute(delete(self.table).where(self.table.c.key == key))
+        buffer = bytearray(); seq = 0; size = 0
+        for piece in chunks:
+            buffer += piece; size += len(piece)
+            while len(buffer) >= self.chunk_size:
+                self._put(conn, key, seq, bytes(buffer[:self.chunk_size])); del buffer[:self.chunk_size]; seq += 1
+        if buffer or seq == 0: self._put(conn, key, seq, bytes(buffer))
+        return size
+
+    def _put(self, conn, key, seq, data):
+        conn.execute(insert(self.table).values(key=key, seq=seq, data=data, created_at=datetime.datetime.utcnow()))
+
+    def read(self, engine, key):
+        """Yield the blob's chunks in order (nothing if it does not exist)."""
+        t = self.table; seq = 0
+        while True:
+            with engine.connect() as conn:
+                data = conn.execute(select(t.c.data).where(t.c.key == key, t.c.seq == seq)).scalar()
+            if data is None: return
+            yield data; seq += 1
+
+    def load(self, engine, key):
+        """The whole blob as bytes, or None; only for small ones such as a single PDF."""
+        chunks = list(self.read(engine, key))
+        return b''.join(chunks) if chunks else None
+
+    def exists(self, engine, key):
+        t = self.table
+        with engine.connect() as conn:
+            return conn.execute(select(t.c.seq).where(t.c.key == key, t.c.seq == 0)).first() is not None
+
+    def delete(self, engine, key):
+        with engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.key == key))
+
+    def expire(self, engine, before, prefix=''):
+        """Delete blobs (whose key starts with `prefix`) written before `before`."""
+        t = self.table
+        old = select(t.c.key).where(t.c.seq == 0, t.c.created_at < before, t.c.key.startswith(prefix, autoescape=True))
+        with engine.begin() as conn:
+            conn.execute(delete(t).where(t.c.key.in_(old)))
@@ -0,0 +1,106 @@
+# -----------------------------
+# BULK PDF EXPORT
+# -----------------------------
+# Renders many invoices in a process pool (ReportLab layout is CPU-bound and
+# holds the GIL) and streams them out as a ZIP while the pool keeps working.
+# At most `window` documents are in flight at once and each finished PDF is
+# written and yielded straight away, so memory stays flat however many invoices
+# are selected. pdf_renderer (and with it ReportLab) is only imported once an
+# export actually starts.
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+
+def get_render_pool(processes=None):
+    """Process pool shared by every export in this worker, created on first use."""
+    global _pool, _pool_size
+    if _pool is None:
+        from pdf_renderer import warm_up
+        with _pool_lock:
+            if _pool is None:
+                _pool_size = processes or os.cpu_count() or 1
+                _pool = ProcessPoolExecutor(max_workers=_pool_size, initializer=warm_up)
+    return _pool
+
+
+class _ChunkSink:
+    """Write-only file object for ZipFile. Without seek()/tell() ZipFile writes data descriptors, so entries can be streamed."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks); self._chunks = []
+        return data
+
+
+def export_filename(invoice_no, seen):
+    name = f"Invoice-{str(invoice_no).replace('/', '-').replace(chr(92), '-')}.pdf"
+    if name in seen:
+        stem, n = name[:-4], 2
+        while f"{stem}-{n}.pdf" in seen: n += 1
+        name = f"{stem}-{n}.pdf"
+    seen.add(name)
+    return name
+
+
+def stream_pdf_zip(entries, cache=None, processes=None, window=None):
+    """Yield a ZIP archive of rendered PDFs chunk by chunk.
+
+    `entries` is an iterable of (user_id, invoice_id, invoice_no, document, key)
+    tuples; it is consumed lazily. When `cache` (a PdfCache) is given, cached
+    PDFs are written without touching the pool and fresh renders are stored.
+    """
+    from pdf_renderer import render_invoice_pdf
+    pool = get_render_pool(processes)
+    window = window or 2 * _pool_size
+    sink = _ChunkSink(); seen = set(); failures = []
+    timestamp = time.localtime(time.time())[:6]
+    pending = {}
+    entries = iter(entries)
+    exhausted = False
+
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zf: # PDF page streams are already deflated
+        def add(invoice_no, data):
+            zf.writestr(zipfile.ZipInfo(export_filename(invoice_no, seen), date_time=timestamp), data)
+
+        while pending or not exhausted:
+            while not exhausted and len(pending) < window:
+                try: user_id, invoice_id, invoice_no, document, key = next(entries)
+                except StopIteration: exhausted = True; break
+                cached = cache.get(user_id, invoice_id, key) if cache else None
+                if cached is not None:
+                    add(invoice_no, cached)
+                    yield sink.drain()
+                    continue
+                pending[pool.submit(render_invoice_pdf, document)] = (user_id, invoice_id, invoice_no, key)
+            if not pending:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                user_id, invoice_id, invoice_no, key = pending.pop(future)
+                try: data = future.result()
+                except Exception as e:
+                    print(f"ERROR building PDF for invoice {invoice_no}: {e}"); failures.append(f"{invoice_no}: {e}")
+                    continue
+                if cache: cache.put(user_id, invoice_id, key, data)
+                add(invoice_no, data)
+            yield sink.drain()
+
+        if failures:
+            zf.writestr(zipfile.ZipInfo('errors.txt', date_time=timestamp), '\n'.join(failures) + '\n')
+    yield sink.drain()
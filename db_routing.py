@@ -0,0 +1,55 @@
+# -----------------------------
+# READ REPLICA ROUTING & POOLS
+# -----------------------------
+# RoutingSession sends plain SELECTs to a read replica once a view has opted in
+# by putting the replica's bind key in session.info['replica']. Everything else
+# goes to the primary: INSERT/UPDATE/DELETE, flushes, SELECT ... FOR UPDATE,
+# raw text() statements, and every statement after the first write, so a view
+# always reads what it has just written. The session notes that write in
+# info['wrote'] for the app to keep the user on the primary for a while.
+#
+# TimedQueuePool is a QueuePool that reports how long each checkout waited --
+# for a connection to be returned, or for a new one to be opened -- and whether
+# it gave up after pool_timeout, so an undersized pool shows up in metrics
+# before it shows up as request latency.
+import time
+
+from flask_sqlalchemy.session import Session
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.selectable import Select, CompoundSelect
+
+
+def is_read(clause):
+    return isinstance(clause, (Select, CompoundSelect)) and clause._for_update_arg is None
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and is_read(clause) and self.info.get('replica'):
+            return self._db.engines[self.info['replica']]
+        if self._flushing or (clause is not None and not is_read(clause)):
+            self.info['wrote'] = True; self.info['replica'] = None
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+class TimedQueuePool(QueuePool):
+    observer = None # callable(pool_name, seconds, timed_out), set by the app
+
+    def _do_get(self):
+        started = time.perf_counter(); timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True; raise
+        finally:
+            if TimedQueuePool.observer: TimedQueuePool.observer(self.logging_name or 'default', time.perf_counter() - started, timed_out)
+
+
+def pool_options(url, name, size, overflow, timeout, recycle, pre_ping):
+    """Engine options for one database; in-memory SQLite keeps Flask-SQLAlchemy's single shared connection."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() == 'sqlite' and parsed.database in (None, '', ':memory:'): return {}
+    return {'poolclass': TimedQueuePool, 'pool_logging_name': name, 'pool_size': size, 'max_overflow': overflow,
+            'pool_timeout': timeout, 'pool_recycle': recycle, 'pool_pre_ping': pre_ping}
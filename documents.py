@@ -0,0 +1,64 @@
+# -----------------------------
+# INVOICE DOCUMENT SNAPSHOT
+# -----------------------------
+# The plain dict that reaches the PDF page. It is built from the models in the
+# web process, hashed for the PDF cache and pickled to render workers, none of
+# which needs ReportLab, so it lives apart from pdf_renderer.py.
+#
+# Issued invoices keep their document frozen in invoice_snapshot as
+# zlib-compressed JSON (pack_document / unpack_document), so later edits to the
+# customer or profile never change them.
+import datetime
+import json
+import os
+import zlib
+from decimal import Decimal
+
+RENDERER_VERSION = 2 # bump whenever the PDF layout changes so cached PDFs are regenerated
+LARGE_INVOICE_ITEMS = int(os.environ.get('PDF_LARGE_INVOICE_ITEMS', 150)) # more line items than this get the chunked plain-text layout
+
+PROFILE_FIELDS = ('name', 'address', 'gstin', 'phone', 'email', 'bank_name', 'account_no', 'ifsc_code', 'terms_and_conditions', 'currency', 'date_format')
+CUSTOMER_FIELDS = ('name', 'billing_address', 'shipping_address', 'gstin', 'state')
+INVOICE_FIELDS = ('invoice_no', 'date', 'po_number', 'po_date', 'eway_bill_no', 'place_of_supply', 'transport_name', 'vehicle_no', 'delivery_location', 'subtotal', 'total_gst', 'grand_total')
+ITEM_FIELDS = ('name', 'hsn', 'qty', 'unit', 'rate', 'tax_percent')
+DATE_FIELDS = ('date', 'po_date')
+MONEY_FIELDS = ('subtotal', 'total_gst', 'grand_total')
+
+
+def invoice_document(invoice, profile=None, tax_summary=None):
+    """Flatten an Invoice (plus its profile, customer and items) into the plain dict the renderer lays out.
+
+    `tax_summary` is the stored {rate: {'taxable_amount', 'gst_amount'}} breakdown; when
+    omitted the renderer derives it from the items.
+    """
+    profile = profile or invoice.profile
+    doc = {f: getattr(invoice, f) for f in INVOICE_FIELDS}
+    doc['profile'] = {f: getattr(profile, f) for f in PROFILE_FIELDS}
+    doc['customer'] = {f: getattr(invoice.customer, f) for f in CUSTOMER_FIELDS}
+    doc['items'] = [{f: getattr(item, f) for f in ITEM_FIELDS} for item in invoice.items]
+    if tax_summary is not None:
+        doc['tax_summary'] = [{'tax_percent': rate, **amounts} for rate, amounts in tax_summary.items()]
+    return doc
+
+
+def layout_for(document):
+    """'large' for invoices past LARGE_INVOICE_ITEMS line items, else 'standard'."""
+    return 'large' if len(document['items']) > LARGE_INVOICE_ITEMS else 'standard'
+
+
+def pack_document(document):
+    """Compressed JSON of an invoice_document() dict (dates as ISO strings, amounts as decimal strings)."""
+    return zlib.compress(json.dumps(document, separators=(',', ':'), default=str).encode('utf-8'), 6)
+
+
+def unpack_document(data):
+    """Inverse of pack_document, with dates and Decimals restored."""
+    document = json.loads(zlib.decompress(data))
+    for field in DATE_FIELDS:
+        if document.get(field): document[field] = datetime.date.fromisoformat(document[field])
+    for field in MONEY_FIELDS: document[field] = Decimal(document[field])
+    for item in document['items']:
+        item['rate'] = Decimal(item['rate']); item['tax_percent'] = Decimal(item['tax_percent'])
+    for line in document.get('tax_summary') or ():
+        for field in ('tax_percent', 'taxable_amount', 'gst_amount'): line[field] = Decimal(line[field])
+    return document
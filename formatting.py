@@ -0,0 +1,23 @@
+# -----------------------------
+# DISPLAY FORMATTING HELPERS
+# -----------------------------
+# Shared by the Jinja templates (via app.inject_helpers) and the PDF renderer,
+# which must not import app.py so it can run inside batch jobs and worker processes.
+from datetime import datetime as dt
+
+DATE_FORMATS = {'DD/MM/YYYY': '%d/%m/%Y', 'MM/DD/YYYY': '%m/%d/%Y', 'YYYY-MM-DD': '%Y-%m-%d'}
+CURRENCY_SYMBOLS = {'USD': '$', 'INR': '₹', 'EUR': '€', 'GBP': '£', 'JPY': '¥'}
+
+
+def get_currency_symbol(currency_code): return CURRENCY_SYMBOLS.get(currency_code, '$')
+
+
+def format_date(value, format_str):
+    """Format a date (or a legacy 'YYYY-MM-DD' string) using the profile's date format."""
+    if not value:
+        return 'N/A'
+    if isinstance(value, str):
+        try: value = dt.strptime(value, '%Y-%m-%d').date()
+        except ValueError: return value # Return original if parsing fails
+    pattern = DATE_FORMATS.get(format_str)
+    return value.strftime(pattern) if pattern else value.isoformat() # Fallback
@@ -0,0 +1,46 @@
+# Gunicorn settings (read automatically from the working directory).
+# The app is imported once in the master and workers are forked from it, so a
+# new or restarted worker is serving almost immediately. Importing app.py does
+# no database work; the schema is brought up to date by `flask init-db` in the
+# release step (see Procfile).
+import os
+import shutil
+import tempfile
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Threads per worker (gthread when > 1). Exported so app.py can size its
+# database pools to match: one connection per thread plus the job threads.
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+os.environ['GUNICORN_THREADS'] = str(threads)
+
+# Workers write their /metrics totals here so any of them can answer a scrape
+# for all; one directory per master, so a restart starts the counters afresh.
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f"invoice-metrics-{os.getpid()}"))
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+
+
+def child_exit(server, worker):
+    from app import metrics
+    metrics.mark_dead(worker.pid)
+
+
+def when_ready(server):
+    # Optionally load ReportLab fonts and styles in the master too, so every
+    # worker shares them through fork instead of paying for them on its first PDF.
+    if preload_app and os.environ.get('PDF_PRELOAD') == '1':
+        from pdf_renderer import warm_up
+        warm_up()
+
+
+def post_fork(server, worker):
+    # Never share pooled database connections (primary or replicas) across processes,
+    # and time this worker's cold start from the fork rather than the master's import
+    if preload_app:
+        from app import app, db, worker_started
+        worker_started()
+        with app.app_context():
+            for engine in db.engines.values(): engine.dispose(close=False)
@@ -0,0 +1,63 @@
+# -----------------------------
+# CSV / JSONL IMPORT PARSING
+# -----------------------------
+# Turns an uploaded file into a lazy stream of records so imports of any size
+# run in constant memory. The database side (batching, dedupe, inserts) lives
+# with the models in app.py.
+import csv
+import json
+from itertools import islice
+
+CUSTOMER_COLUMNS = ('name', 'billing_address', 'shipping_address', 'gstin', 'state', 'contact_person', 'email')
+ITEM_COLUMNS = {'item_name': 'name', 'hsn': 'hsn', 'qty': 'qty', 'unit': 'unit', 'rate': 'rate', 'tax_percent': 'tax_percent'}
+
+
+def detect_format(filename, requested=None):
+    if requested in ('csv', 'jsonl'):
+        return requested
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def iter_records(path, fmt):
+    """Yield (line_no, record, error) for every row of a CSV or JSONL file."""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, {(k or '').strip().lower(): v.strip() if isinstance(v, str) else v for k, v in row.items()}, None
+            return
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try: record = json.loads(line)
+            except ValueError as e: yield line_no, None, f"invalid JSON: {e}"; continue
+            if not isinstance(record, dict): yield line_no, None, "each line must be a JSON object"; continue
+            yield line_no, record, None
+
+
+def iter_invoice_payloads(records):
+    """Group records into invoice payloads shaped like the /api/invoices body.
+
+    JSONL lines that carry an `items` list are passed through. Flat CSV rows
+    (one per line item, header columns repeated) are grouped while consecutive
+    rows share an invoice_no, so rows of one invoice must be adjacent.
+    """
+    current = None; current_line = None
+    for line_no, record, error in records:
+        if error or 'items' in record:
+            if current: yield current_line, current, None; current = None
+            yield line_no, record, error
+            continue
+        item = {target: record.get(source) for source, target in ITEM_COLUMNS.items()}
+        if current and record.get('invoice_no') == current['invoice_no']:
+            current['items'].append(item); continue
+        if current: yield current_line, current, None
+        current = {k: v for k, v in record.items() if k not in ITEM_COLUMNS}
+        current['items'] = [item]; current_line = line_no
+    if current: yield current_line, current, None
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
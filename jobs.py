@@ -0,0 +1,176 @@
+# -----------------------------
+# BACKGROUND JOB QUEUE
+# -----------------------------
+# Slow work (PDF renders, bulk exports, imports) is written to a jobs table and
+# picked up by worker threads, either inside each web process or in a separate
+# `flask run-jobs` process. The database is the only broker:
+#   * claim() moves one job from 'queued' to 'running' in a single UPDATE,
+#     lowest priority value first, skipping tenants that already have
+#     `tenant_limit` jobs running
+#   * a failed job goes back to 'queued' with exponential backoff until it has
+#     used max_attempts, then stays 'failed'
+#   * a 'running' job whose worker died is requeued once its lease expires
+# Job handlers are plain functions registered per kind by the app; they get the
+# claimed row as a dict (params decoded) and return a JSON-able result.
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+from sqlalchemy import insert, select, update, func, text
+
+ACTIVE = ('queued', 'running')
+FINISHED = ('done', 'failed')
+
+
+def _utcnow(): return datetime.datetime.utcnow()
+
+
+def _row(mapping):
+    job = dict(mapping)
+    for field in ('params', 'result'):
+        job[field] = json.loads(job[field]) if job.get(field) else None
+    return job
+
+
+class JobQueue:
+    def __init__(self, table, tenant_limit=2, lease_seconds=1800, retry_delay=5.0):
+        self.table = table
+        self.tenant_limit = tenant_limit
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+        self.retry_delay = retry_delay
+        self.wakeup = threading.Event() # set on enqueue so local workers don't wait out their poll interval
+        self._finished = threading.Condition()
+
+    # --- Producers ---
+    def enqueue(self, engine, user_id, kind, params=None, priority=100, max_attempts=3, dedupe_key=None):
+        """Queue a job and return its id; with `dedupe_key`, an active job of the same user/kind/key is reused."""
+        t = self.table
+        with engine.begin() as conn:
+            if dedupe_key:
+                existing = conn.execute(select(t.c.id).where(t.c.user_id == user_id, t.c.kind == kind, t.c.dedupe_key == dedupe_key, t.c.status.in_(ACTIVE)).limit(1)).scalar()
+                if existing: return existing
+            job_id = conn.execute(insert(t).values(
+                user_id=user_id, kind=kind, params=json.dumps(params or {}), priority=priority, status='queued',
+                attempts=0, max_attempts=max_attempts, dedupe_key=dedupe_key, run_after=_utcnow(), created_at=_utcnow(),
+            ).returning(t.c.id)).scalar()
+        self.wakeup.set()
+        return job_id
+
+    def get(self, engine, job_id):
+        with engine.connect() as conn:
+            row = conn.execute(select(self.table).where(self.table.c.id == job_id)).mappings().first()
+        return _row(row) if row else None
+
+    def wait(self, engine, job_id, timeout):
+        """Block up to `timeout` seconds for a job to finish; returns its latest row either way."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(engine, job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] in FINISHED or remaining <= 0:
+                return job
+            with self._finished: # woken by local workers, re-checked periodically for remote ones
+                self._finished.wait(min(remaining, 0.25))
+
+    # --- Workers ---
+    def claim(self, engine, worker_id):
+        t = self.table; now = _utcnow()
+        candidate = t.alias('candidate'); running = t.alias('running')
+        busy = (select(func.count()).select_from(running)
+                .where(running.c.user_id == candidate.c.user_id, running.c.status == 'running').scalar_subquery())
+        next_id = (select(candidate.c.id)
+                   .where(candidate.c.status == 'queued', candidate.c.run_after <= now, busy < self.tenant_limit)
+                   .order_by(candidate.c.priority, candidate.c.id).limit(1).scalar_subquery())
+        with engine.begin() as conn:
+            if engine.dialect.name == 'postgresql': # serialise claims so the per-tenant count can't be raced
+                conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('job_queue_claim'))"))
+            expired = t.c.status == 'running', t.c.locked_at < now - self.lease
+            conn.execute(update(t).where(*expired, t.c.attempts >= t.c.max_attempts)
+                         .values(status='failed', error='Worker lost (lease expired).', finished_at=now, locked_by=None))
+            conn.execute(update(t).where(*expired).values(status='queued', locked_by=None, run_after=now))
+            row = conn.execute(update(t).where(t.c.id == next_id, t.c.status == 'queued')
+                               .values(status='running', locked_by=worker_id, locked_at=now, attempts=t.c.attempts + 1)
+                               .returning(*t.c)).mappings().first()
+        return _row(row) if row else None
+
+    def complete(self, engine, job, result=None):
+        t = self.table
+        with engine.begin() as conn:
+            conn.execute(update(t).where(t.c.id == job['id']).values(
+                status='done', result=json.dumps(result) if result is not None else None, error=None, finished_at=_utcnow(), locked_by=None))
+        self._notify()
+
+    def fail(self, engine, job, error):
+        """Requeue with backoff, or mark failed once max_attempts is used up."""
+        t = self.table; now = _utcnow()
+        if job['attempts'] < job['max_attempts']:
+            values = dict(status='queued', run_after=now + datetime.timedelta(seconds=self.retry_delay * 2 ** (job['attempts'] - 1)))
+        else:
+            values = dict(status='failed', finished_at=now)
+        with engine.begin() as conn:
+            conn.execute(update(t).where(t.c.id == job['id']).values(error=str(error)[:2000], locked_by=None, **values))
+        self._notify()
+
+    def _notify(self):
+        with self._finished: self._finished.notify_all()
+
+
+class JobWorker:
+    """Threads that claim and run jobs. `context` is a factory for the app context each job runs in."""
+
+    def __init__(self, queue, handlers, context, engine, threads=2, poll_interval=1.0):
+        self.queue = queue
+        self.handlers = handlers
+        self.context = context
+        self.engine = engine # callable, resolved inside the context
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._started = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start the threads once per process (lazily, so forked web workers each get their own)."""
+        if self._started or self.threads < 1: return
+        with self._lock:
+            if self._started: return
+            for n in range(self.threads):
+                threading.Thread(target=self._loop, daemon=True, name=f"job-worker-{n}").start()
+            self._started = True
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self._stop.wait(1): pass
+        except KeyboardInterrupt:
+            self._stop.set()
+
+    def run_one(self):
+        """Claim and run a single job; returns False when nothing was ready."""
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        with self.context():
+            engine = self.engine()
+            job = self.queue.claim(engine, worker_id)
+            if job is None: return False
+            handler = self.handlers.get(job['kind'])
+            try:
+                if handler is None: raise LookupError(f"no handler for job kind {job['kind']!r}")
+                result = handler(job)
+            except Exception as e:
+                print(f"ERROR in job {job['id']} ({job['kind']}, attempt {job['attempts']}): {e}")
+                traceback.print_exc()
+                self.queue.fail(engine, job, e)
+            else:
+                self.queue.complete(engine, job, result)
+        return True
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try: ran = self.run_one()
+            except Exception as e: print(f"ERROR in job worker: {e}"); ran = False
+            if not ran:
+                self.queue.wakeup.wait(self.poll_interval); self.queue.wakeup.clear()
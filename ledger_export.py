@@ -0,0 +1,135 @@
+# -----------------------------
+# LEDGER EXPORT
+# -----------------------------
+# Writes the flat invoice ledger (one row per line item) as CSV or XLSX while
+# the rows are still being fetched. Both writers take any iterable of tuples in
+# LEDGER_COLUMNS order and yield bytes every `batch_rows` rows, so the caller can
+# hand them straight to a streaming response: the header goes out before the
+# first row is read and memory stays flat however long the ledger is.
+#
+# XLSX is written by hand (a workbook is a ZIP of XML parts) rather than with a
+# spreadsheet library, which would build the whole sheet in memory first. The
+# sheet uses inline strings, so no shared-string table has to be collected.
+import csv
+import datetime
+import io
+import re
+import time
+import zipfile
+from xml.sax.saxutils import escape
+
+from bulk_export import _ChunkSink
+
+# (column, kind) -- kind decides CSV quoting guards and XLSX cell type/format
+LEDGER_COLUMNS = (
+    ('invoice_no', 'text'), ('date', 'date'), ('status', 'text'),
+    ('customer', 'text'), ('customer_gstin', 'text'), ('place_of_supply', 'text'),
+    ('item', 'text'), ('hsn', 'text'), ('qty', 'number'), ('unit', 'text'),
+    ('rate', 'money'), ('tax_percent', 'number'),
+    ('taxable_amount', 'money'), ('gst_amount', 'money'), ('line_total', 'money'),
+)
+LEDGER_FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_EXCEL_EPOCH = datetime.date(1899, 12, 30)
+
+
+def _csv_cell(value, kind):
+    if value is None: return ''
+    if kind == 'date': return value.isoformat()
+    if kind == 'money': return f"{value:.2f}"
+    value = str(value)
+    # keep spreadsheet apps from evaluating customer-supplied text as a formula
+    return "'" + value if kind == 'text' and value.startswith(_FORMULA_PREFIXES) else value
+
+
+def stream_csv(rows, batch_rows=500):
+    buffer = io.StringIO(); writer = csv.writer(buffer)
+    buffer.write('\ufeff') # BOM so Excel reads the file as UTF-8 (names, the rupee sign)
+    writer.writerow([name for name, _ in LEDGER_COLUMNS])
+    yield buffer.getvalue().encode('utf-8')
+    buffer.seek(0); buffer.truncate()
+    for n, row in enumerate(rows, start=1):
+        writer.writerow([_csv_cell(value, kind) for value, (_, kind) in zip(row, LEDGER_COLUMNS)])
+        if n % batch_rows == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0); buffer.truncate()
+    if buffer.tell(): yield buffer.getvalue().encode('utf-8')
+
+
+# --- XLSX ---
+_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_STATIC_PARTS = {
+    '[Content_Types].xml': _HEAD + (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'),
+    '_rels/.rels': _HEAD + (
+        f'<Relationships xmlns="{_PKG_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{_REL_NS}/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': _HEAD + (
+        f'<workbook xmlns="{_NS}" xmlns:r="{_REL_NS}">'
+        '<sheets><sheet name="Ledger" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    'xl/_rels/workbook.xml.rels': _HEAD + (
+        f'<Relationships xmlns="{_PKG_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{_REL_NS}/worksheet" Target="worksheets/sheet1.xml"/>'
+        f'<Relationship Id="rId2" Type="{_REL_NS}/styles" Target="styles.xml"/>'
+        '</Relationships>'),
+    # cell styles: 0 general, 1 built-in date format, 2 built-in "0.00"
+    'xl/styles.xml': _HEAD + (
+        f'<styleSheet xmlns="{_NS}">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="2" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+        '</styleSheet>'),
+}
+
+
+def _xlsx_cell(value, kind):
+    if value is None or value == '': return '<c/>'
+    if kind == 'date': return f'<c s="1"><v>{(value - _EXCEL_EPOCH).days}</v></c>'
+    if kind == 'money': return f'<c s="2"><v>{value}</v></c>'
+    if kind == 'number': return f'<c><v>{value}</v></c>'
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(_XML_ILLEGAL.sub("", str(value)))}</t></is></c>'
+
+
+def _xlsx_row(cells):
+    return '<row>' + ''.join(cells) + '</row>'
+
+
+def stream_xlsx(rows, batch_rows=500):
+    sink = _ChunkSink()
+    timestamp = time.localtime(time.time())[:6]
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in _STATIC_PARTS.items():
+            zf.writestr(zipfile.ZipInfo(name, date_time=timestamp), xml, compress_type=zipfile.ZIP_DEFLATED)
+        info = zipfile.ZipInfo('xl/worksheets/sheet1.xml', date_time=timestamp); info.compress_type = zipfile.ZIP_DEFLATED
+        with zf.open(info, 'w', force_zip64=True) as sheet: # size unknown up front; may pass 4 GiB uncompressed
+            header = _xlsx_row(_xlsx_cell(name, 'text') for name, _ in LEDGER_COLUMNS)
+            sheet.write((_HEAD + f'<worksheet xmlns="{_NS}"><sheetData>' + header).encode('utf-8'))
+            yield sink.drain()
+            parts = []
+            for n, row in enumerate(rows, start=1):
+                parts.append(_xlsx_row(_xlsx_cell(value, kind) for value, (_, kind) in zip(row, LEDGER_COLUMNS)))
+                if n % batch_rows == 0:
+                    sheet.write(''.join(parts).encode('utf-8')); parts = []
+                    data = sink.drain()
+                    if data: yield data
+            sheet.write((''.join(parts) + '</sheetData></worksheet>').encode('utf-8'))
+    yield sink.drain()
@@ -0,0 +1,112 @@
+# -----------------------------
+# SMTP BATCH DELIVERY
+# -----------------------------
+# Sends many messages over one SMTP connection instead of connecting (and
+# doing TLS and AUTH) once per message. SmtpBatch opens the connection on the
+# first send, reuses it, reconnects after `max_per_connection` messages or when
+# the server has dropped an idle connection, and paces sends to `rate_limit`
+# messages per second. Failures are raised as DeliveryError, marked permanent
+# for 5xx replies (bad address, rejected content) so the caller knows what is
+# worth retrying; SmtpUnavailable means the server cannot be reached at all.
+import smtplib
+import ssl
+import time
+from email.message import EmailMessage
+from email.utils import formataddr, make_msgid
+
+SECURITY_MODES = ('starttls', 'ssl', 'none')
+
+
+class DeliveryError(Exception):
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class SmtpUnavailable(DeliveryError):
+    """Connecting or logging in failed; nothing in the batch can be sent right now."""
+
+
+def build_message(sender, recipient, subject, body, attachment_name, attachment, reply_to=None):
+    message = EmailMessage()
+    message['From'] = sender; message['To'] = recipient; message['Subject'] = subject
+    if reply_to: message['Reply-To'] = reply_to
+    message['Message-ID'] = make_msgid(domain=sender.rpartition('@')[2].rstrip('>') or None)
+    message.set_content(body)
+    message.add_attachment(attachment, maintype='application', subtype='pdf', filename=attachment_name)
+    return message
+
+
+def sender_address(name, address):
+    return formataddr((name, address)) if name else address
+
+
+class SmtpBatch:
+    def __init__(self, host, port=25, username=None, password=None, security='starttls', timeout=30,
+                 rate_limit=0, max_per_connection=100, clock=time.monotonic, sleep=time.sleep):
+        if security not in SECURITY_MODES: raise ValueError(f"security must be one of {SECURITY_MODES}")
+        self.host, self.port, self.username, self.password = host, port, username, password
+        self.security = security
+        self.timeout = timeout
+        self.interval = 1.0 / rate_limit if rate_limit else 0.0
+        self.max_per_connection = max_per_connection
+        self._clock, self._sleep = clock, sleep
+        self._conn = None
+        self._on_connection = 0 # messages sent over the current connection
+        self._next_send = 0.0
+        self.sent = 0
+        self.connections = 0
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+    def close(self):
+        if self._conn is None: return
+        try: self._conn.quit()
+        except (OSError, smtplib.SMTPException): self._conn.close()
+        self._conn = None
+
+    def _connect(self):
+        try:
+            if self.security == 'ssl':
+                conn = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=ssl.create_default_context())
+            else:
+                conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+                if self.security == 'starttls': conn.starttls(context=ssl.create_default_context())
+            if self.username: conn.login(self.username, self.password or '')
+        except (OSError, smtplib.SMTPException) as e:
+            raise SmtpUnavailable(f"SMTP server {self.host}:{self.port} unavailable: {e}") from e
+        self._conn = conn; self._on_connection = 0; self.connections += 1
+
+    def _pace(self):
+        if not self.interval: return
+        now = self._clock()
+        if self._next_send > now: self._sleep(self._next_send - now); now = self._next_send
+        self._next_send = now + self.interval
+
+    def send(self, message):
+        """Deliver one message, reusing the open connection; raises DeliveryError."""
+        self._pace()
+        if self._conn is not None and self._on_connection >= self.max_per_connection: self.close()
+        for attempt in (1, 2): # a reused connection may have been closed by the server while idle
+            if self._conn is None: self._connect()
+            try:
+                self._conn.send_message(message)
+            except smtplib.SMTPServerDisconnected as e:
+                self._conn = None
+                if attempt == 2 or self._on_connection == 0: raise DeliveryError(f"Connection lost: {e}") from e
+                continue
+            except smtplib.SMTPRecipientsRefused as e:
+                code, reply = next(iter(e.recipients.values()))
+                raise DeliveryError(f"Recipient refused: {code} {_text(reply)}", permanent=500 <= code < 600) from e
+            except smtplib.SMTPResponseException as e: # sender refused, data rejected, ...
+                raise DeliveryError(f"{e.smtp_code} {_text(e.smtp_error)}", permanent=500 <= e.smtp_code < 600) from e
+            except (OSError, smtplib.SMTPException) as e:
+                self.close(); raise DeliveryError(str(e)) from e
+            self._on_connection += 1; self.sent += 1
+            return
+
+
+def _text(reply):
+    return reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else str(reply)
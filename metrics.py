@@ -0,0 +1,163 @@
+# -----------------------------
+# METRICS
+# -----------------------------
+# Counters and histograms kept in memory per process and rendered in the
+# Prometheus text format. Under gunicorn each worker has its own registry, so
+# with a shared `directory` every process writes a JSON snapshot of its totals
+# there (atomically, at most once per `flush_interval`) and the worker that
+# answers a scrape adds all snapshots together. Snapshots of exited workers are
+# folded into archive.json by mark_dead() so totals never go backwards.
+import atexit
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    return tuple(sorted((str(k), str(v)) for k, v in (labels or {}).items()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}' if pairs else ''
+
+
+class Registry:
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.definitions = {} # name -> (type, help, buckets)
+        self.collectors = [] # callables run before each snapshot, e.g. to copy cache counters in
+        self._counters = {} # (name, label_key) -> value
+        self._histograms = {} # (name, label_key) -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flusher = None
+        self._pid = None
+
+    # --- Definitions ---
+    def counter(self, name, help_text):
+        self.definitions[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.definitions[name] = ('histogram', help_text, tuple(buckets))
+
+    # --- Recording ---
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._dirty = True
+        self._ensure_flusher()
+
+    def set_total(self, name, value, **labels):
+        """Overwrite a counter with a running total this process keeps elsewhere."""
+        with self._lock:
+            self._counters[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]; key = (name, _label_key(labels))
+        with self._lock:
+            state = self._histograms.get(key)
+            if state is None: state = self._histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound: state[i] += 1
+            state[-2] += value; state[-1] += 1
+            self._dirty = True
+        self._ensure_flusher()
+
+    # --- Snapshots ---
+    def snapshot(self):
+        for collect in self.collectors:
+            try: collect(self)
+            except Exception as e: print(f"ERROR in metrics collector: {e}")
+        with self._lock:
+            return {'counters': [[n, list(map(list, k)), v] for (n, k), v in self._counters.items()],
+                    'histograms': [[n, list(map(list, k)), list(s)] for (n, k), s in self._histograms.items()]}
+
+    def flush(self):
+        if not self.directory: return
+        os.makedirs(self.directory, exist_ok=True)
+        data = self.snapshot()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f: json.dump(data, f)
+        os.replace(tmp, os.path.join(self.directory, f"{os.getpid()}.json"))
+        self._dirty = False
+
+    def _ensure_flusher(self):
+        # one thread per process, started lazily so each forked worker gets its own
+        if not self.directory or self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._pid = os.getpid()
+        def loop():
+            while True:
+                time.sleep(self.flush_interval)
+                if self._dirty:
+                    try: self.flush()
+                    except OSError as e: print(f"ERROR writing metrics snapshot: {e}")
+        threading.Thread(target=loop, daemon=True, name='metrics-flush').start()
+        atexit.register(self.flush)
+
+    def collect(self):
+        """Totals of every process sharing the directory (or just this one)."""
+        if not self.directory: return self.snapshot()
+        self.flush()
+        merged = {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f: _merge(merged, json.load(f))
+            except (OSError, ValueError): continue # a worker is mid-replace or just exited
+        return {'counters': [[n, k, v] for (kind, n, k), v in merged.items() if kind == 'c'],
+                'histograms': [[n, k, v] for (kind, n, k), v in merged.items() if kind == 'h']}
+
+    def mark_dead(self, pid):
+        """Fold an exited worker's snapshot into archive.json (call from gunicorn's child_exit hook)."""
+        if not self.directory: return
+        path = os.path.join(self.directory, f"{pid}.json"); archive = os.path.join(self.directory, 'archive.json')
+        if not os.path.exists(path): return
+        merged = {}
+        for source in (archive, path):
+            try:
+                with open(source) as f: _merge(merged, json.load(f))
+            except (OSError, ValueError): pass
+        data = {'counters': [[n, k, v] for (kind, n, k), v in merged.items() if kind == 'c'],
+                'histograms': [[n, k, v] for (kind, n, k), v in merged.items() if kind == 'h']}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f: json.dump(data, f)
+        os.replace(tmp, archive); os.remove(path)
+
+    # --- Exposition ---
+    def render(self):
+        data = self.collect(); lines = []
+        by_name = {}
+        for name, labels, value in data['counters']: by_name.setdefault(name, []).append((labels, value))
+        for name, labels, state in data['histograms']: by_name.setdefault(name, []).append((labels, state))
+        for name, (kind, help_text, buckets) in self.definitions.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, value in sorted(by_name.get(name, []), key=lambda item: item[0]):
+                pairs = [tuple(p) for p in labels]
+                if kind == 'counter':
+                    lines.append(f"{name}{_format_labels(pairs)} {value}"); continue
+                for bound, count in zip(buckets, value):
+                    lines.append(f"{name}_bucket{_format_labels(pairs + [('le', repr(float(bound)))])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(pairs + [('le', '+Inf')])} {value[-1]}")
+                lines.append(f"{name}_sum{_format_labels(pairs)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(pairs)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+def _merge(merged, data):
+    for name, labels, value in data.get('counters', []):
+        key = ('c', name, tuple(map(tuple, labels))); merged[key] = merged.get(key, 0) + value
+    for name, labels, state in data.get('histograms', []):
+        key = ('h', name, tuple(map(tuple, labels)))
+        merged[key] = [a + b for a, b in zip(merged[key], state)] if key in merged else list(state)
@@ -0,0 +1,306 @@
+# -----------------------------
+# SCHEMA MIGRATIONS
+# -----------------------------
+# db.create_all() only creates missing tables, so changes to existing tables are
+# applied here and run through the `flask` CLI commands registered in app.py.
+import time
+
+from sqlalchemy import inspect, text
+
+# --- Native date / decimal columns -----------------------------------------
+# Invoice.date and po_date used to be VARCHAR and the money columns FLOAT.
+# On Postgres the conversion runs online in phases, each safe to re-run:
+#   expand   add *_native shadow columns, a trigger that keeps them in sync with
+#            writes from the old code, and (concurrently) the new date index
+#   backfill copy existing rows in id-ordered batches, one transaction each;
+#            progress is stored in schema_migration_progress so it can resume
+#   switch   validate NOT NULL as CHECK constraints first (NOT VALID, then
+#            VALIDATE, which scans without blocking writes), then one short
+#            transaction that swaps the shadow columns into place, where SET
+#            NOT NULL uses the checks instead of scanning under ACCESS
+#            EXCLUSIVE; deploy the new code right after this
+#   cleanup  drop the *_legacy columns once the new release is healthy
+# SQLite stores dates as ISO strings either way, so only the values need
+# normalising (empty strings become NULL) and the declared types stay as they are.
+NATIVE_COLUMNS = {
+    'invoice': [
+        ('date', 'DATE', 'date_expr'), ('po_date', 'DATE', 'date_expr'),
+        ('subtotal', 'NUMERIC(12, 2)', 'numeric_expr'), ('total_gst', 'NUMERIC(12, 2)', 'numeric_expr'),
+        ('grand_total', 'NUMERIC(12, 2)', 'numeric_expr'),
+    ],
+    'invoice_item': [
+        ('rate', 'NUMERIC(12, 2)', 'numeric_expr'), ('tax_percent', 'NUMERIC(5, 2)', 'numeric_expr'),
+    ],
+}
+NOT_NULL_COLUMNS = {'invoice': ['date', 'subtotal', 'total_gst', 'grand_total'], 'invoice_item': ['rate', 'tax_percent']}
+MIGRATION_NAME = 'native_types'
+
+
+def _pg_expr(kind, column, prefix=''):
+    ref = f"{prefix}{column}"
+    if kind == 'date_expr':
+        return f"CASE WHEN {ref}::text ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}}$' THEN {ref}::date END"
+    return f"ROUND({ref}::numeric, 2)"
+
+
+def _column_type(engine, table, column):
+    for col in inspect(engine).get_columns(table):
+        if col['name'] == column:
+            return str(col['type']).upper()
+    return None
+
+
+def native_types_state(engine):
+    """'done' if invoice.date is already a DATE column, else 'legacy' or 'expanded'."""
+    if engine.dialect.name != 'postgresql':
+        return 'sqlite'
+    if _column_type(engine, 'invoice', 'date') == 'DATE':
+        return 'done'
+    return 'expanded' if _column_type(engine, 'invoice', 'date_native') else 'legacy'
+
+
+def _ensure_progress_table(conn):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS schema_migration_progress (name VARCHAR(100) PRIMARY KEY, last_id INTEGER NOT NULL)"))
+
+
+def _progress(conn, key):
+    row = conn.execute(text("SELECT last_id FROM schema_migration_progress WHERE name = :n"), {'n': key}).first()
+    return row[0] if row else 0
+
+
+def _save_progress(conn, key, last_id):
+    updated = conn.execute(text("UPDATE schema_migration_progress SET last_id = :i WHERE name = :n"), {'n': key, 'i': last_id}).rowcount
+    if not updated:
+        conn.execute(text("INSERT INTO schema_migration_progress (name, last_id) VALUES (:n, :i)"), {'n': key, 'i': last_id})
+
+
+def native_types_expand(engine, log=print):
+    if engine.dialect.name != 'postgresql':
+        log("SQLite: nothing to expand, run the backfill step."); return
+    if native_types_state(engine) == 'done':
+        log("Already migrated."); return
+    with engine.begin() as conn:
+        _ensure_progress_table(conn)
+        for table, columns in NATIVE_COLUMNS.items():
+            adds = ', '.join(f"ADD COLUMN IF NOT EXISTS {name}_native {sql_type}" for name, sql_type, _ in columns)
+            conn.execute(text(f"ALTER TABLE {table} {adds}"))
+            assignments = ' '.join(f"NEW.{name}_native := {_pg_expr(kind, name, 'NEW.')};" for name, _, kind in columns)
+            conn.execute(text(f"CREATE OR REPLACE FUNCTION {table}_native_sync() RETURNS trigger AS $$ BEGIN {assignments} RETURN NEW; END $$ LANGUAGE plpgsql"))
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {table}_native_sync ON {table}"))
+            conn.execute(text(f"CREATE TRIGGER {table}_native_sync BEFORE INSERT OR UPDATE ON {table} FOR EACH ROW EXECUTE FUNCTION {table}_native_sync()"))
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_invoice_user_date_native_id ON invoice (user_id, date_native, id)"))
+    log("Shadow columns, sync triggers and index created.")
+
+
+def native_types_backfill(engine, batch_size=1000, pause=0.0, log=print):
+    """Copy existing rows into the native columns in resumable, id-ordered batches."""
+    postgres = engine.dialect.name == 'postgresql'
+    if postgres and native_types_state(engine) != 'expanded':
+        log("Run the expand step first (or the migration is already done)."); return
+    with engine.begin() as conn:
+        _ensure_progress_table(conn)
+    for table, columns in NATIVE_COLUMNS.items():
+        key = f"{MIGRATION_NAME}:{table}"
+        with engine.connect() as conn:
+            last_id = _progress(conn, key)
+            max_id = conn.execute(text(f"SELECT MAX(id) FROM {table}")).scalar() or 0
+        if postgres:
+            assignments = ', '.join(f"{name}_native = {_pg_expr(kind, name)}" for name, _, kind in columns)
+        else:
+            assignments = ', '.join(f"{name} = NULLIF({name}, '')" for name, _, _ in columns)
+        while last_id < max_id:
+            upper = last_id + batch_size
+            with engine.begin() as conn:
+                conn.execute(text(f"UPDATE {table} SET {assignments} WHERE id > :lo AND id <= :hi"), {'lo': last_id, 'hi': upper})
+                _save_progress(conn, key, min(upper, max_id))
+            last_id = min(upper, max_id)
+            log(f"{table}: {last_id}/{max_id}")
+            if pause: time.sleep(pause)
+    log("Backfill complete.")
+
+
+def native_types_check(engine):
+    """Rows whose legacy value could not be converted into a NOT NULL native column."""
+    if native_types_state(engine) != 'expanded':
+        return {}
+    problems = {}
+    with engine.connect() as conn:
+        for table, columns in NOT_NULL_COLUMNS.items():
+            where = ' OR '.join(f"{c}_native IS NULL" for c in columns)
+            problems[table] = conn.execute(text(f"SELECT COUNT(*) FROM {table} WHERE {where}")).scalar()
+    return {t: n for t, n in problems.items() if n}
+
+
+def _not_null_check(table, column):
+    return f"{table}_{column}_not_null"
+
+
+def _validate_not_null_checks(engine, log=print):
+    """Prove the native NOT NULL columns hold no NULLs without an ACCESS EXCLUSIVE scan.
+
+    Each CHECK is added NOT VALID (a brief lock, no scan; new writes are checked from
+    then on) and validated in its own transaction, which scans under SHARE UPDATE
+    EXCLUSIVE so reads and writes carry on. Re-running skips what already exists.
+    """
+    for table, columns in NOT_NULL_COLUMNS.items():
+        for name in columns:
+            constraint = _not_null_check(table, name)
+            with engine.begin() as conn:
+                conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+                exists = conn.execute(text("SELECT 1 FROM pg_constraint WHERE conname = :c AND conrelid = CAST(:t AS regclass)"), {'c': constraint, 't': table}).scalar()
+                if not exists:
+                    conn.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {constraint} CHECK ({name}_native IS NOT NULL) NOT VALID"))
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}"))
+            log(f"{table}.{name}: NOT NULL validated.")
+
+
+def native_types_switch(engine, log=print):
+    if native_types_state(engine) != 'expanded':
+        log("Nothing to switch."); return
+    problems = native_types_check(engine)
+    if problems:
+        log(f"Refusing to switch, unconverted rows: {problems}. Fix them and re-run backfill."); return
+    _validate_not_null_checks(engine, log)
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+        for table, columns in NATIVE_COLUMNS.items():
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {table}_native_sync ON {table}"))
+            conn.execute(text(f"DROP FUNCTION IF EXISTS {table}_native_sync()"))
+            for name, _, _ in columns:
+                conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN {name} TO {name}_legacy"))
+                conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {name}_legacy DROP NOT NULL"))
+                conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN {name}_native TO {name}"))
+            for name in NOT_NULL_COLUMNS[table]: # no scan: the validated CHECK already proves it
+                conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {name} SET NOT NULL"))
+                conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {_not_null_check(table, name)}"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_invoice_user_date_id"))
+        conn.execute(text("ALTER INDEX ix_invoice_user_date_native_id RENAME TO ix_invoice_user_date_id"))
+    log("Native columns are live. Deploy the new release now.")
+
+
+def native_types_cleanup(engine, log=print):
+    if engine.dialect.name != 'postgresql':
+        log("SQLite: nothing to clean up."); return
+    with engine.begin() as conn:
+        for table, columns in NATIVE_COLUMNS.items():
+            drops = ', '.join(f"DROP COLUMN IF EXISTS {name}_legacy" for name, _, _ in columns)
+            conn.execute(text(f"ALTER TABLE {table} {drops}"))
+    log("Legacy columns dropped.")
+
+
+NATIVE_TYPES_STEPS = {
+    'expand': native_types_expand, 'backfill': native_types_backfill,
+    'switch': native_types_switch, 'cleanup': native_types_cleanup,
+}
+
+
+# --- Customer search indexes ------------------------------------------------
+# Substring search over name, GSTIN and contact person. Postgres gets pg_trgm GIN
+# indexes (used by ILIKE '%q%'); SQLite gets an external-content FTS5 table with
+# the trigram tokenizer, kept in sync by triggers. Returns the backend in use so
+# the search query can pick a matching strategy.
+CUSTOMER_SEARCH_COLUMNS = ('name', 'gstin', 'contact_person')
+
+
+def ensure_customer_search_index(engine):
+    """Create the search indexes if missing; returns 'trigram', 'fts5' or 'like'."""
+    cols = ', '.join(CUSTOMER_SEARCH_COLUMNS)
+    if engine.dialect.name == 'postgresql':
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                for col in CUSTOMER_SEARCH_COLUMNS:
+                    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_customer_{col}_trgm ON customer USING gin ({col} gin_trgm_ops)"))
+            return 'trigram'
+        except Exception as e:
+            print(f"WARNING: pg_trgm unavailable ({e}); customer search falls back to unindexed ILIKE.")
+            return 'like'
+    if engine.dialect.name != 'sqlite':
+        return 'like'
+    new_values = ', '.join(f"new.{c}" for c in CUSTOMER_SEARCH_COLUMNS)
+    old_values = ', '.join(f"old.{c}" for c in CUSTOMER_SEARCH_COLUMNS)
+    try:
+        with engine.begin() as conn:
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'customer_fts'")).first()
+            if exists:
+                return 'fts5'
+            conn.execute(text(f"CREATE VIRTUAL TABLE customer_fts USING fts5({cols}, content='customer', content_rowid='id', tokenize='trigram')"))
+            conn.execute(text(f"CREATE TRIGGER customer_fts_ai AFTER INSERT ON customer BEGIN INSERT INTO customer_fts(rowid, {cols}) VALUES (new.id, {new_values}); END"))
+            conn.execute(text(f"CREATE TRIGGER customer_fts_ad AFTER DELETE ON customer BEGIN INSERT INTO customer_fts(customer_fts, rowid, {cols}) VALUES ('delete', old.id, {old_values}); END"))
+            conn.execute(text(f"CREATE TRIGGER customer_fts_au AFTER UPDATE ON customer BEGIN "
+                              f"INSERT INTO customer_fts(customer_fts, rowid, {cols}) VALUES ('delete', old.id, {old_values}); "
+                              f"INSERT INTO customer_fts(rowid, {cols}) VALUES (new.id, {new_values}); END"))
+            conn.execute(text("INSERT INTO customer_fts(customer_fts) VALUES ('rebuild')"))
+        return 'fts5'
+    except Exception as e:
+        print(f"WARNING: FTS5 trigram search unavailable ({e}); customer search falls back to LIKE.")
+        return 'like'
+
+
+# --- Small additive changes -------------------------------------------------
+def add_missing_columns(engine, table):
+    """ALTER TABLE ADD COLUMN for model columns the live table lacks: nullable ones, or NOT NULL ones with a server_default."""
+    existing = {c['name'] for c in inspect(engine).get_columns(table.name)}
+    missing = [c for c in table.columns if c.name not in existing and (c.nullable or c.server_default is not None)]
+    with engine.begin() as conn:
+        for column in missing:
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+            if column.server_default is not None: ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+            conn.execute(text(ddl))
+    return [c.name for c in missing]
+
+
+def backfill_due_dates(engine, days):
+    """Give invoices created before due dates existed one `days` after their invoice date."""
+    if engine.dialect.name == 'postgresql': expr = "date + CAST(:days AS INTEGER)"
+    else: expr = "date(date, '+' || :days || ' days')"
+    with engine.begin() as conn:
+        conn.execute(text(f"UPDATE invoice SET due_date = {expr} WHERE due_date IS NULL"), {'days': days})
+
+
+def backfill_gst_keys(engine):
+    """Fill invoice.customer_gstin / gst_place_of_supply for invoices written before they were stored.
+
+    Uses each customer's current GSTIN and state -- the best that is known for old rows, and
+    what the rollup was built from until now. Run `flask rebuild-gst-rollups` afterwards if
+    customers were edited in the meantime.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(
+            "UPDATE invoice SET"
+            " customer_gstin = COALESCE((SELECT gstin FROM customer WHERE customer.id = invoice.customer_id), ''),"
+            " gst_place_of_supply = COALESCE(NULLIF(place_of_supply, ''), (SELECT state FROM customer WHERE customer.id = invoice.customer_id), '')"
+            " WHERE customer_gstin IS NULL"))
+
+
+def ensure_unique_invoice_numbers(engine, index):
+    """Create the (user_id, invoice_no) unique index, replacing the old plain one.
+
+    Fails softly when existing rows already hold duplicate numbers: those have to
+    be renumbered by hand, and until then the allocator alone keeps new numbers apart.
+    """
+    try:
+        index.create(engine, checkfirst=True)
+    except Exception as e:
+        with engine.connect() as conn:
+            dupes = conn.execute(text("SELECT COUNT(*) FROM (SELECT 1 FROM invoice GROUP BY user_id, invoice_no HAVING COUNT(*) > 1) d")).scalar()
+        print(f"WARNING: cannot enforce unique invoice numbers, {dupes} duplicated number(s) exist ({e}).")
+        return False
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_invoice_user_invoice_no"))
+    return True
+
+
+def customer_search_backend(engine):
+    """Which search strategy ensure_customer_search_index() left in place, without creating anything."""
+    if engine.dialect.name == 'postgresql':
+        return 'trigram' if inspect(engine).has_table('customer') and any(
+            ix['name'] == 'ix_customer_name_trgm' for ix in inspect(engine).get_indexes('customer')) else 'like'
+    if engine.dialect.name != 'sqlite':
+        return 'like'
+    with engine.connect() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'customer_fts'")).first()
+    return 'fts5' if exists else 'like'
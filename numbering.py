@@ -0,0 +1,96 @@
+# -----------------------------
+# INVOICE NUMBER ALLOCATION
+# -----------------------------
+# Numbers come from a per-user counter row (invoice_sequence) that is bumped
+# with a single UPDATE ... RETURNING on its own short transaction, like a
+# database sequence. Each worker can reserve a block of numbers at a time
+# (INVOICE_NUMBER_BLOCK_SIZE) so concurrent creates rarely touch the counter
+# row at all; the cost is that numbers left in a block when a worker exits are
+# skipped. Blocks are guarded per (user, scope), so one tenant waiting on the
+# counter row never holds up another's allocations. Uniqueness is guaranteed by the (user_id, invoice_no) unique index,
+# not by checking before inserting.
+#
+# Formats are str.format templates with these fields:
+#   {seq}   running number, e.g. {seq:04d}
+#   {fy}    Indian financial year of the invoice date, e.g. 2024-25
+#   {yyyy} {yy} {mm}   calendar year / month of the invoice date
+# The counter restarts whenever the rest of the rendered number changes, so
+# 'INV/{fy}/{seq:04d}' starts again at 0001 every April.
+import threading
+from datetime import date
+
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+DEFAULT_FORMAT = 'INV-{seq:04d}'
+
+
+class _SeqPlaceholder:
+    def __format__(self, spec): return '#'
+
+
+def financial_year(on_date):
+    start = on_date.year if on_date.month >= 4 else on_date.year - 1
+    return f"{start}-{(start + 1) % 100:02d}"
+
+
+def _fields(on_date):
+    return {'fy': financial_year(on_date), 'yyyy': f"{on_date.year:04d}", 'yy': f"{on_date.year % 100:02d}", 'mm': f"{on_date.month:02d}"}
+
+
+def format_invoice_number(fmt, seq, on_date):
+    return (fmt or DEFAULT_FORMAT).format(seq=seq, **_fields(on_date))
+
+
+def sequence_scope(fmt, on_date):
+    """The counter a number is drawn from: the rendered format with the sequence blanked out."""
+    return (fmt or DEFAULT_FORMAT).format(seq=_SeqPlaceholder(), **_fields(on_date))[:100]
+
+
+def validate_format(fmt):
+    """Error message for an unusable format, or None."""
+    if not fmt: return None
+    if '{seq' not in fmt: return "Invoice number format must contain {seq}."
+    try: format_invoice_number(fmt, 1, date.today())
+    except (KeyError, ValueError, IndexError, AttributeError) as e: return f"Invalid invoice number format: {e}"
+    return None
+
+
+class InvoiceNumberAllocator:
+    def __init__(self, sequence_table, block_size=1):
+        self.table = sequence_table
+        self.block_size = max(1, block_size)
+        self._blocks = {} # (user_id, scope) -> [next, last]
+        self._key_locks = {} # (user_id, scope) -> Lock guarding that block
+        self._lock = threading.Lock() # guards the two dicts only, never held across a query
+
+    def _reserve(self, engine, user_id, scope, count):
+        """Atomically take `count` numbers from the counter; returns the first."""
+        t = self.table
+        bump = (update(t).where(t.c.user_id == user_id, t.c.scope == scope)
+                .values(next_value=t.c.next_value + count).returning(t.c.next_value))
+        with engine.begin() as conn:
+            new_next = conn.execute(bump).scalar()
+            if new_next is None:
+                dialect_insert = pg_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+                conn.execute(dialect_insert(t).values(user_id=user_id, scope=scope, next_value=1).on_conflict_do_nothing())
+                new_next = conn.execute(bump).scalar()
+        return new_next - count
+
+    def allocate(self, engine, user_id, fmt, on_date):
+        scope = sequence_scope(fmt, on_date); key = (user_id, scope)
+        with self._lock: key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            block = self._blocks.get(key)
+            if not block or block[0] > block[1]:
+                first = self._reserve(engine, user_id, scope, self.block_size)
+                block = self._blocks[key] = [first, first + self.block_size - 1]
+            seq = block[0]; block[0] += 1
+        return format_invoice_number(fmt, seq, on_date)
+
+    def discard(self, user_id=None):
+        """Forget reserved blocks (all, or one user's), e.g. after the counter was edited by hand."""
+        with self._lock: keys = [k for k in self._key_locks if user_id is None or k[0] == user_id]
+        for key in keys:
+            with self._key_locks[key]: self._blocks.pop(key, None)
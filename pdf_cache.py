@@ -0,0 +1,134 @@
+# -----------------------------
+# GENERATED PDF CACHE
+# -----------------------------
+# Rendered invoice PDFs are keyed by a hash of everything that reaches the page
+# (the invoice_document() dict plus the renderer version), so an edit to the
+# invoice, its customer or the company profile always produces a new key and a
+# stale PDF can never be served. Two tiers:
+#   * a bounded in-memory LRU per worker process
+#   * an on-disk tier shared by all workers that survives restarts, laid out as
+#     <directory>/<user_id>/<invoice_id>/<key>.pdf
+# invalidate() only reclaims space; correctness comes from the key itself, so a
+# worker whose memory tier still holds an old version simply never looks it up.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from documents import RENDERER_VERSION, LARGE_INVOICE_ITEMS
+
+
+def document_key(document):
+    """Content hash of an invoice_document() dict."""
+    payload = json.dumps([RENDERER_VERSION, LARGE_INVOICE_ITEMS, document], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class PdfCache:
+    def __init__(self, directory=None, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+
+    # --- Lookup ---
+    def get(self, user_id, invoice_id, key):
+        mem_key = (user_id, invoice_id, key)
+        with self._lock:
+            data = self._memory.get(mem_key)
+            if data is not None:
+                self._memory.move_to_end(mem_key)
+                self.hits['memory'] += 1
+                return data
+        data = self._read_disk(user_id, invoice_id, key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits['disk'] += 1
+            self._remember(mem_key, data)
+        return data
+
+    def put(self, user_id, invoice_id, key, data):
+        with self._lock:
+            self._forget(lambda k: k[0] == user_id and k[1] == invoice_id)
+            self._remember((user_id, invoice_id, key), data)
+        self._write_disk(user_id, invoice_id, key, data)
+
+    # --- Invalidation ---
+    def invalidate(self, user_id, invoice_ids=None):
+        """Drop cached PDFs for the given invoices, or for every invoice of the user when invoice_ids is None."""
+        ids = None if invoice_ids is None else set(invoice_ids)
+        with self._lock:
+            self._forget(lambda k: k[0] == user_id and (ids is None or k[1] in ids))
+        if not self.directory:
+            return
+        user_dir = os.path.join(self.directory, str(user_id))
+        targets = [user_dir] if ids is None else [os.path.join(user_dir, str(i)) for i in ids]
+        for path in targets:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear(); self._memory_bytes = 0
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._memory), 'bytes': self._memory_bytes, 'memory_hits': self.hits['memory'], 'disk_hits': self.hits['disk'], 'misses': self.misses}
+
+    # --- Memory tier (caller holds the lock) ---
+    def _remember(self, mem_key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._memory.pop(mem_key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[mem_key] = data
+        self._memory_bytes += len(data)
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _forget(self, predicate):
+        for mem_key in [k for k in self._memory if predicate(k)]:
+            self._memory_bytes -= len(self._memory.pop(mem_key))
+
+    # --- Disk tier ---
+    def _path(self, user_id, invoice_id, key):
+        return os.path.join(self.directory, str(user_id), str(invoice_id), f"{key}.pdf")
+
+    def _read_disk(self, user_id, invoice_id, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(user_id, invoice_id, key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, user_id, invoice_id, key, data):
+        if not self.directory:
+            return
+        invoice_dir = os.path.dirname(self._path(user_id, invoice_id, key))
+        try:
+            os.makedirs(invoice_dir, exist_ok=True)
+            # Older versions of this invoice can never be requested again.
+            for name in os.listdir(invoice_dir):
+                if name != f"{key}.pdf" and not name.endswith('.tmp'):
+                    try: os.remove(os.path.join(invoice_dir, name))
+                    except OSError: pass
+            fd, tmp_path = tempfile.mkstemp(dir=invoice_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(user_id, invoice_id, key)) # atomic, so other workers never read a partial file
+        except OSError as e:
+            print(f"WARNING: Could not write PDF cache entry: {e}")
@@ -0,0 +1,323 @@
+# -----------------------------
+# INVOICE PDF RENDERING ENGINE
+# -----------------------------
+# Fonts, paragraph styles and table styles are built once per process (on first
+# use, or eagerly via warm_up()) and shared by every render afterwards.
+# render_invoice_pdf() accepts either an Invoice model or the plain dict produced
+# by invoice_document(), so batch jobs can render without a database session.
+# Importing this module loads ReportLab, so the web app imports it lazily (see
+# documents.py for the parts that don't need it).
+#
+# Invoices with more than LARGE_INVOICE_ITEMS line items use a second layout:
+# item cells are plain strings (wrapped once with simpleSplit) in rows whose
+# heights are computed up front, and the item list is cut into one Table per
+# page, each ending with the page subtotal and the running total. Each page's
+# Table is measured with wrap() before it is placed, and rows that do not fit
+# move to the next page, so a chunk never splits away from its subtotal. One big Table
+# of Paragraphs is re-measured every time it splits across a page, which made
+# render time grow quadratically with the item count.
+import io
+import os
+import threading
+import time
+
+from reportlab.lib.pagesizes import A4
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib import colors
+from reportlab.lib.units import inch, mm
+from reportlab.lib.enums import TA_RIGHT, TA_CENTER
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.fonts import addMapping
+from reportlab.lib.utils import simpleSplit
+
+from formatting import get_currency_symbol, format_date
+from documents import RENDERER_VERSION, LARGE_INVOICE_ITEMS, invoice_document, layout_for # re-exported for callers that only import the renderer
+
+FONTS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'fonts')
+THEME_COLOR = colors.HexColor('#4A90E2')
+LIGHT_BG_COLOR = colors.HexColor('#F8F9FA')
+ITEM_COL_WIDTHS = [2.8*inch, 0.8*inch, 0.5*inch, 0.6*inch, 0.9*inch, 0.6*inch, 1.1*inch]
+PAGE_MARGIN = 15*mm
+FRAME_WIDTH = A4[0] - 2*PAGE_MARGIN - 12 # SimpleDocTemplate's frame pads 6pt on each side
+FRAME_HEIGHT = A4[1] - 2*PAGE_MARGIN - 12
+CELL_PADDING = 6 # ReportLab's default left/right cell padding
+LARGE_FONT_SIZE = 8
+LARGE_LEADING = 10
+LARGE_PADDING = 3
+LARGE_ROW_HEIGHT = LARGE_LEADING + 2*LARGE_PADDING # one line of text
+
+
+class _Engine:
+    """Process-wide fonts and styles. Never mutated after construction."""
+
+    def __init__(self):
+        started = time.perf_counter()
+        self.font_normal, self.font_bold = self._register_fonts()
+        self.font_load_seconds = time.perf_counter() - started
+        self._build_styles()
+
+    @staticmethod
+    def _register_fonts():
+        font_normal, font_bold = 'NotoSans', 'NotoSans-Bold'
+        try:
+            pdfmetrics.registerFont(TTFont(font_normal, os.path.join(FONTS_DIR, 'NotoSans-Regular.ttf')))
+            pdfmetrics.registerFont(TTFont(font_bold, os.path.join(FONTS_DIR, 'NotoSans-Bold.ttf')))
+            # Add mapping for bold/italic (though we only have bold)
+            addMapping(font_normal, 0, 0, font_normal) # normal
+            addMapping(font_normal, 1, 0, font_bold)   # bold
+            addMapping(font_normal, 0, 1, font_normal) # italic (fallback to normal)
+            addMapping(font_normal, 1, 1, font_bold)   # bold-italic (fallback to bold)
+            print(f"Successfully registered fonts: {font_normal}, {font_bold}")
+            return font_normal, font_bold
+        except Exception as e:
+            print(f"WARNING: Font registration failed: {e}. Falling back to Helvetica.")
+            return 'Helvetica', 'Helvetica-Bold'
+
+    def _build_styles(self):
+        styles = getSampleStyleSheet()
+        self.style_normal = ParagraphStyle(name='NormalBase', parent=styles['Normal'], fontName=self.font_normal, fontSize=9, leading=12)
+        self.style_normal_right = ParagraphStyle(name='Normal_Right', parent=self.style_normal, alignment=TA_RIGHT)
+        self.style_bold = ParagraphStyle(name='Bold', parent=self.style_normal, fontName=self.font_bold)
+        self.style_bold_right = ParagraphStyle(name='Bold_Right', parent=self.style_bold, alignment=TA_RIGHT)
+        self.style_small = ParagraphStyle(name='Small', parent=self.style_normal, fontSize=8, leading=10)
+        self.style_small_right = ParagraphStyle(name='Small_Right', parent=self.style_small, alignment=TA_RIGHT)
+        self.style_title = ParagraphStyle(name='Title', parent=styles['h1'], fontName=self.font_bold, fontSize=18, alignment=TA_CENTER)
+        self.style_table_header = ParagraphStyle(name='TableHeader', parent=self.style_small, fontName=self.font_bold, textColor=colors.white)
+        self.style_table_header_right = ParagraphStyle(name='TableHeaderRight', parent=self.style_table_header, alignment=TA_RIGHT)
+
+        # Table.setStyle() copies the command list, so one TableStyle can serve every render.
+        self.invoice_details_table_style = TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP')])
+        self.header_table_style = TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('RIGHTPADDING', (0,0), (-1,-1), 0), ('BOTTOMPADDING', (0,0), (-1,-1), 5*mm)])
+        self.transport_table_style = TableStyle([('BACKGROUND', (0,0), (-1,-1), LIGHT_BG_COLOR), ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey), ('PADDING', (0,0), (-1,-1), 6), ('VALIGN', (0,0), (-1,-1), 'TOP')])
+        self.item_table_style = TableStyle([('BACKGROUND', (0,0), (-1,0), THEME_COLOR), ('TEXTCOLOR', (0,0), (-1,0), colors.white), ('FONTNAME', (0,0), (-1,0), self.font_bold), ('BOTTOMPADDING', (0,0), (-1,0), 6), ('TOPPADDING', (0,0), (-1,0), 6), ('ALIGN', (0,0), (-1,0), 'CENTER'), ('FONTNAME', (0,1), (-1,-1), self.font_normal), ('FONTSIZE', (0,1), (-1,-1), 8), ('TOPPADDING', (0,1), (-1,-1), 4), ('BOTTOMPADDING', (0,1), (-1,-1), 4), ('LINEBELOW', (0,0), (-1,0), 1, THEME_COLOR), ('LINEBELOW', (0,-1), (-1,-1), 0.5, colors.grey), ('ALIGN', (2,1), (-1,-1), 'RIGHT'), ('VALIGN', (0,0), (-1,-1), 'MIDDLE')])
+        self.tax_table_style = TableStyle([('FONTSIZE', (0,0), (-1,-1), 8), ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey), ('BOX', (0,0), (-1,-1), 0.5, colors.grey), ('BACKGROUND', (0,0), (-1,0), LIGHT_BG_COLOR), ('FONTNAME', (0,0), (-1,-1), self.font_normal)])
+        self.totals_table_style = TableStyle([('VALIGN', (0,0), (-1,-1), 'MIDDLE'), ('TOPPADDING', (0,0), (-1,-1), 4), ('BOTTOMPADDING', (0,0), (-1,-1), 4), ('LINEABOVE', (0, -1), (-1, -1), 1, colors.grey), ('BACKGROUND', (0, -1), (-1, -1), LIGHT_BG_COLOR), ('FONTNAME', (0,0), (-1,-1), self.font_bold)])
+        self.footer_table_style = TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('RIGHTPADDING', (0,0), (-1,-1), 0)])
+        self.large_item_table_style = TableStyle([('BACKGROUND', (0,0), (-1,0), THEME_COLOR), ('TEXTCOLOR', (0,0), (-1,0), colors.white), ('FONTNAME', (0,0), (-1,0), self.font_bold), ('FONTNAME', (0,1), (-1,-1), self.font_normal), ('FONTSIZE', (0,0), (-1,-1), LARGE_FONT_SIZE), ('LEADING', (0,0), (-1,-1), LARGE_LEADING), ('TOPPADDING', (0,0), (-1,-1), LARGE_PADDING), ('BOTTOMPADDING', (0,0), (-1,-1), LARGE_PADDING), ('ALIGN', (2,0), (-1,-1), 'RIGHT'), ('VALIGN', (0,0), (-1,-1), 'TOP'), ('LINEBELOW', (0,0), (-1,0), 1, THEME_COLOR), ('LINEBELOW', (0,1), (-1,-1), 0.25, colors.lightgrey)])
+        self.large_item_header = ("Item Description", "HSN/SAC", "Qty", "Unit", "Rate", "Tax %", "Amount")
+        self.item_header_row = (
+            Paragraph("Item Description", self.style_table_header), Paragraph("HSN/SAC", self.style_table_header),
+            Paragraph("Qty", self.style_table_header_right), Paragraph("Unit", self.style_table_header_right),
+            Paragraph("Rate", self.style_table_header_right), Paragraph("Tax %", self.style_table_header_right),
+            Paragraph("Amount", self.style_table_header_right),
+        )
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process-wide engine, building it on first call."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _Engine()
+    return _engine
+
+
+def warm_up():
+    """Load fonts and styles now instead of on the first download: gunicorn's when_ready hook calls it in the master, the render pool as its initializer."""
+    get_engine()
+
+
+def _nl_to_br(text):
+    return text.replace('\n', '<br/>') if text else ''
+
+
+def _derive_tax_summary(items):
+    """{rate: {'taxable_amount', 'gst_amount'}} from the items, for documents without a stored breakdown."""
+    tax_summary = {}
+    for item in items:
+        line_total = item['qty'] * item['rate']; tax_rate = item['tax_percent']
+        entry = tax_summary.setdefault(tax_rate, {'taxable_amount': 0, 'gst_amount': 0})
+        entry['taxable_amount'] += line_total
+        entry['gst_amount'] += line_total * tax_rate / 100
+    return tax_summary
+
+
+def _standard_item_table(e, items, currency):
+    item_table_data = [list(e.item_header_row)]
+    for item in items:
+        line_total = item['qty'] * item['rate']
+        item_table_data.append([
+            Paragraph(item['name'], e.style_small),
+            Paragraph(item['hsn'] or '', e.style_small),
+            Paragraph(str(item['qty']), e.style_small_right),
+            Paragraph(item['unit'] or '', e.style_small_right),
+            Paragraph(f"{currency}{item['rate']:.2f}", e.style_small_right),
+            Paragraph(f"{item['tax_percent']:.0f}%", e.style_small_right),
+            Paragraph(f"{currency}{line_total:.2f}", e.style_small_right)
+        ])
+    item_table = Table(item_table_data, colWidths=ITEM_COL_WIDTHS, repeatRows=1)
+    item_table.setStyle(e.item_table_style)
+    return [item_table]
+
+
+def _large_page_table(e, items, wrapped, page, currency, brought_forward, last):
+    """One page of the large layout: (Table, page total). `brought_forward` is None on the first page."""
+    data = [e.large_item_header]; heights = [LARGE_ROW_HEIGHT]; summary_rows = []
+    if brought_forward is not None:
+        summary_rows.append(len(data)); data.append(("Brought forward", '', '', '', '', '', f"{currency}{brought_forward:.2f}")); heights.append(LARGE_ROW_HEIGHT)
+    page_total = 0
+    for index, height in page:
+        item = items[index]; name_lines, hsn_lines = wrapped[index]
+        line_total = item['qty'] * item['rate']; page_total += line_total
+        data.append(('\n'.join(name_lines), '\n'.join(hsn_lines), str(item['qty']), item['unit'] or '',
+                     f"{currency}{item['rate']:.2f}", f"{item['tax_percent']:.0f}%", f"{currency}{line_total:.2f}"))
+        heights.append(height)
+    running = (brought_forward or 0) + page_total
+    summary_rows += [len(data), len(data) + 1]
+    data.append(("Page subtotal", '', '', '', '', '', f"{currency}{page_total:.2f}"))
+    data.append(("Total of all items" if last else "Carried forward", '', '', '', '', '', f"{currency}{running:.2f}"))
+    heights += [LARGE_ROW_HEIGHT, LARGE_ROW_HEIGHT]
+    table = Table(data, colWidths=ITEM_COL_WIDTHS, rowHeights=heights)
+    table.setStyle(e.large_item_table_style)
+    table.setStyle(TableStyle([command for row in summary_rows for command in (
+        ('SPAN', (0,row), (5,row)), ('ALIGN', (0,row), (0,row), 'RIGHT'), ('FONTNAME', (0,row), (-1,row), e.font_bold), ('BACKGROUND', (0,row), (-1,row), LIGHT_BG_COLOR))]))
+    return table, page_total
+
+
+def _large_item_tables(e, items, currency, first_space):
+    """Page-sized item Tables of plain strings, each closed by its page subtotal and the running total."""
+    name_width = ITEM_COL_WIDTHS[0] - 2*CELL_PADDING; hsn_width = ITEM_COL_WIDTHS[1] - 2*CELL_PADDING
+    wrapped = [(simpleSplit(item['name'] or '', e.font_normal, LARGE_FONT_SIZE, name_width) or [''],
+                simpleSplit(item['hsn'] or '', e.font_normal, LARGE_FONT_SIZE, hsn_width) or ['']) for item in items]
+
+    # Cut the rows into pages by height: header, page subtotal and running total on every page, brought forward after the first
+    flowables = []; space = first_space
+    if space < 8 * LARGE_ROW_HEIGHT: flowables.append(PageBreak()); space = FRAME_HEIGHT
+    pages = [[]]; used = 3 * LARGE_ROW_HEIGHT; first_space = space
+    for index, (name_lines, hsn_lines) in enumerate(wrapped):
+        height = max(len(name_lines), len(hsn_lines)) * LARGE_LEADING + 2*LARGE_PADDING
+        if pages[-1] and used + height > space:
+            pages.append([]); space = FRAME_HEIGHT; used = 4 * LARGE_ROW_HEIGHT
+        pages[-1].append((index, height)); used += height
+
+    # Measure each page's Table before placing it; rows the estimate let overflow move on to the next page
+    running = 0; number = 0
+    while number < len(pages):
+        page = pages[number]; space = first_space if number == 0 else FRAME_HEIGHT
+        while True:
+            last = number == len(pages) - 1
+            table, page_total = _large_page_table(e, items, wrapped, page, currency, running if number else None, last)
+            if len(page) == 1 or table.wrap(FRAME_WIDTH, space)[1] <= space: break
+            if last: pages.append([])
+            pages[number + 1].insert(0, page.pop())
+        running += page_total
+        flowables.append(table)
+        if not last: flowables.append(PageBreak())
+        number += 1
+    return flowables
+
+
+def _build_story(engine, document, layout='standard'):
+    e = engine; profile = document['profile']; customer = document['customer']
+    currency = get_currency_symbol(profile['currency'])
+
+    def format_date_pdf(date_str):
+        return format_date(date_str, profile['date_format']) if date_str else 'N/A'
+
+    story = [Paragraph("TAX INVOICE", e.style_title), Spacer(1, 8*mm)]
+
+    supplier_details = f"<b>{profile['name']}</b><br/>{_nl_to_br(profile['address'])}<br/><b>GSTIN:</b> {profile['gstin']}<br/><b>Phone:</b> {profile['phone'] or 'N/A'}<br/><b>Email:</b> {profile['email'] or 'N/A'}"
+    bill_to_details = f"<b>Bill To:</b><br/><b>{customer['name']}</b><br/>{_nl_to_br(customer['billing_address'])}<br/><b>GSTIN:</b> {customer['gstin'] or 'N/A'}"
+    ship_to_address = customer['shipping_address'] or customer['billing_address']
+    ship_to_details = f"<b>Ship To:</b><br/><b>{customer['name']}</b><br/>{_nl_to_br(ship_to_address)}"
+
+    invoice_details_data = [
+        [Paragraph("<b>Invoice No.:</b>", e.style_normal), Paragraph(document['invoice_no'], e.style_normal_right)],
+        [Paragraph("<b>Invoice Date:</b>", e.style_normal), Paragraph(format_date_pdf(document['date']), e.style_normal_right)],
+        [Paragraph("<b>E-Way Bill No.:</b>", e.style_normal), Paragraph(document['eway_bill_no'] or 'N/A', e.style_normal_right)],
+        [Paragraph("<b>Place of Supply:</b>", e.style_normal), Paragraph(document['place_of_supply'] or customer['state'] or 'N/A', e.style_normal_right)]
+    ]
+    invoice_details_table = Table(invoice_details_data, colWidths=['*', 1.8*inch])
+    invoice_details_table.setStyle(e.invoice_details_table_style)
+
+    header_data = [[Paragraph(supplier_details, e.style_normal), [Paragraph(bill_to_details, e.style_normal), Spacer(1, 4*mm), Paragraph(ship_to_details, e.style_normal)], invoice_details_table]]
+    header_table = Table(header_data, colWidths=[2.7*inch, 2.7*inch, 2.4*inch])
+    header_table.setStyle(e.header_table_style)
+    story.append(header_table)
+
+    transport_data = [[
+        Paragraph(f"<b>P.O. Number:</b><br/>{document['po_number'] or 'N/A'}", e.style_small),
+        Paragraph(f"<b>P.O. Date:</b><br/>{format_date_pdf(document['po_date'])}", e.style_small),
+        Paragraph(f"<b>Transport:</b><br/>{document['transport_name'] or 'N/A'}", e.style_small),
+        Paragraph(f"<b>Vehicle No.:</b><br/>{document['vehicle_no'] or 'N/A'}", e.style_small),
+        Paragraph(f"<b>Delivery At:</b><br/>{document['delivery_location'] or 'N/A'}", e.style_small)
+    ]]
+    transport_table = Table(transport_data, colWidths='*')
+    transport_table.setStyle(e.transport_table_style)
+    story.append(transport_table); story.append(Spacer(1, 6*mm))
+
+    if layout == 'large':
+        # space left on the first page under the header blocks above
+        first_space = FRAME_HEIGHT - sum(f.wrap(FRAME_WIDTH, FRAME_HEIGHT)[1] + f.getSpaceBefore() + f.getSpaceAfter() for f in story)
+        story.extend(_large_item_tables(e, document['items'], currency, first_space))
+    else:
+        story.extend(_standard_item_table(e, document['items'], currency))
+    story.append(Spacer(1, 8*mm))
+
+    tax_table_data = [[Paragraph("<b>Tax Rate</b>", e.style_small), Paragraph("<b>Taxable Amount</b>", e.style_small_right), Paragraph("<b>GST Amount</b>", e.style_small_right)]]
+    stored_summary = document.get('tax_summary')
+    tax_summary = {line['tax_percent']: line for line in stored_summary} if stored_summary is not None else _derive_tax_summary(document['items'])
+    for rate, data in sorted(tax_summary.items()):
+        tax_table_data.append([Paragraph(f"{rate:.0f}%", e.style_small), Paragraph(f"{currency}{data['taxable_amount']:.2f}", e.style_small_right), Paragraph(f"{currency}{data['gst_amount']:.2f}", e.style_small_right)])
+    tax_table = Table(tax_table_data, colWidths='*')
+    tax_table.setStyle(e.tax_table_style)
+
+    bank_details = f"<b>Bank Details:</b><br/><b>Bank:</b> {profile['bank_name'] or 'N/A'}<br/><b>A/C No:</b> {profile['account_no'] or 'N/A'}<br/><b>IFSC:</b> {profile['ifsc_code'] or 'N/A'}"
+    terms = f"<b>Terms & Conditions:</b><br/>{_nl_to_br(profile['terms_and_conditions']) or 'Thank you for your business.'}"
+    left_footer_content = [Paragraph("<b>Tax Summary:</b>", e.style_bold), Spacer(1, 1*mm), tax_table, Spacer(1, 5*mm), Paragraph(bank_details, e.style_small), Spacer(1, 5*mm), Paragraph(terms, e.style_small)]
+
+    totals_data = [
+        [Paragraph("Subtotal:", e.style_bold), Paragraph(f"{currency}{document['subtotal']:.2f}", e.style_bold_right)],
+        [Paragraph("Total GST:", e.style_bold), Paragraph(f"{currency}{document['total_gst']:.2f}", e.style_bold_right)],
+        [Paragraph("Grand Total:", e.style_bold), Paragraph(f"{currency}{document['grand_total']:.2f}", e.style_bold_right)]
+    ]
+    totals_table = Table(totals_data, colWidths=['*', 1.5*inch])
+    totals_table.setStyle(e.totals_table_style)
+
+    signature = f"For: {profile['name']}<br/><br/><br/><br/>Authorized Signatory"
+    right_footer_content = [totals_table, Spacer(1, 15*mm), Paragraph(signature, e.style_small_right)]
+
+    footer_table = Table([[left_footer_content, right_footer_content]], colWidths=[4.8*inch, 2.5*inch])
+    footer_table.setStyle(e.footer_table_style)
+    story.append(footer_table)
+    return story
+
+
+def render_invoice_pdf(invoice, timings=None, layout=None):
+    """Render an invoice to PDF bytes.
+
+    `invoice` is an Invoice model or an invoice_document() dict. If `timings` is a
+    dict it receives the seconds spent in each phase: 'font_load' (non-zero only
+    for the call that initialised the engine), 'story_build' and 'doc_build'.
+    `layout` forces 'standard' or 'large'; by default it follows layout_for().
+    """
+    started = time.perf_counter()
+    cold = _engine is None
+    engine = get_engine()
+    font_load = engine.font_load_seconds if cold else 0.0
+    document = invoice if isinstance(invoice, dict) else invoice_document(invoice)
+
+    t0 = time.perf_counter()
+    story = _build_story(engine, document, layout or layout_for(document))
+    t1 = time.perf_counter()
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=PAGE_MARGIN, leftMargin=PAGE_MARGIN, topMargin=PAGE_MARGIN, bottomMargin=PAGE_MARGIN)
+    doc.build(story)
+    t2 = time.perf_counter()
+
+    if timings is not None:
+        timings.update(font_load=font_load, story_build=t1 - t0, doc_build=t2 - t1, total=t2 - started)
+    return buffer.getvalue()
+
+
+def render_invoice_pdf_timed(invoice):
+    """(pdf_bytes, timings) — render_invoice_pdf for a process pool, where the timings dict can't be shared."""
+    timings = {}
+    return render_invoice_pdf(invoice, timings=timings), timings
@@ -150,4 +150,123 @@ document.addEventListener("DOMContentLoaded", function() {
     }
     // --- END NEW SCRIPT ---
 
+
+    // --- 3. IMPORT PROGRESS POLLING ---
+    // Rows of unfinished import jobs ask the server for progress every 2 seconds
+    document.querySelectorAll(".import-job").forEach(function(row) {
+        if (row.dataset.status === "done" || row.dataset.status === "failed") return;
+
+        function poll() {
+            fetch(row.dataset.statusUrl, { credentials: "same-origin" })
+                .then(response => response.json())
+                .then(job => {
+                    row.querySelector(".job-status").textContent = job.status;
+                    row.querySelector(".job-processed").textContent = job.rows_processed;
+                    row.querySelector(".job-imported").textContent = job.rows_imported;
+                    row.querySelector(".job-skipped").textContent = job.rows_skipped;
+                    const errorsCell = row.querySelector(".job-errors");
+                    errorsCell.textContent = "";
+                    job.errors.slice(0, 5).forEach(error => {
+                        const line = document.createElement("div");
+                        line.textContent = (error.line ? "Line " + error.line + ": " : "") + error.error;
+                        errorsCell.appendChild(line);
+                    });
+                    if (job.status !== "done" && job.status !== "failed") setTimeout(poll, 2000);
+                })
+                .catch(() => setTimeout(poll, 5000));
+        }
+        poll();
+    });
+
+
+    // --- 4. CUSTOMER TYPEAHEAD ---
+    // Looks customers up on the server as the user types instead of shipping the whole customer book with the form
+    const customerSearch = document.getElementById("customer-search");
+    const customerIdInput = document.getElementById("customer");
+    const suggestions = document.getElementById("customer-suggestions");
+
+    if (customerSearch && customerIdInput && suggestions) {
+        let debounceTimer = null;
+        let latestQuery = "";
+
+        function renderSuggestions(results) {
+            suggestions.innerHTML = "";
+            results.forEach(customer => {
+                const option = document.createElement("div");
+                option.className = "typeahead-option";
+                option.textContent = customer.name + (customer.gstin ? " (" + customer.gstin + ")" : "");
+                option.addEventListener("mousedown", function(event) {
+                    event.preventDefault(); // keep focus so blur doesn't hide the list first
+                    customerSearch.value = customer.name;
+                    customerIdInput.value = customer.id;
+                    suggestions.hidden = true;
+                });
+                suggestions.appendChild(option);
+            });
+            if (!results.length) {
+                const empty = document.createElement("div");
+                empty.className = "typeahead-empty";
+                empty.textContent = "No matching customers.";
+                suggestions.appendChild(empty);
+            }
+            suggestions.hidden = false;
+        }
+
+        customerSearch.addEventListener("input", function() {
+            customerIdInput.value = ""; // typing invalidates the previous pick
+            clearTimeout(debounceTimer);
+            const query = customerSearch.value.trim();
+            if (!query) { suggestions.hidden = true; return; }
+            debounceTimer = setTimeout(function() {
+                latestQuery = query;
+                fetch(customerSearch.dataset.searchUrl + "?per_page=10&q=" + encodeURIComponent(query), { credentials: "same-origin" })
+                    .then(response => response.json())
+                    .then(data => { if (query === latestQuery) renderSuggestions(data.results); })
+                    .catch(() => {});
+            }, 200);
+        });
+
+        customerSearch.addEventListener("blur", function() { suggestions.hidden = true; });
+
+        if (invoiceForm) {
+            invoiceForm.addEventListener("submit", function(event) {
+                if (!customerIdInput.value) {
+                    event.preventDefault();
+                    alert("Please pick a customer from the list.");
+                    customerSearch.focus();
+                }
+            });
+        }
+    }
+    // --- END CUSTOMER TYPEAHEAD ---
+
+
+    // --- 5. BACKGROUND JOB POLLING ---
+    // Job pages (PDF render, export) poll the job and start the download once it is done
+    const jobPanel = document.querySelector(".job-status-panel");
+
+    if (jobPanel && jobPanel.dataset.status !== "done" && jobPanel.dataset.status !== "failed") {
+        function pollJob() {
+            fetch(jobPanel.dataset.statusUrl, { credentials: "same-origin" })
+                .then(response => response.json())
+                .then(job => {
+                    jobPanel.querySelector(".job-status").textContent = job.status;
+                    if (job.status === "done" && job.result_url) {
+                        const link = jobPanel.querySelector(".job-result");
+                        link.href = job.result_url;
+                        link.hidden = false;
+                        jobPanel.querySelector(".job-message").textContent = "Ready.";
+                        window.location.href = job.result_url;
+                    } else if (job.status === "failed") {
+                        jobPanel.querySelector(".job-message").textContent = "Failed: " + (job.error || "unknown error");
+                    } else {
+                        setTimeout(pollJob, 1000);
+                    }
+                })
+                .catch(() => setTimeout(pollJob, 5000));
+        }
+        pollJob();
+    }
+    // --- END BACKGROUND JOB POLLING ---
+
 }); // --- END of DOMContentLoaded listener ---
\ No newline at end of file
@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = f'sqlite:///{_tmp}/test.db'
+os.environ.setdefault('PDF_CACHE_DIR', f'{_tmp}/pdfcache')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as appmod  # noqa: E402
+
+INVOICE_FORM = dict(customer='1', invoice_no='INV-1', date='2024-04-05', item_name=['A'], hsn=['1'], qty=['2'], unit=['u'], rate=['10'], tax_percent=['18'])
+
+
+@pytest.fixture()
+def client():
+    app = appmod.app
+    app.config['TESTING'] = True
+    with app.app_context():
+        appmod.db.drop_all(); appmod.init_db()
+    for cache in (appmod.identity_cache, appmod.kpi_cache, appmod.overdue_swept): cache.clear()
+    appmod.invoice_numbers.discard()
+    client = app.test_client()
+    client.post('/register', data=dict(email='a@b.c', username='a', password='p', confirm_password='p'))
+    client.post('/login', data=dict(email='a@b.c', password='p'))
+    client.post('/profile', data=dict(name='Acme', address='1 St', gstin='GST1', pan='P', email='e', phone='1', bank_name='B',
+                                      account_no='1', ifsc_code='I', currency='INR', date_format='DD/MM/YYYY', terms_and_conditions='T'))
+    client.post('/customers/add', data=dict(name='Cust', billing_address='Addr', gstin='29OLD', state='KA', contact_person='Bob'))
+    return client
@@ -0,0 +1,27 @@
+import app as appmod
+
+from conftest import INVOICE_FORM
+
+
+def rollup_rows():
+    with appmod.app.app_context():
+        return sorted((r.customer_gstin, r.place_of_supply, r.invoice_count) for r in appmod.GstRollup.query)
+
+
+def test_delete_after_customer_edit_removes_original_rollup_row(client):
+    client.post('/invoice/add', data=INVOICE_FORM)
+    assert rollup_rows() == [('29OLD', 'KA', 1)]
+
+    client.post('/customers/edit/1', data=dict(name='Cust', billing_address='Addr', gstin='29NEW', state='TN', contact_person='Bob'))
+    client.post('/invoice/delete/1')
+
+    assert rollup_rows() == []
+
+
+def test_rebuild_uses_invoice_time_keys(client):
+    client.post('/invoice/add', data=INVOICE_FORM)
+    client.post('/customers/edit/1', data=dict(name='Cust', billing_address='Addr', gstin='29NEW', state='TN', contact_person='Bob'))
+
+    with appmod.app.app_context():
+        appmod.rebuild_gst_rollups(); appmod.db.session.commit()
+    assert rollup_rows() == [('29OLD', 'KA', 1)]
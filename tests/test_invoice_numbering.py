@@ -0,0 +1,107 @@
+import datetime
+import io
+import threading
+import time
+
+import pytest
+from sqlalchemy import insert
+
+import app as appmod
+from conftest import INVOICE_FORM
+from numbering import InvoiceNumberAllocator, validate_format
+
+
+def allocator(block_size=1):
+    return InvoiceNumberAllocator(appmod.InvoiceSequence.__table__, block_size=block_size)
+
+
+def invoice_numbers():
+    with appmod.app.app_context():
+        return sorted(n for (n,) in appmod.db.session.query(appmod.Invoice.invoice_no))
+
+
+def test_concurrent_allocations_never_collide(client):
+    workers = [allocator(block_size=3), allocator(block_size=3)] # two processes sharing the counter row
+    numbers = []; lock = threading.Lock()
+    with appmod.app.app_context():
+        engine = appmod.db.engine
+
+        def allocate(worker):
+            for _ in range(10):
+                number = worker.allocate(engine, 1, 'INV-{seq:04d}', datetime.date(2024, 4, 5))
+                with lock: numbers.append(number)
+
+        threads = [threading.Thread(target=allocate, args=(workers[i % 2],)) for i in range(6)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+    assert len(numbers) == 60 and len(set(numbers)) == 60
+
+
+def test_exhausted_block_reserves_a_new_one(client):
+    numbers = allocator(block_size=2)
+    with appmod.app.app_context():
+        allocated = [numbers.allocate(appmod.db.engine, 1, 'INV-{seq:04d}', datetime.date(2024, 4, 5)) for _ in range(3)]
+        counter = appmod.InvoiceSequence.query.filter_by(user_id=1).one()
+        assert allocated == ['INV-0001', 'INV-0002', 'INV-0003']
+        assert counter.next_value == 5 # two blocks of two taken
+
+
+def test_financial_year_scope_restarts_in_april(client):
+    numbers = allocator(); fmt = 'INV/{fy}/{seq:04d}'
+    with appmod.app.app_context():
+        engine = appmod.db.engine
+        assert numbers.allocate(engine, 1, fmt, datetime.date(2024, 3, 30)) == 'INV/2023-24/0001'
+        assert numbers.allocate(engine, 1, fmt, datetime.date(2024, 3, 31)) == 'INV/2023-24/0002'
+        assert numbers.allocate(engine, 1, fmt, datetime.date(2024, 4, 1)) == 'INV/2024-25/0001'
+        assert numbers.allocate(engine, 1, fmt, datetime.date(2024, 3, 15)) == 'INV/2023-24/0003' # back-dated, old year's counter
+
+
+@pytest.mark.parametrize('fmt, ok', [
+    (None, True), ('INV/{fy}/{seq:04d}', True), ('{yy}{mm}-{seq}', True),
+    ('INV-0001', False), ('INV-{seq:04d}-{branch}', False), ('INV-{seq:04q}', False),
+])
+def test_validate_format(fmt, ok):
+    assert (validate_format(fmt) is None) == ok
+
+
+def test_form_numbering_skips_a_number_entered_by_hand(client):
+    client.post('/invoice/add', data=dict(INVOICE_FORM, invoice_no='INV-0001'))
+    response = client.post('/invoice/add', data=dict(INVOICE_FORM, invoice_no=''))
+    assert response.status_code == 302
+    assert invoice_numbers() == ['INV-0001', 'INV-0002']
+
+
+def test_form_reports_a_duplicate_chosen_number(client):
+    client.post('/invoice/add', data=dict(INVOICE_FORM, invoice_no='INV-0001'))
+    response = client.post('/invoice/add', data=dict(INVOICE_FORM, invoice_no='INV-0001'))
+    assert response.status_code == 200 and b"Invoice number &#39;INV-0001&#39; already exists." in response.data
+    assert invoice_numbers() == ['INV-0001']
+
+
+def import_jsonl(client, *lines):
+    body = '\n'.join(lines).encode()
+    response = client.post('/import', data={'kind': 'invoices', 'file': (io.BytesIO(body), 'i.jsonl')}, content_type='multipart/form-data')
+    job_id = int(response.headers['Location'].split('job=')[1])
+    for _ in range(300): # run by the background job workers
+        job = client.get(f'/import/{job_id}').get_json()
+        if job['status'] in ('done', 'failed'): return job
+        time.sleep(0.1)
+    raise AssertionError(f"import still {job['status']}")
+
+
+def test_import_reports_a_number_taken_during_the_batch(client, monkeypatch):
+    insert_numbered = appmod._insert_numbered
+
+    def racing_insert(user_id, profile, validated, skip=()):
+        with appmod.db.engine.begin() as conn: # another request writes INV-0007 between the lookup and the insert
+            conn.execute(insert(appmod.Invoice).values(user_id=user_id, profile_id=profile.id, customer_id=1, invoice_no='INV-0007', date=datetime.date(2024, 4, 5),
+                                                       subtotal=0, total_gst=0, grand_total=0, status='Draft'))
+        return insert_numbered(user_id, profile, validated, skip)
+
+    monkeypatch.setattr(appmod, '_insert_numbered', racing_insert)
+    item = '"items": [{"name": "A", "qty": 1, "rate": "10"}]'
+    job = import_jsonl(client, '{"invoice_no": "INV-0007", "customer_id": 1, "date": "2024-04-05", ' + item + '}',
+                       '{"customer_id": 1, "date": "2024-04-05", ' + item + '}')
+    assert job['status'] == 'done' and job['rows_imported'] == 1
+    assert job['errors'] == [{'line': 1, 'error': "Invoice number 'INV-0007' already exists."}]
+    assert invoice_numbers() == ['INV-0001', 'INV-0007']
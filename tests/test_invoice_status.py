@@ -0,0 +1,71 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+import app as appmod
+from conftest import INVOICE_FORM
+
+TODAY = datetime.date(2024, 6, 1)
+
+
+def add_invoice(client, number, due_date='2024-05-05'):
+    client.post('/invoice/add', data=dict(INVOICE_FORM, invoice_no=number, due_date=due_date)) # grand total 23.60
+    return appmod.Invoice.query.filter_by(invoice_no=number).one().id
+
+
+def state(invoice_id):
+    appmod.db.session.expire_all()
+    invoice = appmod.db.session.get(appmod.Invoice, invoice_id)
+    return invoice.status, invoice.amount_paid, appmod.Payment.query.filter_by(invoice_id=invoice_id).count()
+
+
+def test_illegal_transition_leaves_invoices_unchanged(client):
+    with appmod.app.app_context():
+        draft = add_invoice(client, 'INV-1'); sent = add_invoice(client, 'INV-2')
+        appmod.transition_invoices(1, [sent], 'Sent'); appmod.db.session.commit()
+
+        assert appmod.transition_invoices(1, [draft], 'Paid') == [] # Draft -> Paid skips issuing
+        assert appmod.transition_invoices(1, [sent], 'Sent') == []
+        with pytest.raises(appmod.InvoiceValidationError): appmod.transition_invoices(1, [draft, sent], 'Draft')
+        appmod.db.session.commit()
+        assert state(draft) == ('Draft', Decimal('0.00'), 0)
+        assert state(sent) == ('Sent', Decimal('0.00'), 0)
+
+
+def test_partial_then_final_payment(client):
+    with appmod.app.app_context():
+        invoice_id = add_invoice(client, 'INV-1')
+        appmod.transition_invoices(1, [invoice_id], 'Sent'); appmod.db.session.commit()
+
+        # a partial payment leaves the invoice payable with the balance reduced
+        assert appmod.record_payment(1, invoice_id, Decimal('10.00'), TODAY, 'UTR1') == 'Sent'; appmod.db.session.commit()
+        assert state(invoice_id) == ('Sent', Decimal('10.00'), 1)
+
+        assert appmod.record_payment(1, invoice_id, Decimal('13.60'), TODAY, 'UTR2') == 'Paid'; appmod.db.session.commit()
+        assert state(invoice_id) == ('Paid', Decimal('23.60'), 2)
+
+
+def test_overpayment_is_refused(client):
+    with appmod.app.app_context():
+        invoice_id = add_invoice(client, 'INV-1')
+        appmod.transition_invoices(1, [invoice_id], 'Sent')
+        appmod.record_payment(1, invoice_id, Decimal('20.00'), TODAY); appmod.db.session.commit()
+
+        with pytest.raises(appmod.InvoiceValidationError): appmod.record_payment(1, invoice_id, Decimal('5.00'), TODAY)
+        appmod.db.session.commit()
+        assert state(invoice_id) == ('Sent', Decimal('20.00'), 1)
+
+
+def test_sweep_only_touches_past_due_unpaid_invoices(client):
+    with appmod.app.app_context():
+        late = add_invoice(client, 'INV-1', due_date='2024-05-05')
+        not_due = add_invoice(client, 'INV-2', due_date='2024-06-01')
+        draft = add_invoice(client, 'INV-3', due_date='2024-05-05')
+        paid = add_invoice(client, 'INV-4', due_date='2024-05-05')
+        appmod.transition_invoices(1, [late, not_due, paid], 'Sent'); appmod.transition_invoices(1, [paid], 'Paid', on_date=TODAY)
+        appmod.db.session.commit()
+
+        assert appmod.sweep_overdue(1, today=TODAY) == 1; appmod.db.session.commit()
+        assert [state(i)[0] for i in (late, not_due, draft, paid)] == ['Overdue', 'Sent', 'Draft', 'Paid']
+        assert appmod.sweep_overdue(1, today=TODAY) == 0 # already Overdue